@@ -1,4 +1,12 @@
 #!/bin/bash
 
-# Start the Django development server
-exec python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
+# Create or update the tables (a new Postgres database starts empty)
+python manage.py migrate --noinput
+
+if [ "${SERVER:-gunicorn}" = "runserver" ]; then
+    # Start the Django development server (single process, auto-reload)
+    exec python manage.py runserver 0.0.0.0:8000
+fi
+
+# Production: gunicorn workers forked from a warmed-up master (see gunicorn.conf.py)
+exec gunicorn -c gunicorn.conf.py
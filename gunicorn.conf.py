@@ -0,0 +1,50 @@
+# gunicorn.conf.py
+# gunicorn -c gunicorn.conf.py  (entrypoint.sh; every value comes from the SERVER_* settings)
+import logging
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myapi.settings')
+
+from django.conf import settings  # noqa: E402 (needs DJANGO_SETTINGS_MODULE)
+
+logger = logging.getLogger(__name__)
+
+bind = settings.SERVER_BIND
+workers = settings.SERVER_WORKERS or multiprocessing.cpu_count()
+if settings.SERVER_WORKER_CLASS == 'uvicorn':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'myapi.asgi:application'
+else:
+    worker_class = settings.SERVER_WORKER_CLASS
+    threads = settings.SERVER_THREADS
+    wsgi_app = 'myapi.wsgi:application'
+timeout = settings.SERVER_TIMEOUT_SECONDS
+graceful_timeout = 30
+keepalive = settings.SERVER_KEEPALIVE_SECONDS
+max_requests = settings.SERVER_MAX_REQUESTS
+max_requests_jitter = settings.SERVER_MAX_REQUESTS_JITTER
+accesslog = '-'
+
+# Load the application in the master, then warm it up (when_ready) before the workers are forked;
+# workers replaced after max_requests are forked from the same warmed-up master
+preload_app = True
+
+
+def when_ready(server):
+    if not settings.WARMUP_ENABLED:
+        return
+    from query_app.warmup import warmup
+
+    try:
+        warmup()
+    except Exception as e:
+        # Workers load what is missing on first use instead
+        logger.warning(f"Warmup failed: {str(e)}")
+
+
+def worker_exit(server, worker):
+    # Writes the conversation turns the history writer still has queued
+    from query_app.history_writer import history_writer
+
+    history_writer.close()
@@ -1,6 +1,10 @@
 # myapi/celery.py
+import logging
 import os
 from celery import Celery
+from celery.signals import worker_init
+
+logger = logging.getLogger(__name__)
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myapi.settings')
@@ -12,4 +16,23 @@ app = Celery('myapi')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Auto-discover tasks in all installed apps.
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+@worker_init.connect
+def warmup_worker(**kwargs):
+    """
+    Loads the heavy modules and the embedding model in the worker's parent
+    process, before the prefork pool forks, so the pool processes share them.
+    Indices are not preloaded: workers do not serve queries.
+    """
+    from django.conf import settings
+
+    if not settings.WARMUP_ENABLED:
+        return
+    from query_app.warmup import warmup
+
+    try:
+        warmup(indices=0)
+    except Exception as e:
+        # The first task loads what is missing instead
+        logger.warning(f"Warmup failed: {str(e)}")
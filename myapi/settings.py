@@ -1,17 +1,143 @@
+import json
 import os
+import tempfile
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # Define paths for temporary files and FAISS indices
 TEMP_PDFS_DIR = os.path.join(BASE_DIR, 'temp_pdfs')
 FAISS_INDICES_DIR = os.path.join(BASE_DIR, 'faiss_indices')
+FAISS_MERGED_INDICES_DIR = os.path.join(FAISS_INDICES_DIR, 'merged')  # One index per client covering all of its PDFs
+
+# FAISS index type by corpus size: flat up to FAISS_FLAT_MAX_VECTORS, then
+# FAISS_MEDIUM_INDEX_TYPE ('hnsw' or 'ivf_flat') up to FAISS_MEDIUM_MAX_VECTORS, then 'ivf_pq'
+FAISS_FLAT_MAX_VECTORS = int(os.getenv('FAISS_FLAT_MAX_VECTORS', 20000))
+FAISS_MEDIUM_MAX_VECTORS = int(os.getenv('FAISS_MEDIUM_MAX_VECTORS', 500000))
+FAISS_MEDIUM_INDEX_TYPE = os.getenv('FAISS_MEDIUM_INDEX_TYPE', 'hnsw')
+FAISS_HNSW_M = int(os.getenv('FAISS_HNSW_M', 32))
+FAISS_DEFAULT_NPROBE = int(os.getenv('FAISS_DEFAULT_NPROBE', 16))  # IVF lists probed per query (overridable per request)
+FAISS_DEFAULT_EF_SEARCH = int(os.getenv('FAISS_DEFAULT_EF_SEARCH', 64))  # HNSW candidate list size (overridable per request)
 
 # Ensure directories exist
 os.makedirs(TEMP_PDFS_DIR, exist_ok=True)
 os.makedirs(FAISS_INDICES_DIR, exist_ok=True)
 
+# Large multipart uploads spool to TEMP_PDFS_DIR so they can be moved into place instead of copied
+FILE_UPLOAD_TEMP_DIR = TEMP_PDFS_DIR
+
+# Chunked, resumable uploads (/api/uploads/)
+UPLOAD_MAX_FILE_SIZE = int(os.getenv('UPLOAD_MAX_FILE_SIZE', 512 * 1024 * 1024))
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv('UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24))  # Unfinished uploads older than this are removed
+
+# Page size of /api/documents/<id>/vectors/ (rows per response)
+VECTORS_PAGE_DEFAULT_ROWS = int(os.getenv('VECTORS_PAGE_DEFAULT_ROWS', 1000))
+VECTORS_PAGE_MAX_ROWS = int(os.getenv('VECTORS_PAGE_MAX_ROWS', 10000))
+
+# Upper bound (in bytes) for the per-process cache of loaded FAISS indices
+FAISS_INDEX_CACHE_MAX_BYTES = int(os.getenv('FAISS_INDEX_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Embedding model shared by the query and ingest paths
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))  # Texts per forward pass during ingest
+EMBEDDING_QUERY_MAX_BATCH_SIZE = int(os.getenv('EMBEDDING_QUERY_MAX_BATCH_SIZE', 32))  # Concurrent queries per forward pass
+EMBEDDING_QUERY_MAX_WAIT_MS = float(os.getenv('EMBEDDING_QUERY_MAX_WAIT_MS', 5))  # Max time a query waits for a batch to fill
+EMBEDDING_INGEST_MAX_BATCH_TEXTS = int(os.getenv('EMBEDDING_INGEST_MAX_BATCH_TEXTS', 512))  # Chunks from concurrent PDFs per shared batch
+EMBEDDING_INGEST_MAX_WAIT_MS = float(os.getenv('EMBEDDING_INGEST_MAX_WAIT_MS', 50))  # Max time an embed task waits for other PDFs to join
+# Backend running the model: 'torch' (full precision), 'torch-int8' (dynamic-quantized, CPU)
+# or 'onnx-int8' (ONNX Runtime, int8; needs onnxruntime, plus torch and onnx once for the export)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', 0))  # CPU threads per forward pass for the int8 backends (0: library default)
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR', os.path.join(BASE_DIR, 'onnx_models'))  # ONNX exports, one directory per model
+
+# Persistent embedding cache keyed by model name and normalized text hash
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', os.path.join(BASE_DIR, 'embedding_cache'))
+EMBEDDING_CACHE_MAX_QUERY_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_QUERY_ENTRIES', 1024))  # Query vectors kept in memory per process (LRU); never written to disk
+
+# Warmup before forking workers (gunicorn --preload, Celery prefork): preload the heavy modules, the
+# embedding model and the indices of the WARMUP_INDEX_COUNT most recent PDFs (gunicorn only), so the
+# forked workers share their memory copy-on-write instead of each loading them on first use
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_EMBEDDING_MODEL = os.getenv('WARMUP_EMBEDDING_MODEL', 'true').lower() == 'true'
+WARMUP_INDEX_COUNT = int(os.getenv('WARMUP_INDEX_COUNT', 20))
+
+# Chat model used to answer queries and summarize conversations
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-3.5-turbo')
+# Prompt size: retrieved chunks are packed into CONTEXT_MAX_TOKENS (deduplicated, in document
+# order); the whole message list is trimmed (oldest history first) to LLM_PROMPT_MAX_TOKENS
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', 2000))
+LLM_PROMPT_MAX_TOKENS = int(os.getenv('LLM_PROMPT_MAX_TOKENS', 15000))  # gpt-3.5-turbo: 16k context minus the 512-token answer
+
+# Conversation history sent to the LLM: the newest HISTORY_KEEP_TURNS turns verbatim within
+# HISTORY_MAX_TOKENS; older turns are folded into a rolling summary by a background task
+HISTORY_KEEP_TURNS = int(os.getenv('HISTORY_KEEP_TURNS', 6))
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', 1500))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv('HISTORY_SUMMARY_MAX_TOKENS', 300))
+HISTORY_SUMMARY_BATCH_MESSAGES = int(os.getenv('HISTORY_SUMMARY_BATCH_MESSAGES', 40))
+HISTORY_SUMMARY_DEBOUNCE_SECONDS = int(os.getenv('HISTORY_SUMMARY_DEBOUNCE_SECONDS', 60))
+# 'deferred': the query views queue history rows for a background thread that inserts them in batches
+# of up to HISTORY_WRITE_BATCH_SIZE (query_app.history_writer); 'sync': each row is written in the request
+HISTORY_WRITE_MODE = os.getenv('HISTORY_WRITE_MODE', 'deferred')
+HISTORY_WRITE_BATCH_SIZE = int(os.getenv('HISTORY_WRITE_BATCH_SIZE', 500))
+
+# Semantic answer cache (per process): reuse an answer when a query is this similar
+# (cosine) to a cached one and retrieval returned the same chunks
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv('ANSWER_CACHE_SIMILARITY_THRESHOLD', 0.95))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv('ANSWER_CACHE_TTL_SECONDS', 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 10000))
+
+# Hybrid retrieval: vector and BM25 keyword results fused with reciprocal rank fusion.
+# k, candidates, the two weights and rerank can be overridden per request.
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', 3))  # Chunks passed to the LLM
+RETRIEVAL_MAX_K = int(os.getenv('RETRIEVAL_MAX_K', 20))
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', 20))  # Chunks taken from each retriever (and reranked)
+RETRIEVAL_MAX_CANDIDATES = int(os.getenv('RETRIEVAL_MAX_CANDIDATES', 100))
+RETRIEVAL_VECTOR_WEIGHT = float(os.getenv('RETRIEVAL_VECTOR_WEIGHT', 1.0))
+RETRIEVAL_KEYWORD_WEIGHT = float(os.getenv('RETRIEVAL_KEYWORD_WEIGHT', 1.0))
+RETRIEVAL_RRF_K = int(os.getenv('RETRIEVAL_RRF_K', 60))
+RERANK_ENABLED = os.getenv('RERANK_ENABLED', 'false').lower() == 'true'  # Cross-encoder rerank by default
+RERANK_MODEL_NAME = os.getenv('RERANK_MODEL_NAME', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+
+# Threads used by the async query endpoint for embedding and FAISS search
+QUERY_THREAD_POOL_SIZE = int(os.getenv('QUERY_THREAD_POOL_SIZE', os.cpu_count() or 1))
+
+# PDF text extraction: documents with at least this many pages are extracted in a process pool
+# (not available in Celery prefork children, which are daemonic: the ingest_io worker uses --pool threads)
+PDF_PARALLEL_PAGE_THRESHOLD = int(os.getenv('PDF_PARALLEL_PAGE_THRESHOLD', 100))
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 25))
+
+# Metrics (/metrics, Prometheus text format): every API and Celery process writes its counters
+# and stage histograms to METRICS_DIR (share it between containers) and /metrics sums them
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'myapi_metrics'))
+METRICS_FLUSH_INTERVAL_SECONDS = float(os.getenv('METRICS_FLUSH_INTERVAL_SECONDS', 5))
+# A process file not refreshed for this long is from an exited process and is folded into cumulative.json
+METRICS_STALE_SECONDS = float(os.getenv('METRICS_STALE_SECONDS', 300))
+METRICS_AUTH_TOKEN = os.getenv('METRICS_AUTH_TOKEN', '')  # Bearer token required by /metrics when set
+# cProfile a share of synchronous requests, and any sending "X-Profile: 1" when the header is enabled
+METRICS_PROFILE_SAMPLE_RATE = float(os.getenv('METRICS_PROFILE_SAMPLE_RATE', 0.0))
+METRICS_PROFILE_HEADER_ENABLED = os.getenv('METRICS_PROFILE_HEADER_ENABLED', 'false').lower() == 'true'
+METRICS_PROFILE_DIR = os.getenv('METRICS_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# Where manage.py benchmark writes its JSON results
+BENCHMARK_RESULTS_DIR = os.getenv('BENCHMARK_RESULTS_DIR', os.path.join(BASE_DIR, 'benchmark_results'))
+
+# Chunking (uploadfile.chunking): 'structure' (sentences, new chunk per heading), 'tokens' (words)
+# or 'characters' (the original 550-character splitter). Token sizes are LLM tokens; keep
+# CHUNK_TOKENS below the embedding model's input limit (256 word pieces for MiniLM).
+CHUNKING_STRATEGY = os.getenv('CHUNKING_STRATEGY', 'structure')
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', 200))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', 20))
+# Per-client overrides as JSON, e.g. {"42": {"strategy": "tokens", "chunk_tokens": 120}}
+CHUNKING_CLIENT_OVERRIDES = json.loads(os.getenv('CHUNKING_CLIENT_OVERRIDES', '{}'))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
@@ -19,9 +145,9 @@ os.makedirs(FAISS_INDICES_DIR, exist_ok=True)
 SECRET_KEY = 'django-insecure-(6ixw$$a*e4u9bjhiu1mlshjzwy)0+ao9hcm-9*)#*$b!275t+'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.getenv('DJANGO_DEBUG', 'false').lower() == 'true'  # DJANGO_DEBUG=true for development
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.getenv('DJANGO_ALLOWED_HOSTS', 'localhost,127.0.0.1,[::1]').split(',') if host]
 
 # Application definition
 
@@ -39,6 +165,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'query_app.metrics.MetricsMiddleware',  # First, so request timings cover the other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,12 +198,54 @@ WSGI_APPLICATION = 'myapi.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),  # Use os.path.join
+# DB_ENGINE 'sqlite' (default; DB_NAME is the file) or 'postgres' (DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT;
+# needs psycopg). Connections are kept open for DB_CONN_MAX_AGE seconds and checked before reuse. On Postgres,
+# DB_POOL_MAX_SIZE > 0 keeps a connection pool per process instead (use it with uvicorn workers, where
+# persistent connections pile up in the async-to-sync threads). SQLite runs in WAL mode so readers do not
+# block the writer, and writers wait up to DB_SQLITE_TIMEOUT_SECONDS for the lock instead of failing.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60))
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 0))  # 0: no pool; else at least threads per worker + 1 (history writer)
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_TIMEOUT_SECONDS', 10))  # Wait for a free pooled connection
+DB_SQLITE_TIMEOUT_SECONDS = float(os.getenv('DB_SQLITE_TIMEOUT_SECONDS', 20))
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'myapi'),
+            'USER': os.getenv('DB_USER', 'myapi'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if DB_POOL_MAX_SIZE else DB_CONN_MAX_AGE,  # Django's pool replaces persistent connections
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': min(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+                    'max_size': DB_POOL_MAX_SIZE,
+                    'timeout': DB_POOL_TIMEOUT_SECONDS,
+                },
+            } if DB_POOL_MAX_SIZE else {},
+        }
     }
-}
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),  # Use os.path.join
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': DB_SQLITE_TIMEOUT_SECONDS,
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'transaction_mode': 'IMMEDIATE',  # Take the write lock at BEGIN, so a transaction never fails to upgrade
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DB_ENGINE {DB_ENGINE!r}: use 'sqlite' or 'postgres'")
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -126,10 +295,57 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Serving (entrypoint.sh, gunicorn.conf.py). SERVER is 'gunicorn' (production) or 'runserver'
+# (development). SERVER_WORKER_CLASS 'gthread' serves the WSGI app with SERVER_THREADS threads per
+# worker; 'uvicorn' serves the ASGI app, where the async /query/stream/ holds no thread per stream
+# (sync views are then run one at a time per worker, so keep /query/ on gthread workers)
+SERVER = os.getenv('SERVER', 'gunicorn')
+SERVER_BIND = os.getenv('SERVER_BIND', '0.0.0.0:8000')
+SERVER_WORKER_CLASS = os.getenv('SERVER_WORKER_CLASS', 'gthread')
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 0))  # 0: one per CPU (each holds the embedding model's activations)
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', 8))  # Per gthread worker; LLM streams hold a thread each
+SERVER_TIMEOUT_SECONDS = int(os.getenv('SERVER_TIMEOUT_SECONDS', 120))  # A worker silent this long is restarted
+SERVER_KEEPALIVE_SECONDS = int(os.getenv('SERVER_KEEPALIVE_SECONDS', 5))
+SERVER_MAX_REQUESTS = int(os.getenv('SERVER_MAX_REQUESTS', 5000))  # Requests before a worker is replaced (0: never)
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv('SERVER_MAX_REQUESTS_JITTER', 500))
+
 # Celery settings
 CELERY_BROKER_URL = 'redis://redis:6379/0'  # Use 'redis' as the hostname
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'  # Use 'redis' as the hostname
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'UTC'
\ No newline at end of file
+CELERY_TIMEZONE = 'UTC'
+
+# Worker tuning for model-heavy, long tasks: take one task at a time (no prefetched backlog stuck
+# behind a long PDF) and replace prefork children after CELERY_WORKER_MAX_TASKS_PER_CHILD tasks or
+# once their RSS passes CELERY_WORKER_MAX_MEMORY_PER_CHILD (KB), checked after each task. Children are
+# forked from the warmed-up parent, so a replacement starts with the model already loaded.
+# Set per worker through the environment; the thread pool ignores the two per-child limits.
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', 1))
+CELERY_WORKER_MAX_TASKS_PER_CHILD = int(os.getenv('CELERY_WORKER_MAX_TASKS_PER_CHILD', 100)) or None
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = int(os.getenv('CELERY_WORKER_MAX_MEMORY_PER_CHILD', 2 * 1024 * 1024)) or None
+CELERY_WORKER_CONCURRENCY = int(os.getenv('CELERY_WORKER_CONCURRENCY', 0)) or None  # None: one per CPU
+
+# Ingest runs as a chain of stages on separate queues (see uploadfile.tasks.start_pdf_ingest),
+# so extraction, embedding and index merging scale on their own worker pools.
+# With INGEST_PIPELINE_ENABLED off, a single process_pdf_task runs every step.
+INGEST_PIPELINE_ENABLED = os.getenv('INGEST_PIPELINE_ENABLED', 'true').lower() == 'true'
+INGEST_PROGRESS_MIN_INTERVAL_SECONDS = float(os.getenv('INGEST_PROGRESS_MIN_INTERVAL_SECONDS', 1))  # Throttle for progress writes to the result backend
+STATUS_BATCH_MAX_TASKS = int(os.getenv('STATUS_BATCH_MAX_TASKS', 100))  # Task ids per batched status lookup or stream
+STATUS_STREAM_POLL_SECONDS = float(os.getenv('STATUS_STREAM_POLL_SECONDS', 1))  # Result backend reads per stream
+STATUS_STREAM_MAX_SECONDS = float(os.getenv('STATUS_STREAM_MAX_SECONDS', 300))  # Streams end after this; clients reconnect
+# Housekeeping (conversation summaries, expiring uploads) has its own queue so it never waits behind ingest
+CELERY_TASK_DEFAULT_QUEUE = 'housekeeping'
+CELERY_TASK_ROUTES = {
+    'uploadfile.tasks.process_pdf_task': {'queue': 'ingest_embed'},  # Single-task ingest (pipeline off) embeds too
+    'uploadfile.tasks.extract_pdf_task': {'queue': 'ingest_io'},
+    'uploadfile.tasks.embed_chunks_task': {'queue': 'ingest_embed'},
+    'uploadfile.tasks.index_chunks_task': {'queue': 'ingest_index'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'expire-upload-sessions': {
+        'task': 'uploadfile.tasks.expire_upload_sessions_task',
+        'schedule': 3600.0,  # Hourly
+    },
+}
@@ -18,10 +18,12 @@ from django.contrib import admin
 from django.urls import path,include
 
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from query_app.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/',include('uploadfile.urls')),
     path('query/', include('query_app.urls')),
+    path('metrics', metrics, name='metrics'),  # Prometheus scrape endpoint
   
 ]
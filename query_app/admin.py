@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import PDFDocument, ConversationHistory  # Import the correct models
+from .models import PDFDocument, ConversationHistory, ConversationSummary  # Import the correct models
 
 # Register the PDFDocument model
 @admin.register(PDFDocument)
@@ -13,4 +13,10 @@ class PDFDocumentAdmin(admin.ModelAdmin):
 class ConversationHistoryAdmin(admin.ModelAdmin):
     list_display = ('session_id', 'role', 'timestamp')
     search_fields = ('session_id', 'role', 'content')
-    list_filter = ('role', 'timestamp')
\ No newline at end of file
+    list_filter = ('role', 'timestamp')
+
+# Register the ConversationSummary model
+@admin.register(ConversationSummary)
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ('session_id', 'summarized_through', 'updated_at')
+    search_fields = ('session_id',)
\ No newline at end of file
@@ -0,0 +1,132 @@
+# ann_index.py
+import math
+
+import faiss
+import numpy as np
+from django.conf import settings
+
+INDEX_FLAT = "flat"
+INDEX_HNSW = "hnsw"
+INDEX_IVF_FLAT = "ivf_flat"
+INDEX_IVF_PQ = "ivf_pq"
+INDEX_TYPES = (INDEX_FLAT, INDEX_HNSW, INDEX_IVF_FLAT, INDEX_IVF_PQ)
+
+
+def choose_index_type(num_vectors):
+    """
+    Picks the FAISS index type for a corpus of `num_vectors` chunks.
+
+    Small corpora use exact flat search, medium ones HNSW or IVF-Flat
+    (FAISS_MEDIUM_INDEX_TYPE), and large ones IVF-PQ, which also compresses
+    each vector to a few bytes.
+    """
+    if num_vectors <= settings.FAISS_FLAT_MAX_VECTORS:
+        return INDEX_FLAT
+    if num_vectors <= settings.FAISS_MEDIUM_MAX_VECTORS:
+        return settings.FAISS_MEDIUM_INDEX_TYPE
+    return INDEX_IVF_PQ
+
+
+def _ivf_nlist(num_vectors):
+    # ~4*sqrt(n) lists, but keep at least 39 training points per list
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _pq_subquantizers(dim):
+    # About 8 dimensions per sub-quantizer; PQ needs m to divide the dimension
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def build_index(vectors, index_type=None):
+    """
+    Builds and trains a FAISS index over `vectors` (positions are preserved).
+    Returns (index, index_type, params) where `params` records the build settings.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    num_vectors, dim = vectors.shape
+    index_type = index_type or choose_index_type(num_vectors)
+
+    if index_type == INDEX_FLAT:
+        index, params = faiss.IndexFlatL2(dim), {}
+    elif index_type == INDEX_HNSW:
+        index = faiss.IndexHNSWFlat(dim, settings.FAISS_HNSW_M)
+        index.hnsw.efSearch = settings.FAISS_DEFAULT_EF_SEARCH
+        params = {"m": settings.FAISS_HNSW_M}
+    elif index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = _ivf_nlist(num_vectors)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == INDEX_IVF_FLAT:
+            index, params = faiss.IndexIVFFlat(quantizer, dim, nlist), {"nlist": nlist}
+        else:
+            m = _pq_subquantizers(dim)
+            index, params = faiss.IndexIVFPQ(quantizer, dim, nlist, m, 8), {"nlist": nlist, "m": m, "nbits": 8}
+        index.train(vectors)
+        index.nprobe = settings.FAISS_DEFAULT_NPROBE
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+
+    index.add(vectors)
+    return index, index_type, params
+
+
+def can_extend(index_type, params, num_vectors):
+    """
+    Whether an index built by build_index can simply take more vectors, up to
+    `num_vectors` in total, instead of being rebuilt: the size tier is still
+    `index_type` and the build settings still apply. IVF lists are trained for
+    the corpus size, so they are kept while the list count build_index would
+    pick now is within a factor of two of the trained one.
+    """
+    if index_type != choose_index_type(num_vectors):
+        return False
+    if index_type == INDEX_HNSW:
+        return params.get("m") == settings.FAISS_HNSW_M
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = params.get("nlist")
+        return bool(nlist) and nlist / 2 <= _ivf_nlist(num_vectors) <= nlist * 2
+    return True
+
+
+def index_type_of(index):
+    """Returns the index type name of a FAISS index built by build_index."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return INDEX_IVF_PQ
+    if isinstance(index, faiss.IndexIVF):
+        return INDEX_IVF_FLAT
+    if isinstance(index, faiss.IndexHNSW):
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def search_parameters(index, nprobe=None, ef_search=None):
+    """
+    Returns per-call FAISS search parameters, or None to use the index defaults.
+
+    Passing parameters per call (instead of setting index.nprobe) keeps a
+    shared, cached index safe to search from concurrent requests.
+    """
+    index_type = index_type_of(index)
+    if nprobe and index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe))
+    if ef_search and index_type == INDEX_HNSW:
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search))
+    return None
+
+
+def search(index, query_vector, k, nprobe=None, ef_search=None):
+    """
+    Runs a top-k search on a FAISS index with optional nprobe/efSearch.
+    Returns a list of (position, distance) pairs, nearest first.
+    """
+    query = np.asarray([query_vector], dtype=np.float32)
+    params = search_parameters(index, nprobe=nprobe, ef_search=ef_search)
+    if params is None:
+        distances, positions = index.search(query, k)
+    else:
+        distances, positions = index.search(query, k, params=params)
+    # -1 marks missing results (fewer than k vectors, or nprobe too small)
+    return [(int(position), float(distance)) for distance, position in zip(distances[0], positions[0]) if position != -1]
@@ -0,0 +1,156 @@
+# answer_cache.py
+import bisect
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Bucket:
+    """Entries sharing a scope and chunk ids, oldest first, with their unit vectors stacked for one matrix product."""
+
+    def __init__(self):
+        self.ids, self.vectors, self.created = [], [], []
+        self._matrix = None
+
+    def add(self, entry_id, vector, created_at):
+        self.ids.append(entry_id)
+        self.vectors.append(vector)
+        self.created.append(created_at)
+        self._matrix = None
+
+    def remove(self, entry_id):
+        i = self.ids.index(entry_id)
+        del self.ids[i], self.vectors[i], self.created[i]
+        self._matrix = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.vstack(self.vectors)
+        return self._matrix
+
+
+class SemanticAnswerCache:
+    """
+    Per-process cache of LLM answers, matched by query meaning.
+
+    Entries are scoped to (client, index). A lookup hits when a cached query's
+    embedding is within `threshold` cosine similarity of the new query AND the
+    retrieval returned the same chunk ids, so a cached answer is only reused for
+    the same evidence. Entries are grouped by scope and chunk ids, so a lookup
+    only scores the entries with the same evidence, in one matrix product.
+    Entries expire after `ttl_seconds` and the least recently used entry is
+    evicted once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, threshold):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries = OrderedDict()  # entry id -> (bucket key, answer), least recently used first
+        self._buckets = {}  # (scope, chunk ids) -> _Bucket
+        self._scopes = {}  # scope -> set of bucket keys
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, scope, query_vector, chunk_ids):
+        """Returns the cached answer for a similar query with the same chunks, or None."""
+        query = self._unit(query_vector)
+        key = (scope, tuple(chunk_ids))
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                # Entries are kept oldest first, so the expired ones are a prefix
+                for entry_id in bucket.ids[:bisect.bisect_left(bucket.created, now - self.ttl_seconds)]:
+                    self._remove(entry_id)
+                bucket = self._buckets.get(key)
+
+            best_id = None
+            if bucket is not None:
+                scores = bucket.matrix() @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    best_id = bucket.ids[best]
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][1]
+
+    def put(self, scope, query_vector, chunk_ids, answer):
+        """Caches `answer` for the query, evicting the least recently used entry if full."""
+        if not answer:
+            return
+        key = (scope, tuple(chunk_ids))
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (key, answer)
+            if key not in self._buckets:
+                self._buckets[key] = _Bucket()
+                self._scopes.setdefault(scope, set()).add(key)
+            self._buckets[key].add(entry_id, self._unit(query_vector), time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, scope):
+        """Drops every cached answer for `scope` (e.g. after the index was rebuilt)."""
+        with self._lock:
+            for key in list(self._scopes.get(scope, ())):
+                for entry_id in list(self._buckets[key].ids):
+                    self._remove(entry_id)
+
+    def clear(self):
+        """Drops all cached answers and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._scopes.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Returns hit/miss counters and the number of cached answers."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def _remove(self, entry_id):
+        key = self._entries.pop(entry_id)[0]
+        bucket = self._buckets[key]
+        bucket.remove(entry_id)
+        if not bucket.ids:
+            del self._buckets[key]
+            scope_keys = self._scopes[key[0]]
+            scope_keys.discard(key)
+            if not scope_keys:
+                del self._scopes[key[0]]
+
+
+# Shared cache instance for this worker process
+answer_cache = SemanticAnswerCache(
+    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+    threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
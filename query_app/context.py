@@ -0,0 +1,96 @@
+# context.py
+from django.conf import settings
+
+from .tokens import count_tokens, message_tokens
+
+MIN_TEXT_OVERLAP = 20  # Shorter suffix/prefix matches between chunks are treated as coincidence
+MAX_TEXT_OVERLAP = 2000  # Longest overlap looked for between chunks without offsets
+
+
+def _text_overlap(previous, text):
+    """Length of the longest suffix of `previous` that is also a prefix of `text`."""
+    for size in range(min(len(previous), len(text), MAX_TEXT_OVERLAP), MIN_TEXT_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return size
+    return 0
+
+
+def _chunk_key(document, rank):
+    """Sort key placing chunks in document order: source, page, then offset (or retrieval rank)."""
+    metadata = document.metadata
+    start = metadata.get("start_index")
+    return (str(metadata.get("source", "")), metadata.get("page") or 0, start if start is not None else rank, rank)
+
+
+def pack_context(documents, max_tokens=None, pdf_name=None):
+    """
+    Builds the prompt context from retrieved chunks (Documents, best first).
+
+    Chunks are taken in relevance order while they fit in `max_tokens`
+    (default CONTEXT_MAX_TOKENS), skipping exact duplicates, then placed in
+    document order. Text a chunk shares with the chunk before it (chunk
+    overlap) is sent once: adjacent chunks are joined into a single passage,
+    using their offsets in the page when the chunker recorded them. Passages
+    from a merged index are prefixed with their source.
+
+    Returns (context, packed), where `packed` lists the Documents used, in
+    the order they appear in the context.
+    """
+    max_tokens = settings.CONTEXT_MAX_TOKENS if max_tokens is None else max_tokens
+    selected, seen = [], set()
+    for rank, document in enumerate(documents):
+        text = document.page_content
+        if not text.strip() or text in seen:
+            continue
+        cost = document.metadata.get("tokens") or count_tokens(text)
+        if cost > max_tokens:
+            continue  # A smaller, lower-ranked chunk may still fit
+        max_tokens -= cost
+        seen.add(text)
+        selected.append((_chunk_key(document, rank), document))
+    selected.sort(key=lambda pair: pair[0])
+
+    passages, packed = [], []  # passages: [source, page, text, end offset]
+    for _, document in selected:
+        metadata = document.metadata
+        source = metadata.get("source", pdf_name)
+        text, start = document.page_content, metadata.get("start_index")
+        previous = passages[-1] if passages and passages[-1][:2] == [source, metadata.get("page")] else None
+        if previous is not None:
+            if start is not None and previous[3] is not None and start <= previous[3]:
+                overlap = previous[3] - start
+            else:
+                overlap = _text_overlap(previous[2], text)
+            if overlap >= len(text):
+                continue  # Entirely contained in the passage already
+            if overlap:
+                previous[2] += text[overlap:]
+                previous[3] = start + len(text) if start is not None else None
+                packed.append(document)
+                continue
+        passages.append([source, metadata.get("page"), text, start + len(text) if start is not None else None])
+        packed.append(document)
+
+    if pdf_name:
+        context = "\n".join(passage[2] for passage in passages)
+    else:
+        context = "\n".join(f"[Source: {passage[0]}] {passage[2]}" for passage in passages)
+    return context, packed
+
+
+def fit_messages(messages, max_tokens=None):
+    """
+    Counts the prompt tokens of the whole message list and, while it exceeds
+    `max_tokens` (default LLM_PROMPT_MAX_TOKENS), drops the oldest history
+    messages (those between the leading system messages and the final user
+    message). Returns (messages, prompt_tokens).
+    """
+    max_tokens = settings.LLM_PROMPT_MAX_TOKENS if max_tokens is None else max_tokens
+    messages = list(messages)
+    costs = [message_tokens(message) for message in messages]
+    total = 3 + sum(costs)
+    first_history = next((i for i, message in enumerate(messages) if message["role"] != "system"), len(messages))
+    while total > max_tokens and first_history < len(messages) - 1:
+        total -= costs.pop(first_history)
+        messages.pop(first_history)
+    return messages, total
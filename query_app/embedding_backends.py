@@ -0,0 +1,175 @@
+# embedding_backends.py
+import fcntl
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_FILE = 'model_int8.onnx'
+ONNX_CONFIG_FILE = 'embedding_model.json'
+
+
+class TorchEmbeddings:
+    """The sentence-transformers model in full precision, through LangChain (the original path)."""
+
+    def __init__(self, model_name, batch_size=64, **options):
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self.model = HuggingFaceEmbeddings(model_name=model_name, encode_kwargs={"batch_size": batch_size})
+
+    def embed_documents(self, texts):
+        return self.model.embed_documents(list(texts))
+
+
+class QuantizedTorchEmbeddings:
+    """
+    The sentence-transformers model on CPU with its Linear layers dynamically
+    quantized to int8 (weights stored as int8, activations quantized per batch).
+    """
+
+    def __init__(self, model_name, batch_size=64, threads=0, **options):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        model = SentenceTransformer(model_name, device='cpu').eval()
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return self.model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False).tolist()
+
+
+class OnnxEmbeddings:
+    """
+    The model exported to ONNX, weights quantized to int8, run by ONNX Runtime.
+
+    Only onnxruntime and tokenizers are imported at run time, so a worker
+    serving this backend does not load torch. The export (which needs torch)
+    happens once per model, on first use or ahead of time with
+    `python manage.py export_embedding_model`. Texts are sorted by length and
+    each batch is padded only to its longest member, as sentence-transformers does.
+    """
+
+    def __init__(self, model_name, batch_size=64, threads=0, onnx_dir=None, **options):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        directory = onnx_model_dir(model_name, onnx_dir)
+        if not os.path.exists(os.path.join(directory, ONNX_CONFIG_FILE)):
+            export_onnx_model(model_name, directory)
+        with open(os.path.join(directory, ONNX_CONFIG_FILE)) as config_file:
+            config = json.load(config_file)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=config["pad_token_id"], pad_token=config["pad_token"])
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(directory, ONNX_MODEL_FILE), session_options, providers=['CPUExecutionProvider'],
+        )
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            encodings = self.tokenizer.encode_batch([texts[i] for i in batch])
+            features = {
+                "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+                "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+            }
+            embeddings = self.session.run(None, {name: features[name] for name in self.input_names})[0]
+            for i, vector in zip(batch, embeddings.tolist()):
+                vectors[i] = vector
+        return vectors
+
+
+BACKENDS = {
+    'torch': TorchEmbeddings,
+    'torch-int8': QuantizedTorchEmbeddings,
+    'onnx-int8': OnnxEmbeddings,
+}
+
+
+def load_backend(backend, model_name, batch_size=64, threads=0, onnx_dir=None):
+    """Loads `model_name` with the embedding backend named `backend` (a key of BACKENDS)."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    return BACKENDS[backend](model_name, batch_size=batch_size, threads=threads, onnx_dir=onnx_dir)
+
+
+def onnx_model_dir(model_name, onnx_dir=None):
+    """Directory holding the ONNX export of `model_name` (under EMBEDDING_ONNX_DIR by default)."""
+    if onnx_dir is None:
+        from django.conf import settings
+
+        onnx_dir = settings.EMBEDDING_ONNX_DIR
+    return os.path.join(onnx_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+
+
+def export_onnx_model(model_name, directory):
+    """
+    Exports a sentence-transformers model (transformer, pooling and
+    normalization) to `directory`: model.onnx, its int8 dynamic-quantized copy,
+    the tokenizer and the settings the ONNX backend needs. Requires torch, onnx
+    and onnxruntime. Concurrent exports of the same model wait for each other.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(directory, ONNX_CONFIG_FILE)):
+            return directory  # Exported by another process meanwhile
+
+        model = SentenceTransformer(model_name, device='cpu').eval()
+        features = model.tokenize(["An example sentence to trace the model with."])
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in features]
+
+        class SentenceEmbedding(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                return self.model(dict(zip(input_names, inputs)))["sentence_embedding"]
+
+        fp32_path = os.path.join(directory, 'model.onnx')
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["sentence_embedding"] = {0: "batch"}
+        with torch.no_grad():
+            torch.onnx.export(
+                SentenceEmbedding(), tuple(features[name] for name in input_names), fp32_path,
+                input_names=input_names, output_names=["sentence_embedding"], dynamic_axes=dynamic_axes, opset_version=14,
+            )
+        quantize_dynamic(fp32_path, os.path.join(directory, ONNX_MODEL_FILE), weight_type=QuantType.QInt8)
+
+        tokenizer = model.tokenizer
+        tokenizer.save_pretrained(directory)
+        config = {
+            "model_name": model_name,
+            "max_seq_length": model.max_seq_length,
+            "dimension": model.get_sentence_embedding_dimension(),
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+        }
+        # Written last: its presence marks a complete export
+        with open(os.path.join(directory, f"{ONNX_CONFIG_FILE}.tmp"), 'w') as config_file:
+            json.dump(config, config_file)
+        os.replace(os.path.join(directory, f"{ONNX_CONFIG_FILE}.tmp"), os.path.join(directory, ONNX_CONFIG_FILE))
+        logger.info(f"Exported {model_name} to ONNX (int8) in {directory}")
+    return directory
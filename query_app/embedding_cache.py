@@ -0,0 +1,183 @@
+# embedding_cache.py
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Collapses whitespace so formatting-only differences share a cache entry."""
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache shared by every process on the host.
+
+    Vectors are appended as raw float32 rows to `vectors.f32` and read back
+    through a read-only numpy memmap. A small SQLite table maps each key
+    (SHA-256 of the model name plus the normalized text) to its row. Appends
+    are serialized across processes with an exclusive file lock.
+
+    Only document (chunk) embeddings are written to disk, where they never
+    expire. Query embeddings (`queries=True`) are read from disk too, but
+    stored in a per-process LRU of at most `max_query_entries` vectors, since
+    free-text queries rarely repeat across users and would grow the files forever.
+    """
+
+    def __init__(self, directory, model_name, max_query_entries=1024):
+        self.model_name = model_name
+        self.directory = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.db_path = os.path.join(self.directory, 'keys.sqlite3')
+        self.lock_path = os.path.join(self.directory, '.lock')
+        self.dim = None
+        self._local = threading.local()
+        self._mmap = None
+        self._mmap_rows = 0
+        self._mmap_lock = threading.Lock()
+        self.max_query_entries = max_query_entries
+        self._queries = OrderedDict()  # key -> float32 vector, least recently used first
+        self._lock = threading.Lock()  # Guards the query LRU and the counters
+        self.hits = 0
+        self.misses = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._read_dim()
+
+    def _read_dim(self):
+        row = self._connection().execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row:
+            self.dim = int(row[0])
+
+    def key(self, text):
+        """Returns the cache key for `text` under this cache's model."""
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts, queries=False):
+        """Returns a list with the cached vector for each text, or None on a miss."""
+        keys = [self.key(text) for text in texts]
+        results = [None] * len(texts)
+        if queries:
+            with self._lock:
+                for i, key in enumerate(keys):
+                    if key in self._queries:
+                        self._queries.move_to_end(key)
+                        results[i] = self._queries[key].tolist()
+
+        rows = {}
+        if self.dim is None:
+            self._read_dim()  # Another process may have stored the first vectors since
+        if self.dim is not None:
+            with self._connection() as conn:
+                unique_keys = list({key for key, result in zip(keys, results) if result is None})
+                for start in range(0, len(unique_keys), 500):  # Stay under SQLite's bound-parameter limit
+                    batch = unique_keys[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows.update(conn.execute(f"SELECT key, row FROM embeddings WHERE key IN ({placeholders})", batch).fetchall())
+
+        if rows:
+            vectors = self._vectors(max(rows.values()) + 1)
+            for i, key in enumerate(keys):
+                if key in rows:
+                    results[i] = vectors[rows[key]].tolist()
+
+        hits = sum(result is not None for result in results)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(texts) - hits
+        return results
+
+    def put_many(self, texts, vectors, queries=False):
+        """Stores vectors for texts that are not cached yet (queries in memory, see the class docstring)."""
+        if not texts:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        keys = [self.key(text) for text in texts]
+        if queries:
+            with self._lock:
+                for key, vector in zip(keys, array):
+                    self._queries[key] = vector
+                    self._queries.move_to_end(key)
+                while len(self._queries) > self.max_query_entries:
+                    self._queries.popitem(last=False)
+            return
+
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with self._connection() as conn:
+                    if self.dim is None:
+                        conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(array.shape[1]),))
+                        self.dim = int(conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()[0])
+                    if array.shape[1] != self.dim:
+                        raise ValueError(f"Embedding dimension {array.shape[1]} does not match cache dimension {self.dim}")
+
+                    # Keep only the first occurrence of each key that is not already stored
+                    known = set()
+                    for start in range(0, len(keys), 500):
+                        batch = keys[start:start + 500]
+                        placeholders = ",".join("?" * len(batch))
+                        known.update(key for key, in conn.execute(f"SELECT key FROM embeddings WHERE key IN ({placeholders})", batch))
+                    new_positions = []
+                    for i, key in enumerate(keys):
+                        if key not in known:
+                            known.add(key)
+                            new_positions.append(i)
+                    if not new_positions:
+                        return
+
+                    # Rows go right after the last indexed row: a torn tail left by an interrupted
+                    # append (crash, full disk) is overwritten instead of shifting every later row
+                    first_row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchone()[0]
+                    with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'w+b') as vectors_file:
+                        vectors_file.seek(first_row * 4 * self.dim)
+                        vectors_file.truncate()
+                        vectors_file.write(np.ascontiguousarray(array[new_positions]).tobytes())
+                    conn.executemany(
+                        "INSERT INTO embeddings (key, row) VALUES (?, ?)",
+                        [(keys[i], first_row + offset) for offset, i in enumerate(new_positions)],
+                    )
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        """Returns hit/miss counters for this process."""
+        with self._lock:
+            hits, misses, query_entries = self.hits, self.misses, len(self._queries)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "query_entries": query_entries,
+        }
+
+    def _connection(self):
+        # SQLite connections cannot be shared across threads or a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _vectors(self, min_rows):
+        """Returns a memmap covering at least `min_rows` rows, remapping if the file grew."""
+        with self._mmap_lock:
+            if self._mmap is None or self._mmap_rows < min_rows:
+                rows = os.path.getsize(self.vectors_path) // (4 * self.dim)
+                self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+                self._mmap_rows = rows
+            return self._mmap
@@ -0,0 +1,248 @@
+# embeddings.py
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from .embedding_backends import load_backend
+from .embedding_cache import EmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+
+class _MicroBatcher:
+    """
+    Combines concurrent embedding requests into shared forward passes.
+
+    Each request is a list of texts. The first request in a batch waits at most
+    `max_wait` seconds for others to join, until the batch holds `max_texts`
+    texts, then the whole batch is embedded with one `embed` call and each
+    caller gets its own slice back.
+    """
+
+    def __init__(self, embed, max_texts, max_wait, name):
+        self.embed = embed
+        self.max_texts = max_texts
+        self.max_wait = max_wait
+        self.name = name
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+
+    def submit(self, texts):
+        """Embeds `texts` in a shared batch and returns their vectors."""
+        future = Future()
+        self._ensure_thread().put((texts, future))
+        return future.result()
+
+    def _ensure_thread(self):
+        # Threads do not survive fork, so a forked worker starts its own batcher
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._batch_loop, args=(self._queue,), name=self.name, daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _batch_loop(self, pending):
+        while True:
+            batch = [pending.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_texts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+
+            try:
+                vectors = self.embed([text for texts, _ in batch for text in texts])
+            except Exception as e:
+                logger.error(f"Error embedding batch of {size} texts ({self.name}): {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(batch)
+            self.texts += size
+            start = 0
+            for texts, future in batch:
+                future.set_result(vectors[start:start + len(texts)])
+                start += len(texts)
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    Process-wide embedding engine shared by the query and ingest paths.
+
+    The model is loaded lazily, once per process, with the embedding `backend`
+    (full-precision torch, int8 torch or int8 ONNX Runtime; see embedding_backends).
+    Concurrent `embed_query` calls are combined into micro-batches: the first
+    query in a batch waits at most `max_wait_ms` for others to join, up to
+    `max_batch_size` queries, and the batch is encoded in a single forward pass.
+    `embed_documents` hands the whole list to the model, which sorts the texts
+    by length and pads each batch of `batch_size` only to its longest member.
+    `embed_documents_batched` does the same across concurrent ingest calls
+    (e.g. several PDFs on a threaded embed worker), waiting at most
+    `ingest_max_wait_ms` for up to `ingest_max_texts` texts.
+    When a `cache` is given, texts already embedded (by any process) are served
+    from it and only the misses reach the model; query vectors are only kept in
+    the cache's bounded in-memory LRU.
+    """
+
+    def __init__(self, model_name, batch_size=64, max_batch_size=32, max_wait_ms=5, cache=None, ingest_max_texts=512, ingest_max_wait_ms=50,
+                 backend='torch', threads=0):
+        self.model_name = model_name
+        self.backend = backend
+        self.threads = threads
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._query_batcher = _MicroBatcher(self._embed_queries, max_batch_size, self.max_wait, "embedding-query-batcher")
+        self._ingest_batcher = _MicroBatcher(self.embed_documents, ingest_max_texts, ingest_max_wait_ms / 1000.0, "embedding-ingest-batcher")
+
+    def _get_model(self):
+        """Loads the embedding model on first use."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = load_backend(self.backend, self.model_name, batch_size=self.batch_size, threads=self.threads)
+                    logger.info(f"Loaded embedding model {self.model_name} ({self.backend}) in {time.perf_counter() - start:.2f}s (pid {os.getpid()})")
+        return self._model
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts (ingest path)."""
+        return self._embed(texts)
+
+    def _embed_queries(self, texts):
+        return self._embed(texts, queries=True)
+
+    def _embed(self, texts, queries=False):
+        texts = list(texts)
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._get_model().embed_documents(texts)
+
+        try:
+            vectors = self.cache.get_many(texts, queries=queries)
+        except Exception as e:
+            logger.warning(f"Embedding cache lookup failed, embedding without cache: {str(e)}")
+            return self._get_model().embed_documents(texts)
+
+        # Embed each distinct missing text once
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(self.cache.key(texts[i]), []).append(i)
+        if missing:
+            missing_texts = [texts[positions[0]] for positions in missing.values()]
+            computed = self._get_model().embed_documents(missing_texts)
+            for positions, vector in zip(missing.values(), computed):
+                for i in positions:
+                    vectors[i] = vector
+            try:
+                self.cache.put_many(missing_texts, computed, queries=queries)
+            except Exception as e:
+                logger.warning(f"Failed to store {len(missing_texts)} embeddings in cache: {str(e)}")
+        return vectors
+
+    def embed_documents_batched(self, texts):
+        """Embeds a list of texts, sharing forward passes with concurrent ingest calls."""
+        texts = list(texts)
+        if not texts or self._ingest_batcher.max_wait <= 0:
+            return self.embed_documents(texts)
+        return self._ingest_batcher.submit(texts)
+
+    def embed_query(self, text):
+        """Embeds a single query, sharing a forward pass with concurrent callers."""
+        if self.max_batch_size <= 1 or self.max_wait <= 0:
+            return self._embed_queries([text])[0]
+        return self._query_batcher.submit([text])[0]
+
+    def stats(self):
+        """Returns micro-batching and embedding cache counters."""
+        queries, query_batches = self._query_batcher.requests, self._query_batcher.batches
+        ingest = self._ingest_batcher
+        return {
+            "queries": queries,
+            "query_batches": query_batches,
+            "avg_query_batch_size": queries / query_batches if query_batches else 0.0,
+            "ingest_requests": ingest.requests,
+            "ingest_batches": ingest.batches,
+            "avg_ingest_batch_texts": ingest.texts / ingest.batches if ingest.batches else 0.0,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    Serves embeddings computed earlier (e.g. by the embed stage of the ingest
+    pipeline) by text, falling back to `fallback` for any text it does not hold.
+    """
+
+    def __init__(self, texts, vectors, fallback):
+        self._vectors = {text: list(map(float, vector)) for text, vector in zip(texts, vectors)}
+        self.fallback = fallback
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        missing = [text for text in texts if text not in self._vectors]
+        if missing:
+            self._vectors.update(zip(missing, self.fallback.embed_documents(missing)))
+        return [self._vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.fallback.embed_query(text)
+
+
+def cache_model_name():
+    """
+    Name the embedding cache is scoped to. Quantized backends return vectors
+    close to, not equal to, the full-precision ones, so each gets its own entries.
+    """
+    if settings.EMBEDDING_BACKEND == 'torch':
+        return settings.EMBEDDING_MODEL_NAME
+    return f"{settings.EMBEDDING_MODEL_NAME}@{settings.EMBEDDING_BACKEND}"
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_embedding_engine():
+    """Returns the embedding engine shared by every caller in this process."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = EmbeddingEngine(
+                    model_name=settings.EMBEDDING_MODEL_NAME,
+                    batch_size=settings.EMBEDDING_BATCH_SIZE,
+                    max_batch_size=settings.EMBEDDING_QUERY_MAX_BATCH_SIZE,
+                    max_wait_ms=settings.EMBEDDING_QUERY_MAX_WAIT_MS,
+                    ingest_max_texts=settings.EMBEDDING_INGEST_MAX_BATCH_TEXTS,
+                    ingest_max_wait_ms=settings.EMBEDDING_INGEST_MAX_WAIT_MS,
+                    backend=settings.EMBEDDING_BACKEND,
+                    threads=settings.EMBEDDING_THREADS,
+                    cache=EmbeddingCache(settings.EMBEDDING_CACHE_DIR, cache_model_name(), max_query_entries=settings.EMBEDDING_CACHE_MAX_QUERY_ENTRIES) if settings.EMBEDDING_CACHE_ENABLED else None,
+                )
+    return _engine
@@ -0,0 +1,83 @@
+# history.py
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ConversationHistory, ConversationSummary
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def format_user_prompt(query, context):
+    """Builds the prompt for the current user turn, with its retrieved context."""
+    return f"Context: {context}\n\nQuestion: {query}\n\nAnswer:"
+
+
+def history_window(session_id, after_id=0, limit=None, fields=('role', 'content')):
+    """
+    Cursor-based history fetch: the newest `limit` rows of a session with id > `after_id`,
+    newest first, reading only `fields`. Served by the (session_id, id) index, so the
+    cost depends on the window size, not on the length of the session.
+    """
+    rows = (
+        ConversationHistory.objects.filter(session_id=session_id, id__gt=after_id)
+        .order_by('-id')
+        .values_list(*fields)
+    )
+    return list(rows[:limit] if limit is not None else rows)
+
+
+def build_history_messages(session_id, max_tokens=None, keep_turns=None):
+    """
+    Returns the earlier turns of a session to send to the LLM, within a token budget.
+
+    The newest `keep_turns` turns not yet folded into the session summary are read
+    (and nothing older), then added newest-first until `max_tokens` is spent.
+    Past user turns contribute only their question, not the context that was
+    injected at the time. The rolling summary, if any, comes first as a system
+    message. When older unsummarized turns exist, a background summarization
+    task is scheduled to fold them into the summary.
+    """
+    max_tokens = settings.HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+    keep_turns = settings.HISTORY_KEEP_TURNS if keep_turns is None else keep_turns
+    window = keep_turns * 2  # One user and one assistant message per turn
+
+    summary = ConversationSummary.objects.filter(session_id=session_id).only('summary', 'summarized_through').first()
+    summarized_through = summary.summarized_through if summary else 0
+
+    # Fetch one row past the window to learn whether older turns still need summarizing
+    rows = history_window(session_id, after_id=summarized_through, limit=window + 1)
+    if len(rows) > window:
+        rows = rows[:window]
+        schedule_summarization(session_id)
+
+    messages = []
+    if summary and summary.summary:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary.summary}"}
+        max_tokens -= count_tokens(summary_message["content"])
+        messages.append(summary_message)
+
+    recent = []
+    for role, content in rows:  # Newest first
+        cost = count_tokens(content)
+        if cost > max_tokens:
+            break
+        max_tokens -= cost
+        recent.append({"role": role, "content": content})
+    messages.extend(reversed(recent))
+    return messages
+
+
+def schedule_summarization(session_id):
+    """Queues summarize_conversation_task at most once per session per HISTORY_SUMMARY_DEBOUNCE_SECONDS."""
+    if not cache.add(f"summarize-conversation:{session_id}", True, timeout=settings.HISTORY_SUMMARY_DEBOUNCE_SECONDS):
+        return
+    from .tasks import summarize_conversation_task
+
+    try:
+        summarize_conversation_task.delay(session_id)
+    except Exception as e:
+        # Summaries are an optimization; a broker outage must not fail the query
+        logger.warning(f"Could not schedule summarization for session {session_id}: {str(e)}")
@@ -0,0 +1,143 @@
+# history_writer.py
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, connections
+
+from .metrics import record_span, registry
+from .models import ConversationHistory
+
+logger = logging.getLogger(__name__)
+
+
+def _close_old_connections():
+    # Connections past CONN_MAX_AGE or broken are closed (a pooled one goes back to the pool);
+    # never the connection of a caller in the middle of a transaction
+    if not connection.in_atomic_block:
+        close_old_connections()
+
+
+class HistoryWriter:
+    """
+    Stores ConversationHistory rows for the query views.
+
+    With HISTORY_WRITE_MODE 'deferred' (the default), add() only queues the
+    row: a background thread of this process inserts the queued rows with one
+    bulk_create per batch of up to HISTORY_WRITE_BATCH_SIZE rows. Rows queued
+    while a batch is being written go into the next one, so the number of
+    writes (and of database write locks taken) stays flat as concurrent
+    streams grow, and a streamed answer never waits on the database.
+    Rows are written in the order they were added, so a session's user turn
+    always gets a lower id than its answer. A row becomes visible to later
+    requests once its batch is written, normally within milliseconds.
+
+    Rows still queued are written by close() (gunicorn's worker_exit) or at
+    exit; a forked child starts with an empty queue. With 'sync', add()
+    writes the row in the calling thread, inside the caller's transaction if
+    any.
+    """
+
+    def __init__(self, batch_size=None):
+        self._batch_size = batch_size
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._pending = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()  # Taking a batch and writing it is one step, which keeps rows in order
+        self._writer = None
+        self._closing = False
+
+    @property
+    def batch_size(self):
+        return self._batch_size or settings.HISTORY_WRITE_BATCH_SIZE
+
+    def add(self, session_id, role, content, context=""):
+        """Stores one message of a session (queued in 'deferred' mode)."""
+        row = ConversationHistory(session_id=session_id, role=role, content=content, context=context)
+        if settings.HISTORY_WRITE_MODE == 'sync':
+            row.save()
+            return
+        with self._condition:
+            self._pending.append(row)
+            self._condition.notify()
+        self._ensure_writer()
+
+    async def aadd(self, session_id, role, content, context=""):
+        """add() for async views: queuing does not block, a 'sync' write runs off the event loop."""
+        if settings.HISTORY_WRITE_MODE == 'sync':
+            await ConversationHistory.objects.acreate(session_id=session_id, role=role, content=content, context=context)
+            return
+        self.add(session_id, role, content, context)
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def flush(self):
+        """Writes every queued row from the calling thread, returning once they are stored."""
+        while self._write_batch():
+            pass
+
+    def close(self):
+        """Writes every queued row and stops the writer thread, closing its database connection."""
+        with self._condition:
+            writer, self._closing = self._writer, True
+            self._condition.notify()
+        if writer is not None:
+            writer.join()
+        with self._condition:
+            self._writer, self._closing = None, False
+        self.flush()  # Rows added while closing
+
+    def _write_batch(self):
+        with self._write_lock:
+            with self._condition:
+                rows = self._pending[:self.batch_size]
+                del self._pending[:len(rows)]
+            if not rows:
+                return False
+            started = time.perf_counter()
+            _close_old_connections()
+            try:
+                ConversationHistory.objects.bulk_create(rows)
+            except Exception as e:
+                # The connection may have dropped; a second attempt opens a new one
+                logger.warning(f"Could not write {len(rows)} history rows, retrying: {str(e)}")
+                _close_old_connections()
+                try:
+                    ConversationHistory.objects.bulk_create(rows)
+                except Exception as e:
+                    logger.error(f"Dropped {len(rows)} history rows: {str(e)}", exc_info=True)
+                    registry.inc("history_rows_dropped_total", len(rows))
+                    return True
+            finally:
+                _close_old_connections()
+            record_span("history.write", time.perf_counter() - started)
+            return True
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._condition:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+                    self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+            self._write_batch()
+        connections.close_all()
+
+
+history_writer = HistoryWriter()
@@ -0,0 +1,115 @@
+# index_cache.py
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _index_signature(index_path):
+    """
+    Returns (version, size_in_bytes) for a saved index directory.
+
+    The version is the directory the path resolves to (a new generation is
+    published by swapping a symlink, see index_store.index_generation) plus
+    the newest mtime of any file inside it, so an index rewritten in place by
+    an older writer still changes it.
+    """
+    real_path = os.path.realpath(index_path)
+    if os.path.isdir(real_path):
+        mtime, size = os.path.getmtime(real_path), 0
+        with os.scandir(real_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    mtime = max(mtime, stat.st_mtime)
+                    size += stat.st_size
+        return (real_path, mtime), size
+    stat = os.stat(real_path)  # Raises FileNotFoundError for missing indices
+    return (real_path, stat.st_mtime), stat.st_size
+
+
+class IndexCache:
+    """
+    Per-process LRU cache of loaded vector indices.
+
+    Entries are keyed by the index path plus its version, so an index rewritten by
+    another process (e.g. the Celery worker) is reloaded on the next lookup.
+    The cache is bounded by the on-disk size of the cached indices, which is a
+    close approximation of their in-memory footprint.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (version, size, index)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, index_path, loader):
+        """
+        Returns the cached index for `index_path`, calling `loader()` on a miss.
+        """
+        version, size = _index_signature(index_path)
+
+        with self._lock:
+            entry = self._entries.get(index_path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(index_path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # Load outside the lock so a slow load does not block hits on other indices
+        index = loader()
+
+        with self._lock:
+            self._entries[index_path] = (version, size, index)
+            self._entries.move_to_end(index_path)
+            self._evict()
+        logger.info(f"Loaded index into cache: {index_path} ({size} bytes)")
+        return index
+
+    def invalidate(self, index_path):
+        """Drops the cached entry for `index_path`, if any."""
+        with self._lock:
+            if self._entries.pop(index_path, None) is not None:
+                logger.info(f"Invalidated cached index: {index_path}")
+
+    def clear(self):
+        """Drops all cached entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the hit/miss counters and current cache occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes(),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _current_bytes(self):
+        return sum(size for _, size, _ in self._entries.values())
+
+    def _evict(self):
+        # Always keep the most recently used entry, even if it alone exceeds the budget
+        while len(self._entries) > 1 and self._current_bytes() > self.max_bytes:
+            evicted_path, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            logger.info(f"Evicted index from cache: {evicted_path}")
+
+
+# Shared cache instance for this worker process
+index_cache = IndexCache(max_bytes=settings.FAISS_INDEX_CACHE_MAX_BYTES)
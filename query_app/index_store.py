@@ -0,0 +1,149 @@
+# index_store.py
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+INDEX_FILE = 'index.faiss'  # Raw FAISS index (faiss.write_index)
+CHUNKS_FILE = 'chunks.bin'  # Concatenated UTF-8 JSON records {"id", "text", "metadata"}, one per index position
+CHUNK_OFFSETS_FILE = 'chunk_offsets.npy'  # int64 byte offsets; record i spans offsets[i]:offsets[i + 1]
+LEGACY_DOCSTORE_FILE = 'index.pkl'  # Pickled LangChain docstore written by FAISS.save_local
+
+
+STAGING_MAX_AGE_SECONDS = 3600  # Staging directories older than this were left by a crashed writer
+
+
+def _generation_path(index_path, kind, token):
+    return os.path.join(os.path.dirname(index_path), f".{os.path.basename(index_path)}.{kind}-{token}")
+
+
+@contextmanager
+def index_generation(index_path):
+    """
+    Yields a new, empty directory to write a complete index into; when the
+    block succeeds, it replaces `index_path` in one atomic step.
+
+    `index_path` is a symlink to the current generation, a hidden sibling
+    directory, and is swapped with os.replace. Files of a published generation
+    are never modified, so a process that has them memory-mapped (IndexStore,
+    SparseIndex in the index cache) or is loading them keeps reading one
+    consistent set. The previous generation is kept for readers that resolved
+    the link just before the swap; older ones are removed. An index directory
+    written before generations existed becomes the previous generation (it is
+    missing for the instant between the two renames).
+    """
+    parent = os.path.dirname(index_path)
+    os.makedirs(parent, exist_ok=True)
+    token = f"{time.time_ns():x}-{os.getpid()}"
+    staging = _generation_path(index_path, 'tmp', token)
+    os.makedirs(staging)
+    try:
+        yield staging
+        generation = _generation_path(index_path, 'gen', token)
+        os.rename(staging, generation)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    previous = os.readlink(index_path) if os.path.islink(index_path) else None
+    if previous is None and os.path.isdir(index_path):
+        previous = os.path.basename(_generation_path(index_path, 'gen', f"{token}-legacy"))
+        os.rename(index_path, os.path.join(parent, previous))
+    link = f"{generation}.link"
+    os.symlink(os.path.basename(generation), link)
+    os.replace(link, index_path)
+    _remove_old_generations(index_path, keep={os.path.basename(generation), previous})
+
+
+def _remove_old_generations(index_path, keep):
+    parent, name = os.path.split(index_path)
+    if os.path.islink(index_path):
+        keep = keep | {os.readlink(index_path)}  # A concurrent writer may have published meanwhile
+    pattern = re.compile(rf"\.{re.escape(name)}\.(gen|tmp)-[0-9a-f]+-\d+(-legacy)?")
+    now = time.time()
+    with os.scandir(parent) as entries:
+        for entry in entries:
+            match = pattern.fullmatch(entry.name)
+            if match is None or entry.name in keep:
+                continue
+            if match.group(1) == 'gen' or now - entry.stat(follow_symlinks=False).st_mtime > STAGING_MAX_AGE_SECONDS:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def write_index_store(index_path, index, documents):
+    """
+    Writes a FAISS index and its chunks (Documents with ids, in index position
+    order) in the native layout, into a new directory (see index_generation).
+    No pickle is involved.
+    """
+    import faiss
+
+    os.makedirs(index_path, exist_ok=True)
+    offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    with open(os.path.join(index_path, CHUNKS_FILE), 'wb') as chunks_file:
+        for position, document in enumerate(documents):
+            record = json.dumps({"id": document.id, "text": document.page_content, "metadata": document.metadata}, ensure_ascii=False)
+            offsets[position + 1] = offsets[position] + chunks_file.write(record.encode('utf-8'))
+    np.save(os.path.join(index_path, CHUNK_OFFSETS_FILE), offsets)
+    faiss.write_index(index, os.path.join(index_path, INDEX_FILE))
+
+
+def has_index_store(index_path):
+    """True if `index_path` holds an index in the native layout."""
+    return os.path.exists(os.path.join(index_path, CHUNK_OFFSETS_FILE))
+
+
+def read_chunk_ids(index_path):
+    """Returns the chunk ids of a saved index in position order, without loading the FAISS index."""
+    index_path = os.path.realpath(index_path)
+    offsets = np.load(os.path.join(index_path, CHUNK_OFFSETS_FILE))
+    with open(os.path.join(index_path, CHUNKS_FILE), 'rb') as chunks_file:
+        chunks = chunks_file.read()
+    return [json.loads(chunks[start:stop].decode('utf-8'))["id"] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+class IndexStore:
+    """
+    A saved index opened for search: the FAISS index in memory and the chunk
+    records memory-mapped, so loading costs the index itself and chunk text is
+    only read (and decoded) for the positions a query asks for.
+    """
+
+    def __init__(self, index, chunks, offsets):
+        self.index = index
+        self._chunks = chunks
+        self._offsets = offsets
+
+    @classmethod
+    def load(cls, index_path):
+        """Opens the index at `index_path`; raises FileNotFoundError if it is not in the native layout."""
+        import faiss
+
+        index_path = os.path.realpath(index_path)  # Every file from the same generation
+        offsets = np.load(os.path.join(index_path, CHUNK_OFFSETS_FILE), mmap_mode='r')
+        index = faiss.read_index(os.path.join(index_path, INDEX_FILE))
+        chunks = b''
+        if offsets[-1]:
+            with open(os.path.join(index_path, CHUNKS_FILE), 'rb') as chunks_file:
+                chunks = mmap.mmap(chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(index, chunks, offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def document(self, position):
+        """Returns the chunk at index `position` as a Document whose id is its chunk id."""
+        from langchain_core.documents import Document
+
+        start, stop = int(self._offsets[position]), int(self._offsets[position + 1])
+        record = json.loads(self._chunks[start:stop].decode('utf-8'))
+        return Document(id=record["id"], page_content=record["text"], metadata=record["metadata"])
+
+    def documents(self):
+        """Returns every chunk, in index position order."""
+        return [self.document(position) for position in range(len(self))]
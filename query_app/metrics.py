@@ -0,0 +1,335 @@
+# metrics.py
+import atexit
+import bisect
+import cProfile
+import fcntl
+import glob
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+DESCRIPTIONS = {
+    "span_duration_seconds": "Duration of an instrumented stage.",
+    "span_errors_total": "Instrumented stages that raised.",
+    "http_request_duration_seconds": "Time to build the response (streamed bodies excluded).",
+    "answer_cache_requests_total": "Semantic answer cache lookups by result.",
+    "ingest_documents_total": "PDF ingests by final status.",
+    "history_rows_dropped_total": "Conversation history rows whose deferred write failed twice.",
+}
+
+# Values of exited processes, folded together so the directory does not grow with every restart
+CUMULATIVE_FILE = "cumulative.json"
+
+
+class MetricsRegistry:
+    """
+    Counters and fixed-bucket histograms of one process, keyed by name and labels.
+
+    Each process writes its values to <directory>/<host>-<pid>-<start>.json at
+    most every `flush_interval` seconds (from a background thread) and at exit;
+    the host name and start time keep processes of different containers, and a
+    process reusing an old pid, apart. The /metrics endpoint sums the files of
+    every process, so API workers and Celery workers sharing the directory are
+    reported together. A file not refreshed for `stale_after` seconds belongs
+    to an exited process: collect() adds it to cumulative.json and removes it,
+    which keeps counters monotonic without one file per process ever started.
+    A forked child starts from zero, so nothing is counted twice.
+    """
+
+    def __init__(self, directory=None, flush_interval=None, stale_after=None):
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._stale_after = stale_after
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    @property
+    def directory(self):
+        return self._directory or settings.METRICS_DIR
+
+    @property
+    def stale_after(self):
+        return self._stale_after or settings.METRICS_STALE_SECONDS
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}-{self._started}.json")
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self._dirty = False
+        self._flusher = None
+        self._started = f"{time.time_ns():x}"
+        self._written = None  # Snapshot last written to this process's file
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Adds `value` to a counter."""
+        if not settings.METRICS_ENABLED:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+        self._ensure_flusher()
+
+    def observe(self, name, seconds, **labels):
+        """Records one observation in a latency histogram."""
+        if not settings.METRICS_ENABLED:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self._dirty = True
+        self._ensure_flusher()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()],
+            }
+
+    def flush(self):
+        """Writes this process's values to its file (atomically) if they changed, else marks the file as live."""
+        try:
+            path = self.path
+            if self._written is not None and not os.path.exists(path):
+                # Taken for an exited process's file and folded: those values are in cumulative.json now
+                self._subtract(self._written)
+                self._written = None
+            if not self._dirty:
+                if self._written is not None:
+                    os.utime(path)
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._dirty = False
+            snapshot = self.snapshot()
+            with open(f"{path}.tmp", 'w') as metrics_file:
+                json.dump(snapshot, metrics_file)
+            os.replace(f"{path}.tmp", path)
+            self._written = snapshot
+        except Exception as e:
+            # Metrics must never fail a request or a task
+            logger.warning(f"Could not write metrics: {str(e)}")
+
+    def _subtract(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                key = self._key(name, labels)
+                self._counters[key] = self._counters.get(key, 0) - value
+            for name, labels, values in snapshot["histograms"]:
+                histogram = self._histograms[self._key(name, labels)]
+                for i, value in enumerate(values):
+                    histogram[i] -= value
+            self._dirty = True
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        interval = self._flush_interval or settings.METRICS_FLUSH_INTERVAL_SECONDS
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def collect(self):
+        """Sums the values of every process writing to the directory (this one included)."""
+        self.flush()
+        try:
+            self._fold_stale_files()
+        except Exception as e:
+            logger.warning(f"Could not fold metrics of exited processes: {str(e)}")
+        return self._sum_files(glob.glob(os.path.join(self.directory, '*.json')))
+
+    def _fold_stale_files(self):
+        """Adds the files of processes that stopped refreshing them to cumulative.json and removes them."""
+        cumulative_path = os.path.join(self.directory, CUMULATIVE_FILE)
+        cutoff = time.time() - self.stale_after
+        stale = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                if path != cumulative_path and os.path.getmtime(path) < cutoff:
+                    stale.append(path)
+            except OSError:
+                continue  # Folded by another process meanwhile
+        if not stale:
+            return
+
+        with open(os.path.join(self.directory, "cumulative.lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # One process folds at a time, each reading the latest total
+            try:
+                stale = [path for path in stale if os.path.exists(path)]
+                counters, histograms = self._sum_files([cumulative_path] + stale)
+                snapshot = {
+                    "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+                    "histograms": [[name, dict(labels), values] for (name, labels), values in histograms.items()],
+                }
+                with open(f"{cumulative_path}.tmp", 'w') as metrics_file:
+                    json.dump(snapshot, metrics_file)
+                os.replace(f"{cumulative_path}.tmp", cumulative_path)
+                for path in stale:
+                    os.remove(path)
+                logger.info(f"Folded the metrics of {len(stale)} exited processes into {cumulative_path}")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sum_files(self, paths):
+        counters, histograms = {}, {}
+        for path in paths:
+            try:
+                with open(path) as metrics_file:
+                    data = json.load(metrics_file)
+            except (OSError, ValueError):
+                continue  # Being replaced right now; picked up on the next scrape
+            for name, labels, value in data.get("counters", []):
+                key = self._key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in data.get("histograms", []):
+                key = self._key(name, labels)
+                total = histograms.setdefault(key, [0] * len(values))
+                if len(total) != len(values):
+                    continue  # Written with different buckets by an older version
+                for i, value in enumerate(values):
+                    total[i] += value
+        return counters, histograms
+
+
+registry = MetricsRegistry()
+
+
+def record_span(name, seconds, **labels):
+    """Records the duration of a stage timed by the caller."""
+    registry.observe("span_duration_seconds", seconds, span=name, **labels)
+
+
+@contextmanager
+def span(name, **labels):
+    """Times the enclosed block as stage `name`; an exception is also counted in span_errors_total."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc("span_errors_total", span=name, **labels)
+        raise
+    finally:
+        record_span(name, time.perf_counter() - started, **labels)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus(counters, histograms):
+    """Formats collected values in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for kind, series in (("counter", counters), ("histogram", histograms)):
+        for name in sorted({name for name, _ in series}):
+            lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series_name, labels), values in sorted(series.items()):
+                if series_name != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {values}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Records http_request_duration_seconds per view, method and status, and
+    profiles a sample of synchronous requests with cProfile: a share
+    METRICS_PROFILE_SAMPLE_RATE of them, plus any request sending
+    "X-Profile: 1" when METRICS_PROFILE_HEADER_ENABLED is on. Profiles are
+    written to METRICS_PROFILE_DIR (open with pstats or snakeviz) and named in
+    the X-Profile-File response header.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, started):
+        match = request.resolver_match
+        registry.observe(
+            "http_request_duration_seconds", time.perf_counter() - started,
+            view=match.view_name if match else "unmatched", method=request.method, status=response.status_code,
+        )
+
+    def _should_profile(self, request):
+        if settings.METRICS_PROFILE_HEADER_ENABLED and request.headers.get('X-Profile') == '1':
+            return True
+        return settings.METRICS_PROFILE_SAMPLE_RATE > 0 and random.random() < settings.METRICS_PROFILE_SAMPLE_RATE
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        if not self._should_profile(request):
+            response = self.get_response(request)
+            self._record(request, response, started)
+            return response
+
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        self._record(request, response, started)
+        try:
+            os.makedirs(settings.METRICS_PROFILE_DIR, exist_ok=True)
+            view = request.resolver_match.view_name if request.resolver_match else "unmatched"
+            path = os.path.join(settings.METRICS_PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{view.replace(':', '.')}-{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            response["X-Profile-File"] = os.path.basename(path)
+            logger.info(f"Profiled {request.method} {request.path} to {path}")
+        except Exception as e:
+            logger.warning(f"Could not write profile: {str(e)}")
+        return response
+
+    async def __acall__(self, request):
+        # Async views interleave on the event loop, so they are timed but not profiled
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, started)
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_app', '0003_conversationhistory_pdfdocument_delete_chathistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='file_hash',
+            field=models.CharField(blank=True, default='', help_text='SHA-256 of the uploaded PDF file.', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_app', '0004_pdfdocument_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='index_type',
+            field=models.CharField(default='flat', help_text='FAISS index type (flat, hnsw, ivf_flat or ivf_pq).', max_length=20),
+        ),
+    ]
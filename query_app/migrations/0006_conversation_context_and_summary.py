@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_app', '0005_pdfdocument_index_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(help_text='Unique identifier for the user session.', max_length=100, unique=True)),
+                ('summary', models.TextField(blank=True, default='', help_text='Summary of the turns folded so far.')),
+                ('summarized_through', models.BigIntegerField(default=0, help_text='Id of the last ConversationHistory row folded into the summary.')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Timestamp of the last summary update.')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversationhistory',
+            name='context',
+            field=models.TextField(blank=True, default='', help_text='Retrieved context injected into this user turn (kept out of later prompts).'),
+        ),
+    ]
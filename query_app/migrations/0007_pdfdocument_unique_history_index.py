@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+def remove_duplicate_pdf_documents(apps, schema_editor):
+    """Keeps only the newest PDFDocument row per (client_id, pdf_name) so the constraint can be added."""
+    PDFDocument = apps.get_model('query_app', 'PDFDocument')
+    latest_ids = (
+        PDFDocument.objects.values('client_id', 'pdf_name')
+        .annotate(latest_id=models.Max('id'))
+        .values_list('latest_id', flat=True)
+    )
+    PDFDocument.objects.exclude(id__in=list(latest_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_app', '0006_conversation_context_and_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['session_id', 'id'], name='history_session_id_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_pdf_documents, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='pdfdocument',
+            constraint=models.UniqueConstraint(fields=('client_id', 'pdf_name'), name='unique_pdf_per_client'),
+        ),
+    ]
@@ -8,6 +8,14 @@ class PDFDocument(models.Model):
     client_id = models.CharField(max_length=100, help_text="Unique identifier for the client.")
     pdf_name = models.CharField(max_length=255, help_text="Name of the PDF file.")
     file_path = models.CharField(max_length=255, help_text="Path to the FAISS index file.")
+    file_hash = models.CharField(max_length=64, blank=True, default="", help_text="SHA-256 of the uploaded PDF file.")
+    index_type = models.CharField(max_length=20, default="flat", help_text="FAISS index type (flat, hnsw, ivf_flat or ivf_pq).")
+
+    class Meta:
+        constraints = [
+            # One row per client and PDF name; also serves client_id-only lookups as its leftmost prefix
+            models.UniqueConstraint(fields=['client_id', 'pdf_name'], name='unique_pdf_per_client'),
+        ]
 
     def __str__(self):
         return f"{self.client_id} - {self.pdf_name}"
@@ -19,7 +27,26 @@ class ConversationHistory(models.Model):
     session_id = models.CharField(max_length=100, help_text="Unique identifier for the user session.")
     role = models.CharField(max_length=50, help_text="Role of the message sender (user or assistant).")
     content = models.TextField(help_text="Content of the message.")
+    context = models.TextField(blank=True, default="", help_text="Retrieved context injected into this user turn (kept out of later prompts).")
     timestamp = models.DateTimeField(auto_now_add=True, help_text="Timestamp of the message.")
 
+    class Meta:
+        indexes = [
+            # Serves "newest N rows of a session after a cursor id" without scanning or sorting
+            models.Index(fields=['session_id', 'id'], name='history_session_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} - {self.role} - {self.timestamp}"
+
+class ConversationSummary(models.Model):
+    """
+    Model to store the rolling summary of the older turns of a session.
+    """
+    session_id = models.CharField(max_length=100, unique=True, help_text="Unique identifier for the user session.")
+    summary = models.TextField(blank=True, default="", help_text="Summary of the turns folded so far.")
+    summarized_through = models.BigIntegerField(default=0, help_text="Id of the last ConversationHistory row folded into the summary.")
+    updated_at = models.DateTimeField(auto_now=True, help_text="Timestamp of the last summary update.")
+
     def __str__(self):
-        return f"{self.session_id} - {self.role} - {self.timestamp}"
\ No newline at end of file
+        return f"{self.session_id} - summary through {self.summarized_through}"
\ No newline at end of file
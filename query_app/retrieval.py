@@ -0,0 +1,101 @@
+# retrieval.py
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .ann_index import search
+
+logger = logging.getLogger(__name__)
+
+
+def reciprocal_rank_fusion(rankings, weights, rrf_k=60):
+    """
+    Fuses ranked lists of ids with weighted reciprocal rank fusion: each id scores
+    sum(weight / (rrf_k + rank)) over the lists it appears in (rank is 1-based).
+    Returns the ids ordered by fused score, best first.
+    """
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        if not weight:
+            continue
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class CrossEncoderReranker:
+    """
+    Scores (query, chunk) pairs with a sentence-transformers cross-encoder on CPU.
+    The model is loaded lazily, once per process.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+
+                    start = time.perf_counter()
+                    self._model = CrossEncoder(self.model_name, device='cpu')
+                    logger.info(f"Loaded reranker {self.model_name} in {time.perf_counter() - start:.2f}s (pid {os.getpid()})")
+        return self._model
+
+    def rerank(self, query, documents, k):
+        """Returns the `k` documents the cross-encoder scores highest for `query`."""
+        if not documents:
+            return []
+        scores = self._get_model().predict([(query, document.page_content) for document in documents])
+        ranked = sorted(zip(scores, range(len(documents))), key=lambda pair: pair[0], reverse=True)
+        return [documents[i] for _, i in ranked[:k]]
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """Returns the cross-encoder reranker shared by every caller in this process."""
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker(settings.RERANK_MODEL_NAME)
+    return _reranker
+
+
+def hybrid_search(store, sparse_index, query, query_vector, k, candidates,
+                  vector_weight=1.0, keyword_weight=1.0, rerank=False, nprobe=None, ef_search=None):
+    """
+    Returns the top-`k` chunks (Documents with ids) of an IndexStore for a query.
+
+    The vector index and, when available, the BM25 keyword index each return
+    `candidates` positions; the two lists are fused with weighted reciprocal
+    rank fusion. With `rerank`, the fused top `candidates` are reordered by the
+    cross-encoder before the top `k` are taken. A retriever whose weight is 0
+    is skipped. Chunk text is only read for the positions returned (or reranked).
+    """
+    pool = max(k, candidates)
+    rankings, weights = [], []
+
+    if vector_weight or sparse_index is None:
+        rankings.append([position for position, _ in search(store.index, query_vector, k=pool, nprobe=nprobe, ef_search=ef_search)])
+        weights.append(vector_weight or 1.0)
+
+    if keyword_weight and sparse_index is not None:
+        rankings.append([position for position, _ in sparse_index.search(query, pool) if position < len(store)])
+        weights.append(keyword_weight)
+
+    fused = reciprocal_rank_fusion(rankings, weights, rrf_k=settings.RETRIEVAL_RRF_K)[:pool if rerank else k]
+    results = [store.document(position) for position in fused]
+
+    if rerank:
+        results = get_reranker().rerank(query, results, k)
+    return results
@@ -0,0 +1,162 @@
+# sparse_index.py
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+SPARSE_DIR = 'sparse'  # Subdirectory of a saved FAISS index holding its keyword index
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words, optionally joined by - . / _ so part numbers ("AB-1234") and clause ids ("12.3.4") stay whole
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+_PART_RE = re.compile(r"[^\W_]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+
+def tokenize(text):
+    """
+    Lowercased keyword tokens of `text`. Compound tokens such as "ab-1234" are
+    kept whole and also contribute their parts ("ab", "1234"), so both exact
+    identifiers and their pieces match. Common English stopwords are dropped.
+    """
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token not in _STOPWORDS:
+            tokens.append(token)
+        if not token.isalnum():  # Only compound tokens have parts
+            tokens.extend(part for part in _PART_RE.findall(token) if part not in _STOPWORDS)
+    return tokens
+
+
+def _term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def build_sparse_index(texts, index_path):
+    """
+    Builds a BM25 index over `texts` (text i is index position i) and writes it
+    to <index_path>/sparse/.
+
+    Terms are stored as sorted 64-bit hashes with CSR-style postings (document
+    positions and term frequencies) and a per-document length normalization,
+    all as .npy files that SparseIndex memory-maps.
+    """
+    vocab = {}
+    term_ids, positions, frequencies = [], [], []
+    lengths = np.zeros(len(texts), dtype=np.float32)
+    for position, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        lengths[position] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            positions.append(position)
+            frequencies.append(tf)
+
+    # Group postings by term hash (then position) with one sort
+    term_hashes = np.fromiter((_term_hash(term) for term in vocab), dtype=np.uint64, count=len(vocab))
+    posting_hashes = term_hashes[np.asarray(term_ids, dtype=np.int64)]
+    positions = np.asarray(positions, dtype=np.uint32)
+    order = np.lexsort((positions, posting_hashes))
+    terms, counts = np.unique(posting_hashes[order], return_counts=True)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    docs = positions[order]
+    tfs = np.minimum(np.asarray(frequencies, dtype=np.int64), 65535).astype(np.uint16)[order]
+
+    avgdl = float(lengths.mean()) if len(texts) else 0.0
+    norms = (BM25_K1 * (1 - BM25_B + BM25_B * lengths / avgdl) if avgdl else np.full(len(texts), BM25_K1)).astype(np.float32)
+
+    # Loaded SparseIndex objects keep the previous arrays memory-mapped, so nothing is rewritten in place:
+    # this build's arrays get new file names and meta.json, which names them, is replaced last
+    sparse_path = os.path.join(index_path, SPARSE_DIR)
+    os.makedirs(sparse_path, exist_ok=True)
+    previous = _read_meta(sparse_path)
+    generation = f"{time.time_ns():x}-{os.getpid()}"
+    files = {}
+    for name, array in (('terms', terms), ('offsets', offsets), ('docs', docs), ('tfs', tfs), ('norms', norms)):
+        files[name] = f'{name}-{generation}.npy'
+        np.save(os.path.join(sparse_path, files[name]), array)
+    meta = {"num_docs": len(texts), "num_terms": len(terms), "avgdl": avgdl, "k1": BM25_K1, "b": BM25_B, "files": files}
+    with open(os.path.join(sparse_path, f'meta.json.{generation}.tmp'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(os.path.join(sparse_path, f'meta.json.{generation}.tmp'), os.path.join(sparse_path, 'meta.json'))
+
+    # Keep the previous build's arrays for readers that have just read its meta.json; drop older ones
+    keep = {'meta.json'} | set(files.values()) | set(_array_files(previous).values())
+    for entry in os.listdir(sparse_path):
+        if entry.endswith('.npy') and entry not in keep:
+            os.remove(os.path.join(sparse_path, entry))
+
+
+def _read_meta(sparse_path):
+    try:
+        with open(os.path.join(sparse_path, 'meta.json')) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _array_files(meta):
+    """Array file names of a build; indices written before builds were versioned use fixed names."""
+    if meta is None:
+        return {}
+    return meta.get("files") or {name: f'{name}.npy' for name in ('terms', 'offsets', 'docs', 'tfs', 'norms')}
+
+
+class SparseIndex:
+    """
+    Memory-mapped BM25 index written by build_sparse_index.
+
+    A query touches only the postings of its own terms: each term is found by
+    binary search over the sorted term hashes and its postings are scored with
+    numpy, so lookups cost well under a millisecond per term for typical
+    chunk counts and the index adds almost nothing to resident memory.
+    """
+
+    def __init__(self, sparse_path):
+        with open(os.path.join(sparse_path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.num_docs = self.meta["num_docs"]
+        self.k1 = self.meta["k1"]
+        files = _array_files(self.meta)  # All from the build meta.json names, even if a newer one lands meanwhile
+        load = lambda name: np.load(os.path.join(sparse_path, files[name]), mmap_mode='r')
+        self.terms, self.offsets, self.docs, self.tfs, self.norms = (load(name) for name in ('terms', 'offsets', 'docs', 'tfs', 'norms'))
+
+    @classmethod
+    def load(cls, index_path):
+        """Returns the sparse index saved next to a FAISS index, or None if there is none."""
+        sparse_path = os.path.join(os.path.realpath(index_path), SPARSE_DIR)
+        if not os.path.exists(os.path.join(sparse_path, 'meta.json')):
+            return None
+        return cls(sparse_path)
+
+    def search(self, query, k):
+        """Returns up to `k` (position, score) pairs for `query`, best first."""
+        if not self.num_docs or not len(self.terms):
+            return []
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_hash = np.uint64(_term_hash(term))
+            i = int(np.searchsorted(self.terms, term_hash))
+            if i >= len(self.terms) or self.terms[i] != term_hash:
+                continue
+            start, stop = int(self.offsets[i]), int(self.offsets[i + 1])
+            df = stop - start
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            docs = np.asarray(self.docs[start:stop])
+            tfs = np.asarray(self.tfs[start:stop], dtype=np.float32)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind='stable')]
+        return [(int(position), float(scores[position])) for position in matched]
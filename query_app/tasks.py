@@ -0,0 +1,64 @@
+import os
+import logging
+from celery import shared_task
+from django.conf import settings
+from .models import ConversationHistory, ConversationSummary
+
+logger = logging.getLogger(__name__)
+
+@shared_task
+def summarize_conversation_task(session_id):
+    """
+    Celery task that folds the older turns of a session into its rolling summary.
+
+    Only turns newer than the current summary and older than the verbatim window
+    (HISTORY_KEEP_TURNS turns) are sent, together with the previous summary, so
+    each run costs the size of the new turns rather than the whole session.
+    """
+    try:
+        summary, _ = ConversationSummary.objects.get_or_create(session_id=session_id)
+        window = settings.HISTORY_KEEP_TURNS * 2
+
+        # Fold the oldest unsummarized rows, leaving the newest `window` rows verbatim
+        pending = ConversationHistory.objects.filter(session_id=session_id, id__gt=summary.summarized_through)
+        if window:
+            window_ids = list(pending.order_by('-id').values_list('id', flat=True)[:window])
+            pending = pending.filter(id__lt=window_ids[-1]) if len(window_ids) == window else pending.none()
+        to_fold = list(pending.order_by('id').values_list('id', 'role', 'content')[:settings.HISTORY_SUMMARY_BATCH_MESSAGES])
+        if not to_fold:
+            return {"status": "success", "session_id": session_id, "folded": 0}
+
+        openai_api_key = os.getenv("OPENAI_API_KEY")
+        if not openai_api_key:
+            raise ValueError("OpenAI API key not found.")
+        import openai  # Imported on first use, so workers that never summarize do not load it
+
+        openai.api_key = openai_api_key
+
+        transcript = "\n".join(f"{role}: {content}" for _, role, content in to_fold)
+        response = openai.chat.completions.create(
+            model=settings.LLM_MODEL,
+            messages=[
+                {"role": "system", "content": "You maintain a concise running summary of a conversation about documents. Keep facts, names, numbers and open questions."},
+                {"role": "user", "content": f"Current summary:\n{summary.summary or '(empty)'}\n\nNew turns:\n{transcript}\n\nReturn the updated summary."},
+            ],
+            max_tokens=settings.HISTORY_SUMMARY_MAX_TOKENS,
+            temperature=0,
+        )
+
+        summary.summary = response.choices[0].message.content.strip()
+        summary.summarized_through = to_fold[-1][0]
+        summary.save(update_fields=['summary', 'summarized_through', 'updated_at'])
+        logger.info(f"Folded {len(to_fold)} messages into the summary of session {session_id}")
+
+        # A full batch means older turns may still be pending; continue in a new task
+        if len(to_fold) == settings.HISTORY_SUMMARY_BATCH_MESSAGES:
+            summarize_conversation_task.delay(session_id)
+        return {"status": "success", "session_id": session_id, "folded": len(to_fold)}
+
+    except Exception as e:
+        logger.error(f"Error summarizing session {session_id}: {str(e)}")
+        return {
+            "status": "error",
+            "error": str(e)
+        }
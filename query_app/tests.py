@@ -1,3 +1,937 @@
-from django.test import TestCase
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import json
+import gc
+import importlib.util
+import subprocess
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
+import numpy as np
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.authtoken.models import Token
+from langchain.docstore.document import Document
+from query_app.index_cache import IndexCache
+from query_app.embeddings import EmbeddingEngine, cache_model_name
+from query_app.embedding_backends import load_backend
+from query_app.embedding_cache import EmbeddingCache
+from query_app.ann_index import build_index, choose_index_type, index_type_of, search
+from query_app.index_store import IndexStore, index_generation, write_index_store
+from query_app.context import fit_messages, pack_context
+from query_app.tokens import count_message_tokens
+from query_app.metrics import CUMULATIVE_FILE, MetricsRegistry, render_prometheus, span
+from query_app.warmup import warmup
+from query_app.models import PDFDocument, ConversationHistory, ConversationSummary
+from query_app.history import build_history_messages, history_window
+from query_app.history_writer import HistoryWriter
+from query_app.tasks import summarize_conversation_task
+from query_app.answer_cache import SemanticAnswerCache, answer_cache
+from query_app.sparse_index import SparseIndex, build_sparse_index, tokenize
+from query_app.retrieval import hybrid_search, reciprocal_rank_fusion
 
-# Create your tests here.
+
+class TestIndexCache(TestCase):
+    def setUp(self):
+        # Create a temporary directory holding fake index directories
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def _make_index(self, name, size=10):
+        index_path = os.path.join(self.base_dir, name)
+        os.makedirs(index_path, exist_ok=True)
+        with open(os.path.join(index_path, "index.faiss"), "wb") as f:
+            f.write(b"x" * size)
+        return index_path
+
+    def test_hit_after_first_load(self):
+        """Test that a second lookup of an unchanged index is served from the cache."""
+        cache = IndexCache(max_bytes=1000)
+        index_path = self._make_index("a.pdf")
+        loads = []
+
+        first = cache.get(index_path, lambda: loads.append(1) or object())
+        second = cache.get(index_path, lambda: loads.append(1) or object())
+
+        self.assertIs(first, second)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_reload_when_index_rewritten(self):
+        """Test that rewriting the index on disk invalidates the cached copy."""
+        cache = IndexCache(max_bytes=1000)
+        index_path = self._make_index("a.pdf")
+        first = cache.get(index_path, object)
+
+        # Bump the mtime as a rewrite by the Celery worker would
+        future = time.time() + 10
+        os.utime(os.path.join(index_path, "index.faiss"), (future, future))
+        second = cache.get(index_path, object)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_explicit_invalidate(self):
+        """Test that invalidate() forces a reload."""
+        cache = IndexCache(max_bytes=1000)
+        index_path = self._make_index("a.pdf")
+        first = cache.get(index_path, object)
+        cache.invalidate(index_path)
+
+        self.assertIsNot(first, cache.get(index_path, object))
+
+    def test_lru_eviction_by_size(self):
+        """Test that the least recently used index is evicted once the byte budget is exceeded."""
+        cache = IndexCache(max_bytes=25)
+        a = self._make_index("a.pdf")
+        b = self._make_index("b.pdf")
+        c = self._make_index("c.pdf")
+
+        cache.get(a, object)
+        cache.get(b, object)
+        cache.get(a, object)  # a is now the most recently used entry
+        cache.get(c, object)  # 30 bytes > 25, so b is evicted
+
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], 20)
+
+        cache.get(a, object)
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_missing_index_raises(self):
+        """Test that looking up a missing index raises FileNotFoundError."""
+        cache = IndexCache(max_bytes=1000)
+        with self.assertRaises(FileNotFoundError):
+            cache.get(os.path.join(self.base_dir, "missing.pdf"), object)
+
+
+class FakeEmbeddingModel:
+    """Stand-in for HuggingFaceEmbeddings that records each forward pass."""
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+class TestEmbeddingEngine(TestCase):
+    def test_embed_documents_preserves_order(self):
+        """Test that document embeddings come back in input order."""
+        engine = EmbeddingEngine("fake-model")
+        engine._model = FakeEmbeddingModel()
+
+        vectors = engine.embed_documents(["aaa", "a", "aa"])
+
+        self.assertEqual(vectors, [[3.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+
+    def test_concurrent_queries_share_a_batch(self):
+        """Test that concurrent embed_query calls are combined into fewer forward passes."""
+        engine = EmbeddingEngine("fake-model", max_batch_size=8, max_wait_ms=200)
+        engine._model = FakeEmbeddingModel()
+        results = {}
+
+        def worker(text):
+            results[text] = engine.embed_query(text)
+
+        threads = [threading.Thread(target=worker, args=("q" * n,)) for n in range(1, 7)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(1, 7):
+            self.assertEqual(results["q" * n], [float(n), 1.0])
+        self.assertLess(len(engine._model.calls), 6)
+        self.assertEqual(engine.stats()["queries"], 6)
+
+    def test_concurrent_ingest_calls_share_a_batch(self):
+        """Test that concurrent embed_documents_batched calls share forward passes and get their own slices."""
+        engine = EmbeddingEngine("fake-model", ingest_max_texts=100, ingest_max_wait_ms=200)
+        engine._model = FakeEmbeddingModel()
+        results = {}
+
+        def worker(n):
+            results[n] = engine.embed_documents_batched(["d" * n] * n)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(1, 5):
+            self.assertEqual(results[n], [[float(n), 1.0]] * n)
+        self.assertLess(len(engine._model.calls), 4)
+        self.assertEqual(engine.stats()["ingest_requests"], 4)
+
+    def test_query_error_is_propagated(self):
+        """Test that a failing forward pass raises in every waiting caller."""
+        engine = EmbeddingEngine("fake-model")
+        engine._model = FakeEmbeddingModel()
+        engine._model.embed_documents = lambda texts: (_ for _ in ()).throw(RuntimeError("model error"))
+
+        with self.assertRaises(RuntimeError):
+            engine.embed_query("question")
+
+
+def make_tiny_sentence_transformer(directory):
+    """Saves a small randomly initialized BERT sentence-transformer (mean pooling, normalized) to `directory`."""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    words = "the a of is due contract payment invoice delivery notice term party fee data report".split()
+    bert_dir = os.path.join(directory, "bert")
+    os.makedirs(bert_dir)
+    with open(os.path.join(bert_dir, "vocab.txt"), "w") as vocab:
+        vocab.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words))
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(words) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=64, max_position_embeddings=64)
+    BertModel(config).save_pretrained(bert_dir)
+    BertTokenizerFast(os.path.join(bert_dir, "vocab.txt")).save_pretrained(bert_dir)
+    model = SentenceTransformer(modules=[models.Transformer(bert_dir, max_seq_length=32), models.Pooling(32), models.Normalize()], device="cpu")
+    model_dir = os.path.join(directory, "model")
+    model.save(model_dir)
+    return model_dir
+
+
+def _min_cosine(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return float(((a * b).sum(axis=1) / np.linalg.norm(a, axis=1) / np.linalg.norm(b, axis=1)).min())
+
+
+class TestEmbeddingBackends(TestCase):
+    TEXTS = ["the contract payment is due", "a notice of delivery", "party fee data report of the term", "invoice", "the fee"]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.work_dir = tempfile.mkdtemp()
+        cls.model_dir = make_tiny_sentence_transformer(cls.work_dir)
+        cls.reference = load_backend("torch", cls.model_dir).embed_documents(cls.TEXTS)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_quantized_torch_matches_full_precision(self):
+        """Test that the dynamic-quantized torch backend returns vectors close to the full-precision ones."""
+        vectors = load_backend("torch-int8", self.model_dir, batch_size=2).embed_documents(self.TEXTS)
+
+        self.assertEqual(len(vectors), len(self.TEXTS))
+        self.assertGreater(_min_cosine(vectors, self.reference), 0.99)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime") and importlib.util.find_spec("onnx"), "onnxruntime and onnx are not installed")
+    def test_onnx_matches_full_precision(self):
+        """Test that the int8 ONNX export returns vectors close to the full-precision ones, in input order."""
+        onnx_dir = os.path.join(self.work_dir, "onnx")
+        vectors = load_backend("onnx-int8", self.model_dir, batch_size=2, onnx_dir=onnx_dir).embed_documents(self.TEXTS)
+
+        self.assertEqual(len(vectors), len(self.TEXTS))
+        self.assertGreater(_min_cosine(vectors, self.reference), 0.99)
+        # A second load reuses the export
+        self.assertEqual(len(load_backend("onnx-int8", self.model_dir, onnx_dir=onnx_dir).embed_documents(["invoice"])[0]), 32)
+
+    def test_backend_selection(self):
+        """Test that unknown backends are rejected and quantized backends get their own cache entries."""
+        with self.assertRaises(ValueError):
+            load_backend("tensorrt", self.model_dir)
+        with override_settings(EMBEDDING_MODEL_NAME="m", EMBEDDING_BACKEND="torch"):
+            self.assertEqual(cache_model_name(), "m")
+        with override_settings(EMBEDDING_MODEL_NAME="m", EMBEDDING_BACKEND="onnx-int8"):
+            self.assertEqual(cache_model_name(), "m@onnx-int8")
+
+    def test_backend_benchmark(self):
+        """Test that the backend benchmark reports throughput and parity for each backend."""
+        from uploadfile.benchmarks import benchmark_embedding_backends
+
+        stages = benchmark_embedding_backends(self.TEXTS * 4, ["torch", "torch-int8"], repeat=2, model_name=self.model_dir, batch_size=8)
+
+        self.assertEqual(set(stages), {"embed_documents[torch]", "embed_query[torch]", "embed_documents[torch-int8]", "embed_query[torch-int8]"})
+        self.assertEqual(stages["embed_documents[torch-int8]"]["items"], 20)
+        self.assertGreater(stages["embed_documents[torch-int8]"]["min_cosine_vs_torch"], 0.99)
+
+
+class TestEmbeddingCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_round_trip_and_persistence(self):
+        """Test that stored vectors are returned by a fresh cache instance on the same directory."""
+        cache = EmbeddingCache(self.cache_dir, "fake-model")
+        self.assertEqual(cache.get_many(["footer"]), [None])
+        cache.put_many(["footer", "header"], [[1.0, 2.0], [3.0, 4.0]])
+
+        reopened = EmbeddingCache(self.cache_dir, "fake-model")
+        self.assertEqual(reopened.get_many(["header", "missing", "footer"]), [[3.0, 4.0], None, [1.0, 2.0]])
+        self.assertAlmostEqual(reopened.stats()["hit_rate"], 2 / 3)
+
+    def test_whitespace_normalization_and_model_scoping(self):
+        """Test that keys ignore whitespace differences but not the model name."""
+        cache = EmbeddingCache(self.cache_dir, "fake-model")
+        cache.put_many(["legal  footer\n"], [[1.0, 2.0]])
+
+        self.assertEqual(cache.get_many(["legal footer"]), [[1.0, 2.0]])
+        self.assertEqual(EmbeddingCache(self.cache_dir, "other-model").get_many(["legal footer"]), [None])
+
+    def test_engine_embeds_only_misses(self):
+        """Test that the embedding engine only sends uncached, distinct texts to the model."""
+        engine = EmbeddingEngine("fake-model", cache=EmbeddingCache(self.cache_dir, "fake-model"))
+        engine._model = FakeEmbeddingModel()
+
+        engine.embed_documents(["a", "bb"])
+        vectors = engine.embed_documents(["a", "ccc", "ccc", "bb"])
+
+        self.assertEqual(engine._model.calls, [["a", "bb"], ["ccc"]])
+        self.assertEqual(vectors, [[1.0, 1.0], [3.0, 1.0], [3.0, 1.0], [2.0, 1.0]])
+
+    def test_torn_append_does_not_shift_later_rows(self):
+        """Test that a partial row left by an interrupted append is overwritten by the next one."""
+        cache = EmbeddingCache(self.cache_dir, "fake-model")
+        cache.put_many(["a"], [[1.0, 2.0]])
+        with open(cache.vectors_path, "ab") as vectors_file:
+            vectors_file.write(b"\x00" * 6)  # Killed halfway through the next row
+
+        cache.put_many(["b"], [[3.0, 4.0]])
+
+        self.assertEqual(EmbeddingCache(self.cache_dir, "fake-model").get_many(["a", "b"]), [[1.0, 2.0], [3.0, 4.0]])
+        self.assertEqual(os.path.getsize(cache.vectors_path), 16)
+
+    def test_cache_opened_empty_sees_rows_of_other_processes(self):
+        """Test that a cache opened before any vector was stored reads rows written by another instance."""
+        early = EmbeddingCache(self.cache_dir, "fake-model")
+        EmbeddingCache(self.cache_dir, "fake-model").put_many(["footer"], [[1.0, 2.0]])
+
+        self.assertEqual(early.get_many(["footer"]), [[1.0, 2.0]])
+
+    def test_queries_are_kept_in_bounded_memory_only(self):
+        """Test that query vectors are served from an LRU in memory and never written to disk."""
+        cache = EmbeddingCache(self.cache_dir, "fake-model", max_query_entries=2)
+        cache.put_many(["q1", "q2"], [[1.0, 0.0], [0.0, 1.0]], queries=True)
+        cache.get_many(["q1"], queries=True)  # q1 is now the most recently used query
+        cache.put_many(["q3"], [[1.0, 1.0]], queries=True)
+
+        self.assertEqual(cache.get_many(["q1", "q2", "q3"], queries=True), [[1.0, 0.0], None, [1.0, 1.0]])
+        self.assertEqual(cache.stats()["query_entries"], 2)
+        self.assertEqual(EmbeddingCache(self.cache_dir, "fake-model").get_many(["q1", "q3"]), [None, None])
+        self.assertFalse(os.path.exists(cache.vectors_path))
+
+    def test_engine_does_not_persist_queries(self):
+        """Test that repeated queries skip the model without being written to the on-disk cache."""
+        engine = EmbeddingEngine("fake-model", max_wait_ms=0, cache=EmbeddingCache(self.cache_dir, "fake-model"))
+        engine._model = FakeEmbeddingModel()
+
+        engine.embed_query("refund policy")
+        engine.embed_query("refund policy")
+
+        self.assertEqual(engine._model.calls, [["refund policy"]])
+        self.assertEqual(EmbeddingCache(self.cache_dir, "fake-model").get_many(["refund policy"]), [None])
+
+
+class TestAnnIndex(TestCase):
+    def setUp(self):
+        self.vectors = np.random.RandomState(0).rand(1200, 16).astype(np.float32)
+
+    @override_settings(FAISS_FLAT_MAX_VECTORS=100, FAISS_MEDIUM_MAX_VECTORS=1000, FAISS_MEDIUM_INDEX_TYPE="ivf_flat")
+    def test_index_type_by_corpus_size(self):
+        """Test that the index type grows with the corpus size."""
+        self.assertEqual(choose_index_type(50), "flat")
+        self.assertEqual(choose_index_type(500), "ivf_flat")
+        self.assertEqual(choose_index_type(5000), "ivf_pq")
+
+    def test_built_indices_find_exact_match(self):
+        """Test that every index type returns a stored vector as its own nearest neighbour."""
+        for index_type in ("flat", "hnsw", "ivf_flat", "ivf_pq"):
+            index, built_type, _ = build_index(self.vectors, index_type)
+            self.assertEqual(built_type, index_type)
+            self.assertEqual(index_type_of(index), index_type)
+            results = search(index, self.vectors[7], k=3, nprobe=64, ef_search=128)
+            self.assertEqual(results[0][0], 7, index_type)
+
+    def test_search_parameters_do_not_mutate_index(self):
+        """Test that a per-query nprobe does not change the shared index's default."""
+        index, _, _ = build_index(self.vectors, "ivf_flat")
+        default_nprobe = index.nprobe
+
+        search(index, self.vectors[0], k=3, nprobe=default_nprobe + 5)
+
+        self.assertEqual(index.nprobe, default_nprobe)
+
+
+class TestHybridRetrieval(TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        self.texts = [
+            "The warranty covers parts and labour for two years.",
+            "Replacement part AB-1234 fits the rear housing.",
+            "Clause 12.3.4 limits liability to the purchase price.",
+            "Warranty claims need the original receipt.",
+        ]
+        # Vectors that rank chunk 0 nearest and the part-number chunk last
+        self.vectors = np.array([[1.0, 0.0], [0.0, 1.0], [0.6, 0.8], [0.9, 0.1]], dtype=np.float32)
+        index, _, _ = build_index(self.vectors, "flat")
+        documents = [Document(id=f"c{i}", page_content=text, metadata={"page": i}) for i, text in enumerate(self.texts)]
+        write_index_store(self.index_dir, index, documents)
+        self.store = IndexStore.load(self.index_dir)
+        build_sparse_index(self.texts, self.index_dir)
+        self.sparse = SparseIndex.load(self.index_dir)
+
+    def test_index_store_round_trip(self):
+        """Test that chunks are read back by position from the native layout, with no pickle written."""
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(self.store.index.ntotal, 4)
+        document = self.store.document(2)
+        self.assertEqual((document.id, document.page_content, document.metadata), ("c2", self.texts[2], {"page": 2}))
+        self.assertFalse(os.path.exists(os.path.join(self.index_dir, "index.pkl")))
+
+    def test_index_generation_replaces_index_atomically(self):
+        """Test that a rewrite publishes a new directory: loaded stores keep their files, two generations stay on disk."""
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir, ignore_errors=True)
+        index_path = os.path.join(base_dir, "doc.pdf")
+        write_index_store(index_path, build_index(self.vectors, "flat")[0], [Document(id="old", page_content="old text")] * 4)  # Pre-generation layout
+        loaded = IndexStore.load(index_path)
+
+        for version in range(3):
+            with index_generation(index_path) as generation_path:
+                documents = [Document(id=f"v{version}-{i}", page_content=text) for i, text in enumerate(self.texts)]
+                write_index_store(generation_path, build_index(self.vectors, "flat")[0], documents)
+
+        self.assertTrue(os.path.islink(index_path))
+        self.assertEqual(IndexStore.load(index_path).document(1).id, "v2-1")
+        self.assertEqual(loaded.document(3).page_content, "old text")  # Still mapped, though its directory is gone
+        self.assertEqual(len([name for name in os.listdir(base_dir) if name.startswith(".doc.pdf.gen-")]), 2)
+
+    def test_tokenize_keeps_identifiers(self):
+        """Test that part numbers and clause ids are kept whole and split into parts."""
+        self.assertEqual(tokenize("Part AB-1234, clause 12.3.4"), ["part", "ab-1234", "ab", "1234", "clause", "12.3.4", "12", "3", "4"])
+
+    def test_sparse_index_ranks_exact_terms(self):
+        """Test that BM25 finds exact identifiers and ignores unknown terms."""
+        self.assertEqual(self.sparse.search("ab-1234", k=2)[0][0], 1)
+        self.assertEqual(self.sparse.search("clause 12.3.4", k=2)[0][0], 2)
+        self.assertEqual(self.sparse.search("zeppelin", k=2), [])
+
+    def test_sparse_rebuild_leaves_loaded_index_intact(self):
+        """Test that rebuilding writes new arrays: a loaded index keeps its own, a new load sees the rebuild."""
+        build_sparse_index(["Nothing about parts here."], self.index_dir)
+        build_sparse_index(["Zeppelin manual."], self.index_dir)
+
+        self.assertEqual(self.sparse.search("ab-1234", k=2)[0][0], 1)
+        self.assertEqual([position for position, _ in SparseIndex.load(self.index_dir).search("zeppelin", k=2)], [0])
+        arrays = [name for name in os.listdir(os.path.join(self.index_dir, "sparse")) if name.endswith(".npy")]
+        self.assertEqual(len(arrays), 10)  # The current build and the previous one
+
+    def test_reciprocal_rank_fusion_weights(self):
+        """Test that fused ranks reward agreement and respect retriever weights."""
+        self.assertEqual(reciprocal_rank_fusion([["a", "b"], ["b", "c"]], [1.0, 1.0])[0], "b")
+        self.assertEqual(reciprocal_rank_fusion([["a", "b"], ["b", "a"]], [2.0, 1.0])[0], "a")
+
+    def test_hybrid_search_surfaces_keyword_match(self):
+        """Test that an exact part number ranks first with keyword weight, but not with vectors alone."""
+        query_vector = [1.0, 0.0]
+
+        vector_only = hybrid_search(self.store, self.sparse, "part AB-1234", query_vector, k=1, candidates=4, keyword_weight=0)
+        hybrid = hybrid_search(self.store, self.sparse, "part AB-1234", query_vector, k=1, candidates=4, keyword_weight=2.0)
+
+        self.assertEqual(vector_only[0].id, "c0")
+        self.assertEqual(hybrid[0].id, "c1")
+
+    @patch("query_app.retrieval.get_reranker")
+    def test_rerank_reorders_candidates(self, mock_reranker):
+        """Test that rerank sees the full candidate pool and picks the final top k."""
+        mock_reranker.return_value.rerank.side_effect = lambda query, documents, k: documents[::-1][:k]
+
+        results = hybrid_search(self.store, self.sparse, "warranty", [1.0, 0.0], k=1, candidates=4, rerank=True)
+
+        candidates = mock_reranker.return_value.rerank.call_args[0][1]
+        self.assertEqual(len(candidates), 4)
+        self.assertEqual(results, [candidates[-1]])
+
+
+class TestWarmup(TestCase):
+    def test_url_resolution_skips_heavy_imports(self):
+        """Test that loading the URL configuration does not import LangChain, FAISS, openai or torch."""
+        code = (
+            "import sys, django; django.setup(); import myapi.urls, myapi.celery; "
+            "print(','.join(m for m in ('langchain_core', 'faiss', 'openai', 'torch') if m in sys.modules))"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="myapi.settings")
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)), env=env,
+                                capture_output=True, text=True, timeout=120)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
+
+    def test_warmup_preloads_recent_indices(self):
+        """Test that warmup loads the most recent PDFs' indices into the index cache."""
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir, ignore_errors=True)
+        self.addCleanup(gc.unfreeze)
+        for name in ("old.pdf", "new.pdf"):
+            index_path = os.path.join(base_dir, name)
+            index, _, _ = build_index(np.eye(2, dtype=np.float32), "flat")
+            write_index_store(index_path, index, [Document(id=f"{name}{i}", page_content=f"chunk {i}") for i in range(2)])
+            PDFDocument.objects.create(client_id="7", pdf_name=name, file_path=index_path)
+
+        with patch("query_app.warmup.index_cache", IndexCache(max_bytes=10 ** 9)) as cache:
+            warmup(embedding_model=False, indices=1)
+
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache.get(os.path.join(base_dir, "new.pdf"), None).document(1).page_content, "chunk 1")
+
+
+class TestContextPacking(TestCase):
+    def test_overlapping_chunks_are_joined_in_page_order(self):
+        """Test that chunks are ordered by position and their shared overlap is sent once."""
+        page = "Refunds are issued within 30 days. Items must be unused. Shipping costs are not refunded."
+        later = Document(id="b", page_content=page[35:], metadata={"page": 1, "start_index": 35})
+        earlier = Document(id="a", page_content=page[:57], metadata={"page": 1, "start_index": 0})
+
+        context, packed = pack_context([later, earlier], max_tokens=1000, pdf_name="a.pdf")
+
+        self.assertEqual(context, page)
+        self.assertEqual([doc.id for doc in packed], ["a", "b"])
+
+    def test_overlap_without_offsets_and_duplicates(self):
+        """Test that chunks from older indices are merged by matching text and exact duplicates are dropped."""
+        first = Document(id="a", page_content="The warranty covers parts and labour for two years.", metadata={"page": 2, "source": "w.pdf"})
+        second = Document(id="b", page_content="parts and labour for two years. Claims need the receipt.", metadata={"page": 2, "source": "w.pdf"})
+        duplicate = Document(id="c", page_content=first.page_content, metadata={"page": 2, "source": "copy.pdf"})
+
+        context, packed = pack_context([first, second, duplicate], max_tokens=1000)
+
+        self.assertEqual(context, "[Source: w.pdf] The warranty covers parts and labour for two years. Claims need the receipt.")
+        self.assertEqual([doc.id for doc in packed], ["a", "b"])
+
+    def test_budget_keeps_most_relevant_chunks(self):
+        """Test that chunks are taken by relevance until the token budget is spent."""
+        documents = [Document(id=str(i), page_content=f"chunk {i} text", metadata={"page": 5 - i, "tokens": 10}) for i in range(4)]
+
+        _, packed = pack_context(documents, max_tokens=25, pdf_name="a.pdf")
+
+        self.assertEqual([doc.id for doc in packed], ["1", "0"])
+
+    def test_fit_messages_drops_oldest_history(self):
+        """Test that the message list is trimmed from the oldest history turn, keeping system and question."""
+        messages = [{"role": "system", "content": "sys"}] + [{"role": "user", "content": "x" * 400} for _ in range(3)] + [{"role": "user", "content": "question"}]
+
+        fitted, prompt_tokens = fit_messages(messages, max_tokens=count_message_tokens(messages) - 50)
+
+        self.assertEqual(len(fitted), 4)
+        self.assertEqual((fitted[0]["content"], fitted[-1]["content"]), ("sys", "question"))
+        self.assertEqual(prompt_tokens, count_message_tokens(fitted))
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        self.registry = MetricsRegistry(directory=self.metrics_dir)
+
+    def test_collect_sums_processes(self):
+        """Test that values written by other processes are summed with this one's."""
+        self.registry.inc("ingest_documents_total", status="success")
+        self.registry.observe("span_duration_seconds", 0.02, span="query.embed")
+        other = {"counters": [["ingest_documents_total", {"status": "success"}, 2]],
+                 "histograms": [["span_duration_seconds", {"span": "query.embed"}, [0, 1] + [0] * 13 + [0.008]]]}
+        with open(os.path.join(self.metrics_dir, "1.json"), "w") as metrics_file:
+            json.dump(other, metrics_file)
+
+        text = render_prometheus(*self.registry.collect())
+
+        self.assertIn('ingest_documents_total{status="success"} 3', text)
+        self.assertIn('span_duration_seconds_bucket{span="query.embed",le="0.01"} 1', text)
+        self.assertIn('span_duration_seconds_bucket{span="query.embed",le="+Inf"} 2', text)
+        self.assertIn('span_duration_seconds_count{span="query.embed"} 2', text)
+
+    def test_process_files_are_named_by_host_pid_and_start(self):
+        """Test that two registries of one pid (as after pid reuse) write separate files."""
+        other = MetricsRegistry(directory=self.metrics_dir)
+        self.registry.inc("ingest_documents_total", status="success")
+        other.inc("ingest_documents_total", status="success")
+        self.registry.flush()
+        other.flush()
+
+        names = sorted(os.listdir(self.metrics_dir))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.startswith(f"{socket.gethostname()}-{os.getpid()}-") for name in names))
+        self.assertEqual(self.registry.collect()[0][("ingest_documents_total", (("status", "success"),))], 2)
+
+    def test_stale_files_are_folded_into_cumulative(self):
+        """Test that files of exited processes are folded once and counters stay monotonic."""
+        exited = os.path.join(self.metrics_dir, "worker-7-abc.json")
+        with open(exited, "w") as metrics_file:
+            json.dump({"counters": [["ingest_documents_total", {"status": "success"}, 2]], "histograms": []}, metrics_file)
+        os.utime(exited, (time.time() - 600, time.time() - 600))
+        self.registry.inc("ingest_documents_total", status="success")
+
+        first = self.registry.collect()[0]
+        second = self.registry.collect()[0]
+
+        key = ("ingest_documents_total", (("status", "success"),))
+        self.assertEqual((first[key], second[key]), (3, 3))
+        self.assertFalse(os.path.exists(exited))
+        self.assertTrue(os.path.exists(os.path.join(self.metrics_dir, CUMULATIVE_FILE)))
+
+    def test_folded_live_process_is_not_counted_twice(self):
+        """Test that a process whose file was taken as stale writes only what it counted afterwards."""
+        self.registry.inc("ingest_documents_total", status="success")
+        self.registry.flush()
+        os.utime(self.registry.path, (time.time() - 600, time.time() - 600))
+        MetricsRegistry(directory=self.metrics_dir).collect()  # Another process folds it
+
+        self.registry.inc("ingest_documents_total", status="success")
+
+        self.assertEqual(self.registry.collect()[0][("ingest_documents_total", (("status", "success"),))], 2)
+
+    def test_span_counts_errors(self):
+        """Test that a failing span is timed and counted as an error."""
+        with patch("query_app.metrics.registry", self.registry):
+            with self.assertRaises(ValueError):
+                with span("ingest.embed"):
+                    raise ValueError("boom")
+        counters, histograms = self.registry.collect()
+        self.assertEqual(counters[("span_errors_total", (("span", "ingest.embed"),))], 1)
+        self.assertEqual(histograms[("span_duration_seconds", (("span", "ingest.embed"),))][0], 1)
+
+    @override_settings(METRICS_AUTH_TOKEN="scrape-secret")
+    def test_metrics_endpoint_requires_token(self):
+        """Test that /metrics serves the text format only with the configured token."""
+        with patch("query_app.views.registry", self.registry):
+            self.registry.inc("answer_cache_requests_total", result="hit")
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-secret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'answer_cache_requests_total{result="hit"} 1', response.content)
+
+
+def _chunk(content):
+    """Builds an object shaped like an OpenAI streaming chunk."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class _AsyncStream:
+    """Async iterator over fake OpenAI streaming chunks."""
+
+    def __init__(self, contents):
+        self._chunks = iter([_chunk(content) for content in contents])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+# History rows are written in the request: a deferred write from another thread could not see the test's transaction
+@override_settings(HISTORY_WRITE_MODE="sync")
+@patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"})
+@patch("query_app.views._retrieve", return_value=("retrieved context", [{"pdf_name": "a.pdf", "page": 1}], [1.0, 0.0], ["chunk-1"]))
+class TestQueryViews(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="client", password="secret")
+        self.token = Token.objects.create(user=self.user)
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        PDFDocument.objects.create(client_id=str(self.user.id), pdf_name="a.pdf", file_path=self.index_dir)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+        self.body = {"query": "What is the refund policy?", "pdf_name": "a.pdf", "session_id": "s1"}
+        answer_cache.clear()
+        self.addCleanup(answer_cache.clear)
+
+    @patch("openai.chat.completions.create")
+    def test_query_pdf_streams_answer_and_records_history(self, mock_create, mock_retrieve):
+        """Test that the sync endpoint streams the answer and stores both turns."""
+        mock_create.return_value = iter([_chunk("Refunds "), _chunk(None), _chunk("within 30 days.")])
+
+        response = self.client.post("/query/", self.body, content_type="application/json", **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"Refunds within 30 days.")
+        self.assertEqual(json.loads(response["X-Sources"]), [{"pdf_name": "a.pdf", "page": 1}])
+        self.assertGreater(int(response["X-Prompt-Tokens"]), 0)
+        roles = list(ConversationHistory.objects.filter(session_id="s1").order_by("timestamp").values_list("role", flat=True))
+        self.assertEqual(roles, ["user", "assistant"])
+
+    @patch("openai.chat.completions.create")
+    def test_repeated_question_served_from_answer_cache(self, mock_create, mock_retrieve):
+        """Test that a repeated question over the same chunks skips the LLM call."""
+        mock_create.return_value = iter([_chunk("Refunds within 30 days.")])
+        first = self.client.post("/query/", self.body, content_type="application/json", **self.auth)
+        b"".join(first.streaming_content)
+
+        second = self.client.post("/query/", self.body, content_type="application/json", **self.auth)
+
+        self.assertEqual(second["X-Answer-Cache"], "hit")
+        self.assertEqual(b"".join(second.streaming_content), b"Refunds within 30 days.")
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertEqual(ConversationHistory.objects.filter(session_id="s1").count(), 4)
+
+    def test_query_pdf_unknown_pdf(self, mock_retrieve):
+        """Test that querying a PDF the client does not own returns 404."""
+        body = dict(self.body, pdf_name="missing.pdf")
+
+        response = self.client.post("/query/", body, content_type="application/json", **self.auth)
+
+        self.assertEqual(response.status_code, 404)
+        mock_retrieve.assert_not_called()
+
+    @patch("query_app.views._get_async_openai_client")
+    async def test_query_pdf_stream_sends_sse_events(self, mock_client, mock_retrieve):
+        """Test that the async endpoint streams sources, tokens and done as SSE events."""
+        mock_client.return_value.chat.completions.create = AsyncMock(return_value=_AsyncStream(["Refunds ", "apply."]))
+
+        response = await self.async_client.post(
+            "/query/stream/", self.body, content_type="application/json", headers={"Authorization": f"Token {self.token.key}"}
+        )
+        body = b"".join([part async for part in response.streaming_content]).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = [block.split("\n") for block in body.strip().split("\n\n")]
+        self.assertEqual([lines[0] for lines in events], ["event: sources", "event: token", "event: token", "event: done"])
+        self.assertEqual(json.loads(events[1][1][len("data: "):]), {"content": "Refunds "})
+        assistant = await ConversationHistory.objects.filter(session_id="s1", role="assistant").afirst()
+        self.assertEqual(assistant.content, "Refunds apply.")
+
+    @patch("openai.chat.completions.create")
+    def test_query_pdf_stream_is_incremental_under_wsgi(self, mock_create, mock_retrieve):
+        """Test that a WSGI request gets a sync stream whose tokens are sent as the LLM produces them."""
+        produced = []
+
+        def llm_chunks():
+            for content in ["Refunds ", "apply."]:
+                produced.append(content)
+                yield _chunk(content)
+
+        mock_create.return_value = llm_chunks()
+
+        response = self.client.post("/query/stream/", self.body, content_type="application/json", **self.auth)
+        stream = iter(response.streaming_content)
+
+        self.assertFalse(response.is_async)
+        self.assertTrue(next(stream).startswith(b"event: sources"))
+        self.assertEqual(json.loads(next(stream).decode().split("\n")[1][len("data: "):]), {"content": "Refunds "})
+        self.assertEqual(produced, ["Refunds "])  # The first token went out before the LLM produced the second
+        self.assertEqual([part.decode().split("\n")[0] for part in stream], ["event: token", "event: done"])
+        self.assertEqual(ConversationHistory.objects.get(session_id="s1", role="assistant").content, "Refunds apply.")
+
+    async def test_query_pdf_stream_requires_token(self, mock_retrieve):
+        """Test that the async endpoint rejects unauthenticated requests."""
+        response = await self.async_client.post("/query/stream/", self.body, content_type="application/json")
+
+        self.assertEqual(response.status_code, 401)
+
+
+class TestSemanticAnswerCache(TestCase):
+    def test_hit_requires_similar_query_and_same_chunks(self):
+        """Test that only a similar query over the same chunk ids hits."""
+        cache = SemanticAnswerCache(max_entries=10, ttl_seconds=60, threshold=0.9)
+        cache.put("scope", [1.0, 0.0], ["c1", "c2"], "answer")
+
+        self.assertEqual(cache.get("scope", [0.99, 0.05], ["c1", "c2"]), "answer")
+        self.assertIsNone(cache.get("scope", [0.0, 1.0], ["c1", "c2"]))  # Different meaning
+        self.assertIsNone(cache.get("scope", [1.0, 0.0], ["c1", "c3"]))  # Different evidence
+        self.assertIsNone(cache.get("other", [1.0, 0.0], ["c1", "c2"]))  # Different client/PDF
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+    def test_best_match_among_entries_with_same_chunks(self):
+        """Test that the most similar entry for the same chunks wins, and invalidate drops the scope."""
+        cache = SemanticAnswerCache(max_entries=100, ttl_seconds=60, threshold=0.9)
+        for i in range(50):
+            cache.put("scope", [1.0, 0.0], [f"other-{i}"], f"other {i}")
+        cache.put("scope", [1.0, 0.3], ["c1"], "close")
+        cache.put("scope", [1.0, 0.05], ["c1"], "closest")
+
+        self.assertEqual(cache.get("scope", [1.0, 0.0], ["c1"]), "closest")
+        cache.invalidate("scope")
+        self.assertIsNone(cache.get("scope", [1.0, 0.0], ["c1"]))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_ttl_expiry(self):
+        """Test that expired answers are not served."""
+        cache = SemanticAnswerCache(max_entries=10, ttl_seconds=0, threshold=0.9)
+        cache.put("scope", [1.0, 0.0], ["c1"], "answer")
+        time.sleep(0.01)
+
+        self.assertIsNone(cache.get("scope", [1.0, 0.0], ["c1"]))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used answer is evicted first."""
+        cache = SemanticAnswerCache(max_entries=2, ttl_seconds=60, threshold=0.9)
+        cache.put("scope", [1.0, 0.0], ["a"], "answer a")
+        cache.put("scope", [0.0, 1.0], ["b"], "answer b")
+        cache.get("scope", [1.0, 0.0], ["a"])  # a is now the most recently used entry
+        cache.put("scope", [1.0, 1.0], ["c"], "answer c")
+
+        self.assertEqual(cache.get("scope", [1.0, 0.0], ["a"]), "answer a")
+        self.assertIsNone(cache.get("scope", [0.0, 1.0], ["b"]))
+
+
+class TestConversationHistoryWindow(TestCase):
+    def setUp(self):
+        # Five turns: questions q0..q4 with injected context, answers a0..a4
+        self.rows = []
+        for turn in range(5):
+            self.rows.append(ConversationHistory.objects.create(session_id="s1", role="user", content=f"q{turn}", context=f"long context {turn}"))
+            self.rows.append(ConversationHistory.objects.create(session_id="s1", role="assistant", content=f"a{turn}"))
+
+    @patch("query_app.history.schedule_summarization")
+    def test_keeps_last_turns_without_context(self, mock_schedule):
+        """Test that only the newest turns are sent, with raw questions instead of injected context."""
+        messages = build_history_messages("s1", max_tokens=1000, keep_turns=2)
+
+        self.assertEqual([m["content"] for m in messages], ["q3", "a3", "q4", "a4"])
+        mock_schedule.assert_called_once_with("s1")
+
+    @patch("query_app.history.count_tokens", return_value=1)
+    @patch("query_app.history.schedule_summarization")
+    def test_token_budget_drops_oldest_turns_first(self, mock_schedule, mock_count):
+        """Test that the token budget is filled newest-first."""
+        messages = build_history_messages("s1", max_tokens=2, keep_turns=5)
+
+        self.assertEqual([m["content"] for m in messages], ["q4", "a4"])
+        mock_schedule.assert_not_called()
+
+    @patch("query_app.history.schedule_summarization")
+    def test_summary_replaces_folded_turns(self, mock_schedule):
+        """Test that folded turns are replaced by the rolling summary."""
+        ConversationSummary.objects.create(session_id="s1", summary="User asked q0-q2.", summarized_through=self.rows[5].id)
+
+        messages = build_history_messages("s1", max_tokens=1000, keep_turns=5)
+
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertIn("User asked q0-q2.", messages[0]["content"])
+        self.assertEqual([m["content"] for m in messages[1:]], ["q3", "a3", "q4", "a4"])
+
+    def test_history_window_cursor(self):
+        """Test that the cursor fetch returns only rows after the cursor, newest first."""
+        rows = history_window("s1", after_id=self.rows[6].id, limit=2, fields=("id", "content"))
+
+        self.assertEqual(rows, [(self.rows[9].id, "a4"), (self.rows[8].id, "q4")])
+
+    @override_settings(HISTORY_KEEP_TURNS=2, HISTORY_SUMMARY_BATCH_MESSAGES=100)
+    @patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"})
+    @patch("openai.chat.completions.create")
+    def test_summarize_task_folds_only_older_turns(self, mock_create):
+        """Test that the summarization task folds turns outside the verbatim window, incrementally."""
+        mock_create.return_value = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" summary v1 "))])
+
+        result = summarize_conversation_task("s1")
+
+        self.assertEqual(result["folded"], 6)
+        summary = ConversationSummary.objects.get(session_id="s1")
+        self.assertEqual(summary.summary, "summary v1")
+        self.assertEqual(summary.summarized_through, self.rows[5].id)
+        prompt = mock_create.call_args.kwargs["messages"][1]["content"]
+        self.assertIn("user: q0", prompt)
+        self.assertNotIn("q3", prompt)
+        self.assertNotIn("long context", prompt)
+
+        # Nothing new outside the window: no second LLM call
+        self.assertEqual(summarize_conversation_task("s1")["folded"], 0)
+        self.assertEqual(mock_create.call_count, 1)
+
+
+class TestHistoryWriter(TransactionTestCase):
+    @override_settings(HISTORY_WRITE_MODE="deferred")
+    def test_deferred_rows_written_in_order_in_batches(self):
+        """Test that queued rows are stored by the background thread, in order, in batches of at most batch_size."""
+        writer = HistoryWriter(batch_size=2)
+        self.addCleanup(writer.close)
+        with patch.object(ConversationHistory.objects, "bulk_create", wraps=ConversationHistory.objects.bulk_create) as bulk_create:
+            for turn in range(3):
+                writer.add("s1", "user", f"q{turn}", context="ctx")
+                writer.add("s1", "assistant", f"a{turn}")
+            deadline = time.monotonic() + 10
+            while writer.pending() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            writer.flush()
+
+        rows = list(ConversationHistory.objects.filter(session_id="s1").order_by("id").values_list("role", "content"))
+        self.assertEqual(rows, [("user", "q0"), ("assistant", "a0"), ("user", "q1"), ("assistant", "a1"), ("user", "q2"), ("assistant", "a2")])
+        self.assertTrue(all(len(call.args[0]) <= 2 for call in bulk_create.call_args_list))
+        self.assertEqual(ConversationHistory.objects.get(content="q1").context, "ctx")
+
+    @override_settings(HISTORY_WRITE_MODE="deferred")
+    def test_deferred_add_does_not_wait_for_database(self):
+        """Test that add() returns while the database write is still blocked."""
+        writer = HistoryWriter()
+        self.addCleanup(writer.close)
+        release = threading.Event()
+        original = ConversationHistory.objects.bulk_create
+
+        def slow_bulk_create(rows):
+            release.wait(10)
+            return original(rows)
+
+        with patch.object(ConversationHistory.objects, "bulk_create", side_effect=slow_bulk_create):
+            started = time.perf_counter()
+            writer.add("s1", "assistant", "answer")
+            self.assertLess(time.perf_counter() - started, 1)
+            release.set()
+            writer.flush()
+            deadline = time.monotonic() + 10
+            while not ConversationHistory.objects.filter(session_id="s1").exists() and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(ConversationHistory.objects.get(session_id="s1").content, "answer")
+
+    @override_settings(HISTORY_WRITE_MODE="sync")
+    def test_sync_mode_writes_before_returning(self):
+        """Test that the sync mode stores the row in the calling thread."""
+        HistoryWriter().add("s1", "user", "q0")
+
+        self.assertEqual(ConversationHistory.objects.filter(session_id="s1").count(), 1)
+
+
+class TestDatabaseSettings(TestCase):
+    def _databases(self, **env):
+        code = "import json; from myapi import settings; print(json.dumps(settings.DATABASES['default']))"
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                                env=dict({k: v for k, v in os.environ.items() if not k.startswith("DB_")}, **env),
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout)
+
+    def test_postgres_from_environment(self):
+        """Test that DB_* variables select Postgres with persistent connections, or a pool instead of them."""
+        database = self._databases(DB_ENGINE="postgres", DB_HOST="db", DB_PASSWORD="pw", DB_CONN_MAX_AGE="30")
+        self.assertEqual(database["ENGINE"], "django.db.backends.postgresql")
+        self.assertEqual((database["HOST"], database["PASSWORD"], database["CONN_MAX_AGE"]), ("db", "pw", 30))
+        self.assertNotIn("pool", database["OPTIONS"])
+
+        pooled = self._databases(DB_ENGINE="postgres", DB_POOL_MAX_SIZE="9")
+        self.assertEqual(pooled["CONN_MAX_AGE"], 0)
+        self.assertEqual(pooled["OPTIONS"]["pool"]["max_size"], 9)
+
+    def test_sqlite_default_uses_wal(self):
+        """Test that the default SQLite database waits for locks and runs in WAL mode."""
+        database = self._databases()
+        self.assertEqual(database["ENGINE"], "django.db.backends.sqlite3")
+        self.assertIn("journal_mode=WAL", database["OPTIONS"]["init_command"])
+        self.assertGreater(database["OPTIONS"]["timeout"], 0)
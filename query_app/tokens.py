@@ -0,0 +1,70 @@
+# tokens.py
+import logging
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Returns the tiktoken encoding for the LLM model, or None if it cannot be loaded."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+
+                    _encoding = tiktoken.encoding_for_model(settings.LLM_MODEL)
+                except Exception as e:
+                    # e.g. the BPE file cannot be downloaded; fall back to an estimate
+                    logger.warning(f"tiktoken encoding unavailable, estimating token counts: {str(e)}")
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Counts the tokens of `text` for the LLM model (about 4 characters per token without tiktoken)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message):
+    """Counts the prompt tokens of one chat message, including the 3-token per-message overhead."""
+    return 3 + count_tokens(message["role"]) + count_tokens(message["content"])
+
+
+def count_message_tokens(messages):
+    """
+    Counts the prompt tokens of a chat message list, including the per-message
+    overhead of the chat format (3 tokens per message, 3 to prime the reply).
+    """
+    return 3 + sum(message_tokens(message) for message in messages)
+
+
+def count_tokens_many(texts):
+    """Counts the tokens of each text in `texts` (one batched tokenizer call); see count_tokens."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return [(len(text) + 3) // 4 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(list(texts))]
+
+
+def split_tokens(text, max_tokens):
+    """Splits `text` into consecutive pieces of at most `max_tokens` tokens (about 4 characters per token without tiktoken)."""
+    encoding = _get_encoding()
+    if encoding is None:
+        step = max_tokens * 4
+        return [text[start:start + step] for start in range(0, len(text), step)]
+    tokens = encoding.encode_ordinary(text)
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path('', views.query_pdf, name='query_pdf'),
+    path('stream/', views.query_pdf_stream, name='query_pdf_stream'),  # Async SSE endpoint (serve with ASGI)
 ]
\ No newline at end of file
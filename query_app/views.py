@@ -1,23 +1,214 @@
+import asyncio
+import hmac
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from dotenv import load_dotenv
 import logging
-import openai
 from typing import List, Dict
-from .models import PDFDocument, ConversationHistory  # Import the models
+from .models import PDFDocument  # Import the models
+from .index_cache import index_cache
+from .sparse_index import SPARSE_DIR, SparseIndex
+from .index_store import IndexStore, has_index_store
+from .context import fit_messages, pack_context
+from .metrics import record_span, registry, render_prometheus, span
+from .answer_cache import answer_cache
+from .history import build_history_messages, format_user_prompt
+from .history_writer import history_writer
 
 load_dotenv()  # Load environment variables from .env file
 
 logger = logging.getLogger(__name__)
 
-# Initialize embedding function globally (this is independent of the client)
-embedding_function = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# openai, LangChain, FAISS search and the embedding model are imported on first use, so that
+# management commands and URL resolution do not load them; servers preload them (see warmup.py)
+
+# Thread pool that runs embedding and FAISS search for the async endpoint
+_query_executor = None
+
+# Async OpenAI client shared by all requests of this process (reuses HTTP connections)
+_async_openai_client = None
+
+
+class QueryError(Exception):
+    """Raised while preparing a query; carries the HTTP status for the error response."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _parse_query_params(data):
+    """Validates the request body and returns the query parameters."""
+    if 'query' not in data or 'session_id' not in data:
+        raise QueryError("Missing 'query' or 'session_id' parameter.", status=400)
+    try:
+        nprobe = int(data['nprobe']) if data.get('nprobe') is not None else None
+        ef_search = int(data['ef_search']) if data.get('ef_search') is not None else None
+    except (TypeError, ValueError):
+        raise QueryError("'nprobe' and 'ef_search' must be integers.", status=400)
+    try:
+        k = int(data.get('k', settings.RETRIEVAL_K))
+        candidates = int(data.get('candidates', settings.RETRIEVAL_CANDIDATES))
+        vector_weight = float(data.get('vector_weight', settings.RETRIEVAL_VECTOR_WEIGHT))
+        keyword_weight = float(data.get('keyword_weight', settings.RETRIEVAL_KEYWORD_WEIGHT))
+    except (TypeError, ValueError):
+        raise QueryError("'k' and 'candidates' must be integers, 'vector_weight' and 'keyword_weight' numbers.", status=400)
+    if not 1 <= k <= settings.RETRIEVAL_MAX_K or not 1 <= candidates <= settings.RETRIEVAL_MAX_CANDIDATES:
+        raise QueryError(f"'k' must be between 1 and {settings.RETRIEVAL_MAX_K} and 'candidates' between 1 and {settings.RETRIEVAL_MAX_CANDIDATES}.", status=400)
+    if vector_weight < 0 or keyword_weight < 0 or not (vector_weight or keyword_weight):
+        raise QueryError("'vector_weight' and 'keyword_weight' must be >= 0 and not both 0.", status=400)
+    rerank = data.get('rerank', settings.RERANK_ENABLED)
+    return {
+        "query": data['query'],
+        "pdf_name": data.get('pdf_name'),  # None searches across all of the client's PDFs
+        "session_id": data['session_id'],
+        "nprobe": nprobe,
+        "ef_search": ef_search,
+        "k": k,
+        "candidates": candidates,
+        "vector_weight": vector_weight,
+        "keyword_weight": keyword_weight,
+        "rerank": rerank.lower() == 'true' if isinstance(rerank, str) else bool(rerank),
+    }
+
+
+def _resolve_index_path(client_id, pdf_name):
+    """Returns the index to search: the PDF's own index, or the client's merged index."""
+    if pdf_name:
+        # Fetch the PDF document from the database
+        # Unique (client_id, pdf_name) lookup that reads only the index path
+        faiss_index_file = PDFDocument.objects.filter(client_id=client_id, pdf_name=pdf_name).values_list('file_path', flat=True).first()
+        if not faiss_index_file:
+            logger.info(f"No PDF document found for client_id={client_id}, pdf_name={pdf_name}")
+            raise QueryError("No PDF document found. Please upload a PDF file first.", status=404)
+    else:
+        if not PDFDocument.objects.filter(client_id=client_id).exists():
+            logger.info(f"No PDF documents found for client_id={client_id}")
+            raise QueryError("No PDF document found. Please upload a PDF file first.", status=404)
+        faiss_index_file = os.path.join(settings.FAISS_MERGED_INDICES_DIR, f'client_{client_id}')
+
+    if not os.path.exists(faiss_index_file):
+        logger.error(f"FAISS index not found at {faiss_index_file}")
+        raise QueryError("FAISS index not found. Please generate the index for the uploaded PDF.", status=404)
+    return faiss_index_file
+
+
+def _load_index_store(faiss_index_file):
+    """Returns the cached IndexStore for `faiss_index_file`, loading it on a miss."""
+    if not has_index_store(faiss_index_file):
+        logger.error(f"FAISS index at {faiss_index_file} is in the legacy pickle format; run 'manage.py convert_indices'")
+        raise QueryError("This index was built in an older format. Please re-upload the PDF.", status=409)
+    return index_cache.get(faiss_index_file, lambda: IndexStore.load(faiss_index_file))
+
+
+def _load_sparse_index(faiss_index_file, faiss_index):
+    """Returns the cached keyword index saved with `faiss_index`, or None if missing or out of step."""
+    sparse_path = os.path.join(faiss_index_file, SPARSE_DIR)
+    if not os.path.isdir(sparse_path):
+        return None  # Indices built before keyword search existed
+    sparse_index = index_cache.get(sparse_path, lambda: SparseIndex.load(faiss_index_file))
+    if sparse_index is None or sparse_index.num_docs != faiss_index.index.ntotal:
+        return None  # Caught mid-rewrite; vector search alone this time
+    return sparse_index
+
+
+def _retrieve(faiss_index_file, params):
+    """
+    Loads (or reuses) the indices, embeds the query, runs the hybrid search
+    (vector + keyword, optionally reranked) with the request's parameters and
+    packs the chunks into a token-budgeted context. CPU-bound and free of
+    database access. Returns (context, sources, query_vector, chunk_ids) for
+    the chunks that made it into the context.
+    """
+    from .embeddings import get_embedding_engine
+    from .retrieval import hybrid_search
+
+    query, pdf_name = params["query"], params["pdf_name"]
+
+    # Load the FAISS index for the client, reusing the copy cached in this process if unchanged
+    with span("query.index_load"):
+        faiss_index = _load_index_store(faiss_index_file)
+
+    # 1. Embed the query using Sentence Transformers
+    with span("query.embed"):
+        query_vector = get_embedding_engine().embed_query(query)
+
+    # 2. Verify dimensionality
+    if len(query_vector) != faiss_index.index.d:
+        raise QueryError(f"Dimensionality mismatch: Query vector has {len(query_vector)} dimensions, but FAISS index has {faiss_index.index.d} dimensions.")
+
+    # 3. Perform hybrid search (top-k across all documents in merged mode)
+    with span("query.search", rerank=params["rerank"]):
+        relevant_docs = hybrid_search(
+            faiss_index, _load_sparse_index(faiss_index_file, faiss_index), query, query_vector,
+            k=params["k"], candidates=params["candidates"],
+            vector_weight=params["vector_weight"], keyword_weight=params["keyword_weight"], rerank=params["rerank"],
+            nprobe=params["nprobe"], ef_search=params["ef_search"],
+        )
+
+    # 4. Pack the chunks into the context: within the token budget, deduplicated, in document order
+    with span("query.pack_context"):
+        context, packed_docs = pack_context(relevant_docs, pdf_name=pdf_name)
+    chunk_ids = [doc.id for doc in packed_docs]
+    sources = [
+        {"pdf_name": doc.metadata.get("source", pdf_name), "page": doc.metadata.get("page")}
+        for doc in packed_docs
+    ]
+    return context, sources, query_vector, chunk_ids
+
+
+def _record_user_turn(session_id, query, context):
+    # 5. Add the user's query to the conversation history (raw question and injected context kept apart)
+    history_writer.add(session_id, "user", query, context=context)
+
+
+def _record_cached_answer(session_id, query, context, answer):
+    """Stores both turns of a query answered from the semantic answer cache."""
+    _record_user_turn(session_id, query, context)
+    history_writer.add(session_id, "assistant", answer)
+
+
+def _lookup_cached_answer(scope, query_vector, chunk_ids):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    answer = answer_cache.get(scope, query_vector, chunk_ids)
+    registry.inc("answer_cache_requests_total", result="miss" if answer is None else "hit")
+    return answer
+
+
+def _build_messages(session_id, query, context):
+    """
+    Stores the user's turn and returns the message list for the LLM: the system
+    prompt, the token-budgeted history window (with the rolling summary) and the
+    current question with its retrieved context. The whole list is counted and
+    trimmed to LLM_PROMPT_MAX_TOKENS before it is sent.
+    Returns (messages, prompt_tokens).
+    """
+    # Fetch the bounded conversation history window from the database
+    with span("query.history"):
+        history = build_history_messages(session_id)
+        _record_user_turn(session_id, query, context)
+
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": format_user_prompt(query, context)})
+    messages, prompt_tokens = fit_messages(messages)
+    logger.info(f"Prompt for session {session_id}: {len(messages)} messages, {prompt_tokens} tokens")
+    return messages, prompt_tokens
+
 
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])  # Add Token Authentication
@@ -25,61 +216,36 @@ embedding_function = HuggingFaceEmbeddings(model_name="sentence-transformers/all
 def query_pdf(request):
     """
     Endpoint to handle user queries and return responses based on the indexed PDF.
+    When 'pdf_name' is omitted the query runs against every PDF the client owns,
+    using the client's merged index. Optional 'nprobe' (IVF indices) and
+    'ef_search' (HNSW indices) trade recall for speed per request; 'k',
+    'candidates', 'vector_weight', 'keyword_weight' and 'rerank' tune the hybrid
+    vector + keyword retrieval. Sources of the
+    retrieved chunks are returned in the 'X-Sources' response header.
     Supports conversation history and text streaming.
     """
-    # Input validation
-    if 'query' not in request.data or 'pdf_name' not in request.data or 'session_id' not in request.data:
-        return HttpResponseBadRequest("Missing 'query', 'pdf_name', or 'session_id' parameter.")
-
-    query = request.data['query']
-    pdf_name = request.data['pdf_name']
-    session_id = request.data['session_id']
-
     # Get the client_id from the authenticated user
     client_id = str(request.user.id)  # Use the authenticated user's ID as the client ID
 
     try:
-        # Fetch the PDF document from the database
-        pdf_document = PDFDocument.objects.filter(client_id=client_id, pdf_name=pdf_name).first()
-        if not pdf_document:
-            logger.info(f"No PDF document found for client_id={client_id}, pdf_name={pdf_name}")
-            return JsonResponse({
-                "error": "No PDF document found. Please upload a PDF file first."
-            }, status=404)
-
-        faiss_index_file = pdf_document.file_path
-
-        if not os.path.exists(faiss_index_file):
-            logger.error(f"FAISS index not found at {faiss_index_file}")
-            return JsonResponse({
-                "error": "FAISS index not found. Please generate the index for the uploaded PDF."
-            }, status=404)
-
-        # Load the FAISS index dynamically for the client
-        faiss_index = FAISS.load_local(faiss_index_file, embedding_function, allow_dangerous_deserialization=True)
-        logger.info(f"FAISS index loaded successfully for client_id={client_id}, pdf_name={pdf_name}")
-
-        # 1. Embed the query using Sentence Transformers
-        query_vector = embedding_function.embed_query(query)
-
-        # 2. Verify dimensionality
-        if len(query_vector) != faiss_index.index.d:
-            return JsonResponse({
-                "error": f"Dimensionality mismatch: Query vector has {len(query_vector)} dimensions, but FAISS index has {faiss_index.index.d} dimensions."
-            }, status=500)
-
-        # 3. Perform similarity search
-        relevant_docs = faiss_index.similarity_search_by_vector(query_vector, k=3)
-
-        # 4. Combine the relevant chunks into a single context
-        context = "\n".join([doc.page_content for doc in relevant_docs])
-
-        # 5. Add the user's query to the conversation history
-        ConversationHistory.objects.create(
-            session_id=session_id,
-            role="user",
-            content=f"Context: {context}\n\nQuestion: {query}\n\nAnswer:"
-        )
+        # Input validation
+        params = _parse_query_params(request.data)
+        session_id = params["session_id"]
+
+        with span("query.db_lookup"):
+            faiss_index_file = _resolve_index_path(client_id, params["pdf_name"])
+        context, sources, query_vector, chunk_ids = _retrieve(faiss_index_file, params)
+        logger.info(f"Retrieved context for client_id={client_id}, pdf_name={params['pdf_name'] or '<all>'}")
+
+        # Serve a near-identical question over the same chunks from the semantic answer cache
+        cache_scope = (client_id, faiss_index_file)
+        cached_answer = _lookup_cached_answer(cache_scope, query_vector, chunk_ids)
+        if cached_answer is not None:
+            _record_cached_answer(session_id, params["query"], context, cached_answer)
+            response = StreamingHttpResponse(iter([cached_answer]), content_type="text/plain")
+            response["X-Sources"] = json.dumps(sources)
+            response["X-Answer-Cache"] = "hit"
+            return response
 
         # 6. Send the query and context to OpenAI with streaming
         openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -87,17 +253,16 @@ def query_pdf(request):
             return JsonResponse({"error": "OpenAI API key not found."}, status=500)
 
         # Set the OpenAI API key
+        import openai
+
         openai.api_key = openai_api_key
 
-        # Fetch conversation history from the database
-        conversation_history = ConversationHistory.objects.filter(session_id=session_id).order_by('timestamp')
-        messages = [{"role": "system", "content": "You are a helpful assistant."}]
-        for entry in conversation_history:
-            messages.append({"role": entry.role, "content": entry.content})
+        messages, prompt_tokens = _build_messages(session_id, params["query"], context)
 
         # Use the new OpenAI API format with streaming
+        llm_started = time.perf_counter()
         response_stream = openai.chat.completions.create(
-            model="gpt-3.5-turbo",  # Use a valid model
+            model=settings.LLM_MODEL,
             messages=messages,
             max_tokens=512,
             temperature=0.5,
@@ -107,21 +272,219 @@ def query_pdf(request):
         # 7. Stream the response back to the client
         def generate():
             full_response = ""
+            first_token_at = None
             for chunk in response_stream:
                 if chunk.choices[0].delta.content:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        record_span("query.llm_first_token", first_token_at - llm_started)
                     chunk_content = chunk.choices[0].delta.content
                     full_response += chunk_content
                     yield chunk_content
+            if first_token_at is not None:
+                record_span("query.stream", time.perf_counter() - first_token_at)
 
-            # Add the assistant's response to the conversation history
-            ConversationHistory.objects.create(
-                session_id=session_id,
-                role="assistant",
-                content=full_response
-            )
+            # Add the assistant's response to the conversation history (queued, see HistoryWriter)
+            history_writer.add(session_id, "assistant", full_response)
+            if settings.ANSWER_CACHE_ENABLED:
+                answer_cache.put(cache_scope, query_vector, chunk_ids, full_response)
 
-        return StreamingHttpResponse(generate(), content_type="text/plain")
+        response = StreamingHttpResponse(generate(), content_type="text/plain")
+        response["X-Sources"] = json.dumps(sources)
+        response["X-Answer-Cache"] = "miss"
+        response["X-Prompt-Tokens"] = str(prompt_tokens)
+        return response
 
+    except QueryError as e:
+        if e.status == 400:
+            return HttpResponseBadRequest(e.message)
+        return JsonResponse({"error": e.message}, status=e.status)
     except Exception as e:
         logger.error(f"An unexpected error occurred: {str(e)}", exc_info=True)  # Log the full traceback
-        return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
\ No newline at end of file
+        return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
+
+
+def _get_query_executor():
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = ThreadPoolExecutor(max_workers=settings.QUERY_THREAD_POOL_SIZE, thread_name_prefix="query")
+    return _query_executor
+
+
+def _get_async_openai_client(api_key):
+    import openai
+
+    global _async_openai_client
+    if _async_openai_client is None or _async_openai_client.api_key != api_key:
+        _async_openai_client = openai.AsyncOpenAI(api_key=api_key)
+    return _async_openai_client
+
+
+def _create_sync_completion(api_key, completion_args):
+    """Starts a streamed completion with the sync OpenAI client, as query_pdf does."""
+    import openai
+
+    openai.api_key = api_key
+    return openai.chat.completions.create(**completion_args)
+
+
+def _authenticate_token(request):
+    """Runs DRF token authentication on a plain Django request; returns the user or None."""
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def _sse_event(event, data):
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@csrf_exempt
+@require_POST
+async def query_pdf_stream(request):
+    """
+    Async version of query_pdf, streamed as Server-Sent Events.
+
+    Accepts the same JSON body and token authentication as query_pdf. Database
+    access runs through Django's async ORM bridge, embedding and FAISS search run
+    on a dedicated thread pool, and the answer is streamed from the async OpenAI
+    client, so under ASGI an in-flight answer does not hold a worker thread.
+    Under WSGI (gunicorn gthread, the default) the answer is read from the sync
+    client by a plain generator instead, since a WSGI server would otherwise
+    collect an async stream whole before sending it. Emits a 'sources' event,
+    one 'token' event per content delta, then 'done' (or 'error').
+    """
+    is_asgi = isinstance(request, ASGIRequest)
+    user = await sync_to_async(_authenticate_token)(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    client_id = str(user.id)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return HttpResponseBadRequest("Request body must be valid JSON.")
+
+    try:
+        params = _parse_query_params(data)
+        session_id = params["session_id"]
+
+        with span("query.db_lookup"):
+            faiss_index_file = await sync_to_async(_resolve_index_path)(client_id, params["pdf_name"])
+        loop = asyncio.get_running_loop()
+        context, sources, query_vector, chunk_ids = await loop.run_in_executor(
+            _get_query_executor(), _retrieve, faiss_index_file, params,
+        )
+
+        cache_scope = (client_id, faiss_index_file)
+        cached_answer = _lookup_cached_answer(cache_scope, query_vector, chunk_ids)
+        if cached_answer is not None:
+            await sync_to_async(_record_cached_answer)(session_id, params["query"], context, cached_answer)
+            cached_events = [
+                _sse_event("sources", sources),
+                _sse_event("token", {"content": cached_answer, "cached": True}),
+                _sse_event("done", {}),
+            ]
+
+            async def cached_event_stream():
+                for event in cached_events:
+                    yield event
+
+            response = StreamingHttpResponse(cached_event_stream() if is_asgi else cached_events, content_type="text/event-stream")
+            response["Cache-Control"] = "no-cache"
+            response["X-Answer-Cache"] = "hit"
+            return response
+
+        openai_api_key = os.getenv("OPENAI_API_KEY")
+        if not openai_api_key:
+            return JsonResponse({"error": "OpenAI API key not found."}, status=500)
+
+        messages, prompt_tokens = await sync_to_async(_build_messages)(session_id, params["query"], context)
+        completion_args = dict(model=settings.LLM_MODEL, messages=messages, max_tokens=512, temperature=0.5, stream=True)
+        llm_started = time.perf_counter()
+        if is_asgi:
+            response_stream = await _get_async_openai_client(openai_api_key).chat.completions.create(**completion_args)
+        else:
+            response_stream = await sync_to_async(_create_sync_completion)(openai_api_key, completion_args)
+    except QueryError as e:
+        if e.status == 400:
+            return HttpResponseBadRequest(e.message)
+        return JsonResponse({"error": e.message}, status=e.status)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {str(e)}", exc_info=True)  # Log the full traceback
+        return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
+
+    full_response = []
+    first_token_at = None
+
+    def token_event(chunk):
+        nonlocal first_token_at
+        if not (chunk.choices and chunk.choices[0].delta.content):
+            return None
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+            record_span("query.llm_first_token", first_token_at - llm_started)
+        full_response.append(chunk.choices[0].delta.content)
+        return _sse_event("token", {"content": chunk.choices[0].delta.content})
+
+    def error_event(e):
+        logger.error(f"Error while streaming the answer: {str(e)}", exc_info=True)
+        return _sse_event("error", {"error": str(e)})
+
+    def finish_answer():
+        if first_token_at is not None:
+            record_span("query.stream", time.perf_counter() - first_token_at)
+        if settings.ANSWER_CACHE_ENABLED:
+            answer_cache.put(cache_scope, query_vector, chunk_ids, "".join(full_response))
+
+    def sync_event_stream():
+        yield _sse_event("sources", sources)
+        try:
+            for chunk in response_stream:
+                if (event := token_event(chunk)) is not None:
+                    yield event
+        except Exception as e:
+            yield error_event(e)
+            return
+        # Add the assistant's response to the conversation history (queued, see HistoryWriter)
+        history_writer.add(session_id, "assistant", "".join(full_response))
+        finish_answer()
+        yield _sse_event("done", {})
+
+    async def event_stream():
+        yield _sse_event("sources", sources)
+        try:
+            async for chunk in response_stream:
+                if (event := token_event(chunk)) is not None:
+                    yield event
+        except Exception as e:
+            yield error_event(e)
+            return
+        await history_writer.aadd(session_id, "assistant", "".join(full_response))
+        finish_answer()
+        yield _sse_event("done", {})
+
+    response = StreamingHttpResponse(event_stream() if is_asgi else sync_event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Answer-Cache"] = "miss"
+    response["X-Prompt-Tokens"] = str(prompt_tokens)
+    response["X-Accel-Buffering"] = "no"  # Disable proxy buffering so events are delivered immediately
+    return response
+
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus scrape endpoint: stage timings, request latencies and counters
+    summed over every API and Celery process writing to METRICS_DIR. When
+    METRICS_AUTH_TOKEN is set, requests must send it as a Bearer token.
+    """
+    if settings.METRICS_AUTH_TOKEN:
+        expected = f"Bearer {settings.METRICS_AUTH_TOKEN}"
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return JsonResponse({"detail": "Invalid metrics token."}, status=401)
+    counters, histograms = registry.collect()
+    return HttpResponse(render_prometheus(counters, histograms), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,102 @@
+# warmup.py
+import gc
+import importlib
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from .index_cache import index_cache
+from .index_store import IndexStore, has_index_store
+from .models import PDFDocument
+from .sparse_index import SPARSE_DIR, SparseIndex
+
+logger = logging.getLogger(__name__)
+
+# Imported on first use by the views and tasks; preloading them shares their pages between workers
+PRELOAD_MODULES = (
+    'openai',
+    'faiss',
+    'langchain_core.documents',
+    'query_app.embeddings',
+    'query_app.retrieval',
+    'uploadfile.pdf_processing',
+    'uploadfile.tasks',
+)
+
+
+def _hot_index_paths(count):
+    """Indices of the `count` most recently added PDFs, followed by their clients' merged indices."""
+    paths, clients = [], []
+    for client_id, file_path in PDFDocument.objects.order_by('-id').values_list('client_id', 'file_path')[:count]:
+        paths.append(file_path)
+        if client_id not in clients:
+            clients.append(client_id)
+    paths += [os.path.join(settings.FAISS_MERGED_INDICES_DIR, f'client_{client_id}') for client_id in clients]
+    return paths
+
+
+def warmup(embedding_model=None, indices=None):
+    """
+    Loads what the first requests and tasks would otherwise load, for a parent
+    process about to fork its workers (gunicorn --preload, Celery prefork):
+    the heavy modules, the embedding model (unless `embedding_model` is False;
+    default WARMUP_EMBEDDING_MODEL) and the indices of the `indices` most
+    recently added PDFs (default WARMUP_INDEX_COUNT) into the index cache.
+    Forked workers then share these pages copy-on-write.
+
+    Objects are moved out of the garbage collector's reach (gc.freeze) so that
+    collections in the workers do not write to, and so copy, the shared pages.
+    Database connections, and a Postgres connection pool with its threads, are
+    closed: a forked worker must open its own.
+    The model runs no forward pass here, since thread pools started by
+    torch, tokenizers or ONNX Runtime do not survive fork; an ONNX Runtime
+    session is not created either (each worker opens its own), only the
+    export is made if missing.
+    """
+    embedding_model = settings.WARMUP_EMBEDDING_MODEL if embedding_model is None else embedding_model
+    indices = settings.WARMUP_INDEX_COUNT if indices is None else indices
+    started = time.perf_counter()
+
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+    if embedding_model:
+        from .embedding_backends import ONNX_CONFIG_FILE, export_onnx_model, onnx_model_dir
+        from .embeddings import get_embedding_engine
+
+        engine = get_embedding_engine()
+        if engine.backend == 'onnx-int8':
+            directory = onnx_model_dir(engine.model_name)
+            if not os.path.exists(os.path.join(directory, ONNX_CONFIG_FILE)):
+                export_onnx_model(engine.model_name, directory)
+        else:
+            engine._get_model()
+
+    loaded = 0
+    try:
+        for index_path in _hot_index_paths(indices) if indices else []:
+            if not has_index_store(index_path):
+                continue
+            try:
+                index_cache.get(index_path, lambda: IndexStore.load(index_path))
+                if os.path.isdir(os.path.join(index_path, SPARSE_DIR)):
+                    index_cache.get(os.path.join(index_path, SPARSE_DIR), lambda: SparseIndex.load(index_path))
+                loaded += 1
+            except Exception as e:
+                logger.warning(f"Could not preload index {index_path}: {str(e)}")
+                continue
+            if index_cache.stats()["bytes"] >= index_cache.max_bytes:
+                break  # Further indices would only evict these
+    finally:
+        connections.close_all()
+        for connection in connections.all(initialized_only=True):
+            if connection.settings_dict['OPTIONS'].get('pool'):
+                connection.close_pool()
+
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Warmed up in {time.perf_counter() - started:.2f}s: embedding model {'loaded' if embedding_model else 'skipped'}, "
+                f"{loaded} indices preloaded (pid {os.getpid()})")
@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import UploadSession
 
-# Register your models here.
+# Register the UploadSession model
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('pdf_name', 'client_id', 'received_bytes', 'total_size', 'status', 'updated_at')
+    search_fields = ('client_id', 'pdf_name')
+    list_filter = ('status',)
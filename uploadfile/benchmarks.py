@@ -0,0 +1,370 @@
+# benchmarks.py
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from rest_framework.authtoken.models import Token
+
+from query_app.embedding_backends import load_backend
+from query_app.embeddings import PrecomputedEmbeddings, get_embedding_engine
+from query_app.index_cache import index_cache
+from query_app.index_store import IndexStore
+from query_app.models import PDFDocument
+from query_app.sparse_index import SparseIndex
+from .chunking import get_chunker
+from .pdf_processing import add_to_vector_store_and_generate_vectors, convert_to_documents, process_documents, read_pdf, read_pdf_pages
+
+_WORDS = (
+    "agreement warranty customer payment invoice delivery service period notice liability "
+    "termination clause schedule supplier contract renewal refund receipt product support "
+    "data security access report audit fee credit obligation party term effective date"
+).split()
+
+
+def make_pdf(path, pages, lines_per_page=40, seed=0):
+    """Writes a synthetic PDF of `pages` pages: a numbered heading, then lines of sentence-like text."""
+    rng = random.Random(seed)
+    pdf = canvas.Canvas(path, pagesize=letter)
+    for page in range(1, pages + 1):
+        y = 750
+        pdf.drawString(72, y, f"{page}. {rng.choice(_WORDS).upper()} {rng.choice(_WORDS).upper()}")
+        for _ in range(lines_per_page):
+            y -= 17
+            words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 14))]
+            words[0] = words[0].capitalize()
+            pdf.drawString(72, y, " ".join(words) + rng.choice(".,;") + f" Ref AB-{rng.randint(1000, 9999)}.")
+        pdf.showPage()
+    pdf.save()
+
+
+def _rss_mb():
+    """Current resident set size in MB (Linux), falling back to the peak elsewhere."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if platform.system() == 'Darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def summarize(samples, items=None):
+    """
+    Latency percentiles (seconds) of `samples`, plus throughput when each run
+    processes `items` items, and the process memory after the runs.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    summary = {
+        "runs": len(samples),
+        "mean": float(samples.mean()),
+        "min": float(samples.min()),
+        "max": float(samples.max()),
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "rss_mb": round(_rss_mb(), 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+    if items:
+        summary["items"] = items
+        summary["items_per_second"] = float(items / summary["p50"]) if summary["p50"] else None
+    return summary
+
+
+def _time(fn, repeat):
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+class _StubLLMHandler(BaseHTTPRequestHandler):
+    """Answers /chat/completions like the OpenAI API, streaming `tokens` chunks `delay` seconds apart."""
+
+    tokens = 50
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i in range(self.tokens):
+            if self.delay:
+                time.sleep(self.delay)
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "stub",
+                     "choices": [{"index": 0, "delta": {"content": f"word{i} "}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMServer:
+    """A local OpenAI-compatible streaming server, so query benchmarks exclude the real LLM."""
+
+    def __init__(self, tokens=50, token_delay_ms=0.0, host='127.0.0.1', port=0):
+        handler = type('Handler', (_StubLLMHandler,), {"tokens": tokens, "delay": token_delay_ms / 1000.0})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.base_url = f"http://{host}:{self.server.server_address[1]}/v1/"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name="stub-llm", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def benchmark_embedding_backends(texts, backends, repeat=5, model_name=None, batch_size=None):
+    """
+    Embeds `texts` with each named embedding backend and returns a stage per
+    backend: throughput, the RSS growth from loading it, and its parity with the
+    first backend (lowest cosine similarity over the texts). Backends are
+    loaded one after the other in this process, so the RSS growth of the first
+    includes the libraries the others share.
+    """
+    model_name = model_name or settings.EMBEDDING_MODEL_NAME
+    batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+    stages, reference = {}, None
+    for backend in backends:
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        model = load_backend(backend, model_name, batch_size=batch_size, threads=settings.EMBEDDING_THREADS)
+        load_seconds = time.perf_counter() - start
+        rss_loaded = _rss_mb()
+        model.embed_documents(texts[:8])  # Warm up outside the timed runs
+        samples, vectors = _time(lambda: model.embed_documents(texts), repeat)
+        summary = summarize(samples, items=len(texts))
+        summary.update(load_seconds=load_seconds, load_rss_mb=round(rss_loaded - rss_before, 1))
+        vectors = np.asarray(vectors, dtype=np.float64)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if reference is None:
+            reference = vectors
+        summary["min_cosine_vs_" + backends[0]] = float((vectors * reference).sum(axis=1).min())
+        samples, _ = _time(lambda: model.embed_documents([texts[0]]), repeat * 10)
+        stages[f"embed_documents[{backend}]"] = summary
+        stages[f"embed_query[{backend}]"] = summarize(samples)
+        del model
+    return stages
+
+
+def run_benchmarks(pages=50, repeat=5, queries=50, llm_tokens=50, llm_token_delay_ms=0.0, embedding_backends=(), log=print):
+    """
+    Runs every benchmark on a synthetic PDF of `pages` pages and returns the results:
+    read_pdf, process_documents, embedding throughput, index build and save, index
+    load, and query_pdf end to end against a local stub LLM. Ingest stages run
+    `repeat` times; the query stage issues `queries` requests. When
+    `embedding_backends` names several backends, their throughput and parity
+    are compared on the same chunks.
+    """
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    stages = {}
+    try:
+        pdf_path = os.path.join(work_dir, 'synthetic.pdf')
+        make_pdf(pdf_path, pages)
+
+        log(f"read_pdf ({pages} pages)")
+        def read():
+            with open(pdf_path, 'rb') as file:
+                return read_pdf(file)
+        samples, _ = _time(read, repeat)
+        stages["read_pdf"] = summarize(samples, items=pages)
+
+        log("process_documents")
+        with open(pdf_path, 'rb') as file:
+            pages_text = list(read_pdf_pages(file))
+        samples, chunks = _time(lambda: process_documents(convert_to_documents(pages_text), chunker=get_chunker()), repeat)
+        stages["process_documents"] = summarize(samples, items=len(chunks))
+
+        log(f"embedding ({len(chunks)} chunks)")
+        engine = get_embedding_engine()
+        texts = [chunk.page_content for chunk in chunks]
+        cache, engine.cache = engine.cache, None  # Time the model, not the embedding cache
+        try:
+            engine.embed_documents(texts[:8])  # Load the model outside the timed runs
+            samples, vectors = _time(lambda: engine.embed_documents(texts), repeat)
+            stages["embed_documents"] = summarize(samples, items=len(texts))
+            samples, _ = _time(lambda: engine.embed_documents([texts[0]]), repeat * 10)
+            stages["embed_query"] = summarize(samples)
+        finally:
+            engine.cache = cache
+        if embedding_backends:
+            log(f"embedding backends ({', '.join(embedding_backends)})")
+            stages.update(benchmark_embedding_backends(texts, list(embedding_backends), repeat))
+
+        log("index build and save")
+        precomputed = PrecomputedEmbeddings(texts, vectors, engine)
+        runs = iter(range(repeat))
+        samples, _ = _time(lambda: add_to_vector_store_and_generate_vectors(chunks, 'bench', f'run{next(runs)}.pdf', work_dir, embedding=precomputed), repeat)
+        stages["index_build_save"] = summarize(samples, items=len(chunks))
+        index_path = os.path.join(work_dir, 'client_bench', 'run0.pdf')
+
+        log("index load")
+        samples, _ = _time(lambda: (IndexStore.load(index_path), SparseIndex.load(index_path)), repeat * 4)
+        stages["index_load"] = summarize(samples)
+
+        log(f"query_pdf ({queries} requests)")
+        stages.update(_benchmark_queries(index_path, texts, queries, llm_tokens, llm_token_delay_ms))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"pages": pages, "repeat": repeat, "queries": queries, "llm_tokens": llm_tokens, "llm_token_delay_ms": llm_token_delay_ms,
+                   "embedding_model": settings.EMBEDDING_MODEL_NAME,
+                   "embedding_backend": settings.EMBEDDING_BACKEND, "chunking_strategy": settings.CHUNKING_STRATEGY},
+        "stages": stages,
+    }
+
+
+def _benchmark_queries(index_path, texts, queries, llm_tokens, llm_token_delay_ms):
+    """Times POST /query/ through the full Django stack; rows it writes (synchronously) are rolled back."""
+    rng = random.Random(1)
+    first_chunk, total = [], []
+    setup_test_environment()  # Allows the test client's host name
+    previous_env = {name: os.environ.get(name) for name in ('OPENAI_BASE_URL', 'OPENAI_API_KEY')}
+    previous_base_url = openai.base_url
+    try:
+        with StubLLMServer(llm_tokens, llm_token_delay_ms) as llm, override_settings(ANSWER_CACHE_ENABLED=False, HISTORY_WRITE_MODE='sync'), transaction.atomic():
+            os.environ['OPENAI_BASE_URL'] = llm.base_url
+            os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+            openai.base_url = llm.base_url
+
+            user = User.objects.create_user(username=f"benchmark-{time.time_ns()}")
+            token = Token.objects.create(user=user)
+            PDFDocument.objects.create(client_id=str(user.id), pdf_name='synthetic.pdf', file_path=index_path)
+            client = Client(HTTP_AUTHORIZATION=f"Token {token.key}")
+            for i in range(queries + 1):
+                words = rng.choice(texts).split()
+                body = {"query": " ".join(words[:12]) + "?", "pdf_name": "synthetic.pdf", "session_id": f"benchmark-{i % 10}"}
+                start = time.perf_counter()
+                response = client.post('/query/', body, content_type='application/json')
+                if response.status_code != 200:
+                    raise RuntimeError(f"/query/ returned {response.status_code}: {response.content[:200]!r}")
+                stream = iter(response.streaming_content)
+                next(stream)
+                first = time.perf_counter()
+                for _ in stream:
+                    pass
+                if i:  # The first request warms the index cache and HTTP connection
+                    first_chunk.append(first - start)
+                    total.append(time.perf_counter() - start)
+            transaction.set_rollback(True)
+    finally:
+        teardown_test_environment()
+        index_cache.clear()
+        openai.base_url = previous_base_url
+        for name, value in previous_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    return {"query_first_chunk": summarize(first_chunk), "query_total": summarize(total)}
+
+
+def run_load_test(base_url, token, pdf_name=None, path='/query/', concurrency=8, total=200, warmup=None, timeout=300, log=print):
+    """
+    Sends `total` query requests to a running server from `concurrency`
+    threads (after `warmup` untimed ones, default one per thread) and returns
+    throughput and the latency percentiles of the first body chunk and of the
+    whole streamed answer. Point the server at a stub LLM (manage.py stub_llm)
+    so the model's latency does not dominate.
+    """
+    rng = random.Random(2)
+    url = base_url.rstrip('/') + path
+    headers = {"Authorization": f"Token {token}"}
+    local = threading.local()
+
+    def send(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        body = {"query": " ".join(rng.choice(_WORDS) for _ in range(8)) + "?", "session_id": f"loadtest-{i % 50}"}
+        if pdf_name:
+            body["pdf_name"] = pdf_name
+        start = time.perf_counter()
+        with session.post(url, json=body, headers=headers, stream=True, timeout=timeout) as response:
+            chunks = response.iter_content(chunk_size=None)
+            next(chunks, None)
+            first = time.perf_counter()
+            for _ in chunks:
+                pass
+            return response.status_code, first - start, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(concurrency if warmup is None else warmup)))
+        log(f"{total} requests to {url}, {concurrency} concurrent")
+        start = time.perf_counter()
+        results = list(executor.map(send, range(total)))
+        duration = time.perf_counter() - start
+
+    errors = [status for status, _, _ in results if status != 200]
+    timed = [(first, whole) for status, first, whole in results if status == 200] or [(0.0, 0.0)]
+    client_memory = ("rss_mb", "peak_rss_mb")  # The load generator's, not the server's
+    return {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "url": url,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": len(errors),
+        "error_statuses": sorted(set(errors)),
+        "duration": duration,
+        "requests_per_second": (total - len(errors)) / duration if duration else None,
+        "first_chunk": {key: value for key, value in summarize([first for first, _ in timed]).items() if key not in client_memory},
+        "total": {key: value for key, value in summarize([whole for _, whole in timed]).items() if key not in client_memory},
+    }
+
+
+def compare_results(baseline, current, threshold=1.2):
+    """
+    Compares the p50 and p95 of each stage present in both result sets.
+    Returns rows of (stage, metric, baseline, current, ratio, regressed), where
+    `regressed` marks a ratio above `threshold`.
+    """
+    rows = []
+    for stage, summary in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before:
+            continue
+        for metric in ("p50", "p95"):
+            ratio = summary[metric] / before[metric] if before[metric] else float('inf')
+            rows.append((stage, metric, before[metric], summary[metric], ratio, ratio > threshold))
+    return rows
@@ -0,0 +1,150 @@
+# chunking.py
+import re
+from collections import deque
+
+from django.conf import settings
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from query_app.tokens import count_tokens_many, split_tokens
+
+_WORD_RE = re.compile(r"\S+")
+_LINE_RE = re.compile(r"[^\n]*\n?")
+# A sentence runs to terminal punctuation (plus closing quotes/brackets) followed by whitespace, or to the end
+_SENTENCE_RE = re.compile(r"\S.*?(?:[.!?]+[\"')\]]*(?=\s)|\Z)", re.S)
+# Markdown headings, numbered headings ("2.1 Scope", "IV. Terms") and all-caps lines, not ending like a sentence
+_HEADING_RE = re.compile(r"(?:#{1,6}\s+\S.*|(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.)\s+[A-Z]\S*(?:\s+\S+){0,6}|[^a-z\n]*[A-Z]{2}[^a-z\n]*)(?<![.,;:!?])")
+_HEADING_MAX_CHARS = 80
+
+
+class CharacterChunker:
+    """The original splitter: recursive separators on a character budget."""
+
+    def __init__(self, chunk_size=550, chunk_overlap=50):
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+
+    def split(self, document):
+        return self.splitter.split_documents([document])
+
+
+class TokenChunker:
+    """
+    Packs the text into chunks of at most `chunk_tokens` tokens (see
+    query_app.tokens), breaking only between words. Consecutive chunks share
+    up to `overlap_tokens` tokens of trailing segments.
+
+    Splitting is a single pass: the text is cut into segments once, each
+    segment is tokenized once (in one batch), and segments are packed
+    greedily. A chunk is a slice of the original text, so spacing is kept.
+    Every chunk records its token count in metadata["tokens"] and its offset
+    in the page text in metadata["start_index"] (as LangChain's splitters do).
+    """
+
+    def __init__(self, chunk_tokens=None, overlap_tokens=None):
+        self.chunk_tokens = chunk_tokens or settings.CHUNK_TOKENS
+        self.overlap_tokens = settings.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        if not 0 <= self.overlap_tokens < self.chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.section = None  # Heading the text being split falls under
+
+    def _segments(self, text):
+        """Yields (start, end, is_heading) spans of `text`, in order."""
+        for match in _WORD_RE.finditer(text):
+            yield match.start(), match.end(), False
+
+    def split(self, document):
+        text = document.page_content
+        spans = list(self._segments(text))
+        counts = count_tokens_many(text[start:end] for start, end, _ in spans)
+
+        chunks = []
+        window = deque()  # (start, end, tokens) of the segments in the open chunk
+        window_tokens = 0
+        has_body = False  # Whether the open chunk holds more than headings
+
+        def emit(content, start, tokens):
+            metadata = dict(document.metadata, start_index=start, tokens=tokens)
+            if self.section:
+                metadata["section"] = self.section
+            chunks.append(Document(page_content=content, metadata=metadata))
+
+        def flush(keep_overlap):
+            nonlocal window_tokens, has_body
+            if window:
+                emit(text[window[0][0]:window[-1][1]], window[0][0], window_tokens)
+            has_body = False
+            if not keep_overlap:
+                window.clear()
+                window_tokens = 0
+            while window and window_tokens > self.overlap_tokens:  # Keep the trailing segments that fit in the overlap
+                window_tokens -= window.popleft()[2]
+
+        for (start, end, is_heading), tokens in zip(spans, counts):
+            if is_heading:
+                if has_body:
+                    flush(keep_overlap=False)  # A new section never continues the previous one
+                self.section = text[start:end].lstrip("# ")
+            if tokens > self.chunk_tokens:
+                flush(keep_overlap=False)
+                for piece in split_tokens(text[start:end], self.chunk_tokens):
+                    emit(piece, start, count_tokens_many([piece])[0])
+                    start += len(piece)
+                continue
+            if window_tokens + tokens > self.chunk_tokens:
+                flush(keep_overlap=True)
+                while window and window_tokens + tokens > self.chunk_tokens:
+                    window_tokens -= window.popleft()[2]
+            window.append((start, end, tokens))
+            window_tokens += tokens
+            has_body = has_body or not is_heading
+        if has_body or not chunks:  # Headings alone (e.g. at the foot of a page) are not a chunk
+            flush(keep_overlap=False)
+        return chunks
+
+
+class StructureChunker(TokenChunker):
+    """
+    A TokenChunker that breaks only between sentences and starts a new chunk at
+    every heading. Chunks record the heading they fall under in
+    metadata["section"]; the section carries over from one page to the next,
+    so use one instance per PDF.
+    """
+
+    def _segments(self, text):
+        run_start = run_end = None
+        for line in _LINE_RE.finditer(text):
+            stripped = line.group().strip()
+            if stripped and not (len(stripped) <= _HEADING_MAX_CHARS and _HEADING_RE.fullmatch(stripped)):
+                if run_start is None:
+                    run_start = line.start()
+                run_end = line.end()
+                continue
+            if run_start is not None:  # A blank line or heading ends the paragraph
+                for sentence in _SENTENCE_RE.finditer(text, run_start, run_end):
+                    yield sentence.start(), sentence.end(), False
+                run_start = None
+            if stripped:
+                start = line.start() + len(line.group()) - len(line.group().lstrip())
+                yield start, start + len(stripped), True
+            if not line.group():
+                break
+
+
+CHUNKERS = {
+    'characters': CharacterChunker,
+    'tokens': TokenChunker,
+    'structure': StructureChunker,
+}
+
+
+def get_chunker(client_id=None):
+    """
+    Returns the chunker configured for `client_id`: CHUNKING_STRATEGY with its
+    default sizes, unless CHUNKING_CLIENT_OVERRIDES has an entry for the client
+    ({"strategy": ..., plus keyword arguments of that chunker}).
+    """
+    config = dict(settings.CHUNKING_CLIENT_OVERRIDES.get(str(client_id), {})) if client_id is not None else {}
+    strategy = config.pop('strategy', settings.CHUNKING_STRATEGY)
+    if strategy not in CHUNKERS:
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
+    return CHUNKERS[strategy](**config)
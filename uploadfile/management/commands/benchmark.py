@@ -0,0 +1,59 @@
+# benchmark.py
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from uploadfile.benchmarks import compare_results, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the ingest and query hot paths on a synthetic PDF and stores the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=50, help="Pages in the synthetic PDF")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per ingest stage")
+        parser.add_argument('--queries', type=int, default=50, help="Requests sent to /query/")
+        parser.add_argument('--llm-tokens', type=int, default=50, help="Chunks streamed by the stub LLM per answer")
+        parser.add_argument('--llm-token-delay-ms', type=float, default=0.0, help="Delay of the stub LLM between chunks")
+        parser.add_argument('--embedding-backends', default='', help="Comma-separated embedding backends to compare, e.g. torch,torch-int8,onnx-int8")
+        parser.add_argument('--output', help="Results file (default: BENCHMARK_RESULTS_DIR/<timestamp>.json)")
+        parser.add_argument('--compare', help="Earlier results file to compare against")
+        parser.add_argument('--threshold', type=float, default=1.2, help="Fail when a p50/p95 grows by more than this factor")
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(
+            pages=options['pages'], repeat=options['repeat'], queries=options['queries'],
+            llm_tokens=options['llm_tokens'], llm_token_delay_ms=options['llm_token_delay_ms'],
+            embedding_backends=[backend for backend in options['embedding_backends'].split(',') if backend],
+            log=lambda message: self.stderr.write(f"Running {message}"),
+        )
+
+        output = options['output'] or os.path.join(settings.BENCHMARK_RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+        self.stdout.write(f"{'stage':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'items/s':>12}{'rss MB':>9}")
+        for stage, summary in results["stages"].items():
+            rate = summary.get("items_per_second")
+            self.stdout.write(
+                f"{stage:<28}{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}"
+                f"{(f'{rate:.1f}' if rate else '-'):>12}{summary['rss_mb']:>9.0f}"
+            )
+        for stage, summary in results["stages"].items():
+            parity = next((key for key in summary if key.startswith("min_cosine_vs_")), None)
+            if parity:
+                self.stdout.write(f"{stage}: loaded in {summary['load_seconds']:.1f}s (+{summary['load_rss_mb']:.0f} MB), {parity} {summary[parity]:.4f}")
+        self.stdout.write(f"Results written to {output}")
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                rows = compare_results(json.load(baseline_file), results, options['threshold'])
+            regressions = [row for row in rows if row[5]]
+            for stage, metric, before, after, ratio, regressed in rows:
+                self.stdout.write(f"{stage:<28}{metric:>4} {before * 1000:>9.1f} -> {after * 1000:>9.1f} ms  x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+            if regressions:
+                raise CommandError(f"{len(regressions)} measurements regressed by more than x{options['threshold']}")
@@ -0,0 +1,55 @@
+# build_merged_indices.py
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from query_app.index_store import has_index_store, read_chunk_ids
+from query_app.models import PDFDocument
+from uploadfile.pdf_processing import load_flat_vector_store, update_merged_index
+
+
+def _merged_pdf_names(merged_index_path):
+    """Returns the names of the PDFs that have chunks in a client's merged index."""
+    if not os.path.exists(os.path.join(merged_index_path, 'index.faiss')):
+        return set()
+    if has_index_store(merged_index_path):
+        ids = read_chunk_ids(merged_index_path)
+    else:
+        ids = load_flat_vector_store(merged_index_path).index_to_docstore_id.values()
+    return {merged_id.split('::', 1)[0] for merged_id in ids}
+
+
+class Command(BaseCommand):
+    help = "Adds PDFs indexed before merged indices existed to their client's merged index (cross-document search)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--client', help="Only this client id (default: every client)")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the PDFs that would be added")
+
+    def handle(self, *args, **options):
+        documents = PDFDocument.objects.order_by('client_id', 'id')
+        if options['client']:
+            documents = documents.filter(client_id=options['client'])
+
+        added = failed = 0
+        merged_names = {}
+        for document in documents.iterator():
+            merged_index_path = os.path.join(settings.FAISS_MERGED_INDICES_DIR, f'client_{document.client_id}')
+            if merged_index_path not in merged_names:
+                merged_names[merged_index_path] = _merged_pdf_names(merged_index_path)
+            if document.pdf_name in merged_names[merged_index_path]:
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"{document.client_id}: {document.pdf_name}")
+                continue
+            try:
+                # Takes the same lock as the ingest workers; vectors are copied, not re-embedded
+                update_merged_index(load_flat_vector_store(document.file_path), document.pdf_name, merged_index_path)
+                added += 1
+                self.stdout.write(f"Added {document.pdf_name} to {merged_index_path}")
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Could not add {document.pdf_name} to {merged_index_path}: {str(e)}")
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Added {added} PDFs to merged indices, {failed} failed"))
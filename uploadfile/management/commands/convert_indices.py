@@ -0,0 +1,37 @@
+# convert_indices.py
+import fcntl
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from query_app.index_store import LEGACY_DOCSTORE_FILE, has_index_store
+from uploadfile.pdf_processing import load_flat_vector_store, save_vector_store
+
+
+class Command(BaseCommand):
+    help = "Rewrites FAISS indices saved with a pickled docstore (index.pkl) in the native memory-mapped layout."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.FAISS_INDICES_DIR, help="Directory to scan (default: FAISS_INDICES_DIR)")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the indices that would be converted")
+
+    def handle(self, *args, **options):
+        converted = failed = 0
+        for index_path, _, files in os.walk(options['path']):
+            if LEGACY_DOCSTORE_FILE not in files or has_index_store(index_path):
+                continue
+            if options['dry_run']:
+                self.stdout.write(index_path)
+                continue
+            try:
+                with open(f"{index_path}.lock", 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)  # Same lock the ingest workers take for merged indices
+                    save_vector_store(load_flat_vector_store(index_path), index_path)
+                converted += 1
+                self.stdout.write(f"Converted {index_path}")
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Could not convert {index_path}: {str(e)}")
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Converted {converted} indices, {failed} failed"))
@@ -0,0 +1,17 @@
+# export_embedding_model.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from query_app.embedding_backends import export_onnx_model, onnx_model_dir
+
+
+class Command(BaseCommand):
+    help = "Exports the embedding model to int8 ONNX for EMBEDDING_BACKEND=onnx-int8 (run once, e.g. at image build)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=settings.EMBEDDING_MODEL_NAME, help="Model to export (default: EMBEDDING_MODEL_NAME)")
+        parser.add_argument('--output', help="Export directory (default: under EMBEDDING_ONNX_DIR)")
+
+    def handle(self, *args, **options):
+        directory = export_onnx_model(options['model'], options['output'] or onnx_model_dir(options['model']))
+        self.stdout.write(self.style.SUCCESS(f"Exported {options['model']} to {directory}"))
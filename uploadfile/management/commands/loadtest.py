@@ -0,0 +1,43 @@
+# loadtest.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from uploadfile.benchmarks import run_load_test
+
+
+class Command(BaseCommand):
+    help = "Measures query throughput and latency of a running server (runserver, gunicorn, ...) under concurrent load."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="Server base URL")
+        parser.add_argument('--path', default='/query/', help="Endpoint to load (/query/ or /query/stream/)")
+        parser.add_argument('--token', required=True, help="API token of a user with an uploaded PDF")
+        parser.add_argument('--pdf-name', help="PDF to query (default: the user's merged index)")
+        parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight")
+        parser.add_argument('--requests', type=int, default=200, help="Timed requests")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--compare', help="Earlier results file (e.g. from runserver) to compare against")
+
+    def handle(self, *args, **options):
+        results = run_load_test(
+            options['url'], options['token'], pdf_name=options['pdf_name'], path=options['path'],
+            concurrency=options['concurrency'], total=options['requests'],
+            log=lambda message: self.stderr.write(f"Running {message}"),
+        )
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+
+        self.stdout.write(f"{results['requests_per_second']:.1f} requests/s, {results['errors']} errors {results['error_statuses'] or ''}")
+        for name in ("first_chunk", "total"):
+            summary = results[name]
+            self.stdout.write(f"{name:<12} p50 {summary['p50'] * 1000:.0f} ms  p95 {summary['p95'] * 1000:.0f} ms  p99 {summary['p99'] * 1000:.0f} ms")
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            self.stdout.write(f"throughput x{results['requests_per_second'] / baseline['requests_per_second']:.2f} vs {options['compare']}, "
+                              f"p95 total x{results['total']['p95'] / baseline['total']['p95']:.2f}")
+        if results['errors'] == results['requests']:
+            raise CommandError("Every request failed")
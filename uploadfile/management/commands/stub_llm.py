@@ -0,0 +1,25 @@
+# stub_llm.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from uploadfile.benchmarks import StubLLMServer
+
+
+class Command(BaseCommand):
+    help = "Serves a local OpenAI-compatible streaming stub, for load tests that should exclude the real LLM."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on (0.0.0.0 inside Docker)")
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--tokens', type=int, default=50, help="Chunks streamed per answer")
+        parser.add_argument('--token-delay-ms', type=float, default=20.0, help="Delay between chunks")
+
+    def handle(self, *args, **options):
+        with StubLLMServer(options['tokens'], options['token_delay_ms'], host=options['host'], port=options['port']) as llm:
+            self.stdout.write(f"Stub LLM listening; start the server with OPENAI_BASE_URL={llm.base_url}")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
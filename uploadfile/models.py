@@ -1,3 +1,41 @@
+import os
+import uuid
+
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class UploadSession(models.Model):
+    """
+    A chunked, resumable PDF upload. Chunks are appended in order to a
+    `.part` file in TEMP_PDFS_DIR; `received_bytes` is the offset the next
+    chunk must start at, so an interrupted client can resume from there.
+    """
+    STATUS_OPEN = 'open'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [(STATUS_OPEN, 'Open'), (STATUS_COMPLETED, 'Completed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    client_id = models.CharField(max_length=255)
+    pdf_name = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    received_bytes = models.BigIntegerField(default=0)
+    checksum = models.CharField(max_length=64, blank=True)  # Optional SHA-256 of the whole file
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    task_id = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'updated_at'], name='upload_status_updated_idx')]
+
+    @property
+    def part_path(self):
+        return os.path.join(settings.TEMP_PDFS_DIR, f"{self.id}.part")
+
+    @property
+    def pdf_path(self):
+        return os.path.join(settings.TEMP_PDFS_DIR, f"{self.id}.pdf")
+
+    def __str__(self):
+        return f"{self.pdf_name} ({self.received_bytes}/{self.total_size}) - {self.status}"
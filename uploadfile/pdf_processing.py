@@ -1,72 +1,197 @@
 #pdf_processing.py
 import logging  # Import the logging module for structured logging
+import fcntl  # Import fcntl to serialize updates of a client's merged index across workers
+import hashlib  # Import hashlib for content-addressed file and chunk hashes
+import json  # Import json to record how each index was built
 import os  # Import the os module for operating system-related tasks like file path manipulation
+import time  # Import time to measure the chunking share of the extract stage
+from collections import deque  # Import deque to track in-flight page extraction jobs
+from concurrent.futures import ProcessPoolExecutor  # Import ProcessPoolExecutor to extract pages in parallel
+from itertools import chain, islice  # Import iterator helpers for the page streaming pipeline
+import faiss  # Import faiss to rebuild indices in memory as exact flat indices
+import numpy as np  # Import numpy for the raw vector sidecar files
 import PyPDF2  # Import the PyPDF2 library for reading and manipulating PDF files
 from langchain.docstore.document import Document  # Import the Document class from LangChain for representing documents
-from langchain.text_splitter import RecursiveCharacterTextSplitter  # Import the RecursiveCharacterTextSplitter for splitting text into chunks
 from langchain_community.vectorstores import FAISS  # Import FAISS for creating and managing vector stores
-from langchain_huggingface import HuggingFaceEmbeddings  # Import HuggingFaceEmbeddings for generating embeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore  # Import the in-memory docstore used while updating an index
+from query_app.embeddings import get_embedding_engine  # Import the shared embedding engine for generating embeddings
+from query_app.ann_index import build_index, can_extend  # Import the size-based ANN index builder
+from query_app.sparse_index import build_sparse_index  # Import the BM25 keyword index builder
+from query_app.index_store import IndexStore, has_index_store, index_generation, write_index_store  # Import the native (pickle-free) index layout
+from query_app.metrics import record_span, span  # Import the stage timers reported by /metrics
+from .chunking import get_chunker  # Import the configurable chunking strategies
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')  # Configure basic logging settings
 
-# Step 1: Read the PDF
-def read_pdf(file):
-    """Reads a PDF file and extracts the text."""
+# Step 0: Content hashes used to skip unchanged files and chunks
+def hash_file(path, block_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_ids(documents):
+    """
+    Returns a content-addressed id for each chunk: the SHA-256 of its text.
+
+    Repeated chunks within one document get an occurrence suffix ("<hash>-1", ...)
+    so every id stays unique while identical re-uploads produce identical ids.
+    """
+    seen = {}
+    ids = []
+    for document in documents:
+        digest = hashlib.sha256(document.page_content.encode('utf-8')).hexdigest()
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        ids.append(digest if occurrence == 0 else f"{digest}-{occurrence}")
+    return ids
+
+# Step 1: Read the PDF page by page
+def _open_reader(source):
+    """Opens a PdfReader and decrypts it with an empty password if needed."""
+    reader = PyPDF2.PdfReader(source)  # Create a PdfReader object to read the PDF file
+    if reader.is_encrypted:  # Check if the PDF is encrypted
+        name = getattr(source, 'name', source)
+        try:
+            reader.decrypt("")  # Attempt to decrypt the PDF with an empty password
+            logging.info(f"Successfully decrypted PDF: {name}") # Log successful decryption
+        except Exception as e:
+            logging.error(f"Cannot decrypt the PDF {name}: {str(e)}") # Log decryption failure
+            raise ValueError(f"Cannot decrypt the PDF {name}: {str(e)}") # Raise a ValueError if decryption fails
+    return reader
+
+def _extract_page_text(reader, page_num):
+    """Extracts the text of a single page, returning '' if the page cannot be read."""
     try:
-        reader = PyPDF2.PdfReader(file)  # Create a PdfReader object to read the PDF file
-        if reader.is_encrypted:  # Check if the PDF is encrypted
-            try:
-                reader.decrypt("")  # Attempt to decrypt the PDF with an empty password
-                logging.info(f"Successfully decrypted PDF: {file.name}") # Log successful decryption
-            except Exception as e:
-                logging.error(f"Cannot decrypt the PDF {file.name}: {str(e)}") # Log decryption failure
-                raise ValueError(f"Cannot decrypt the PDF {file.name}: {str(e)}") # Raise a ValueError if decryption fails
-
-        text = ""  # Initialize an empty string to store the extracted text
-        for page_num in range(len(reader.pages)):  # Iterate through each page of the PDF
+        return reader.pages[page_num].extract_text() or ""  # Extract the text from the page
+    except Exception as e:
+        logging.error(f"Error reading page {page_num}: {str(e)}") # Log error reading specific page
+        return ""
+
+def _extract_page_range(pdf_path, start, stop):
+    """Process-pool worker: extracts pages [start, stop) of the PDF at `pdf_path`."""
+    reader = _open_reader(pdf_path)  # Each worker parses the PDF once for its whole range
+    return [(page_num, _extract_page_text(reader, page_num)) for page_num in range(start, stop)]
+
+def _iter_pages_parallel(pdf_path, page_count, max_workers, pages_per_task):
+    """Extracts page ranges in a process pool and yields them in page order."""
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    max_in_flight = max_workers * 2  # Bound the number of extracted-but-unconsumed ranges held in memory
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        next_range = iter(ranges)
+        for start, stop in islice(next_range, max_in_flight):
+            pending.append(executor.submit(_extract_page_range, pdf_path, start, stop))
+
+        while pending:
+            for page in pending.popleft().result():
+                yield page
+            for start, stop in islice(next_range, 1):
+                pending.append(executor.submit(_extract_page_range, pdf_path, start, stop))
+
+_parallel_fallback_logged = False # The fallback warning is logged once per process
+
+def read_pdf_pages(file, parallel_threshold=100, max_workers=None, pages_per_task=25, on_page=None):
+    """
+    Reads a PDF file and yields (page_number, text) for every page with text.
+
+    Page numbers are 1-based. Documents with at least `parallel_threshold` pages
+    are extracted in a process pool when the file is on disk; otherwise pages are
+    extracted sequentially in this process. `on_page(pages_done, page_count)` is
+    called after each page, with or without text. Raises ValueError if no page has text.
+    """
+    global _parallel_fallback_logged
+    name = getattr(file, 'name', 'PDF')
+    try:
+        reader = _open_reader(file)
+        page_count = len(reader.pages)
+        max_workers = max_workers or os.cpu_count() or 1
+
+        pages = None
+        if page_count >= parallel_threshold and max_workers > 1 and isinstance(name, str) and os.path.isfile(name):
             try:
-                page = reader.pages[page_num]  # Get the current page
-                page_text = page.extract_text()  # Extract the text from the page
-                if page_text:  # Check if the extracted text is not empty
-                    text += page_text  # Append the extracted text to the 'text' string
-            except Exception as e:
-                logging.error(f"Error reading page {page_num}: {str(e)}") # Log error reading specific page
-
-        if not text:
-            logging.warning(f"No text extracted from the PDF: {file.name}") # Log if no text extracted
+                pages = _iter_pages_parallel(name, page_count, max_workers, pages_per_task)
+                first_page = next(pages, None)  # Starts the pool so spawn failures surface before anything is yielded
+                pages = chain([first_page] if first_page else [], pages)
+                logging.info(f"Extracting {page_count} pages of {name} with {max_workers} worker processes")
+            except (AssertionError, OSError) as e:
+                # e.g. daemonic Celery prefork children are not allowed to have children
+                if not _parallel_fallback_logged:
+                    _parallel_fallback_logged = True
+                    logging.warning(f"Parallel page extraction unavailable in this process, extracting sequentially (run the ingest_io worker with --pool threads or solo): {str(e)}")
+                pages = None
+        if pages is None:
+            pages = ((page_num, _extract_page_text(reader, page_num)) for page_num in range(page_count))
+
+        extracted = 0
+        for pages_done, (page_num, page_text) in enumerate(pages, 1):
+            if on_page is not None:
+                on_page(pages_done, page_count)
+            if page_text:  # Skip pages without extractable text
+                extracted += 1
+                yield page_num + 1, page_text
+
+        if not extracted:
+            logging.warning(f"No text extracted from the PDF: {name}") # Log if no text extracted
             raise ValueError("No text extracted from the PDF.") # Raise an error if no text was extracted
 
-        logging.info(f"Successfully read PDF: {file.name}") # Log successful PDF reading
-        return text  # Return the extracted text
+        logging.info(f"Successfully read {extracted} pages from PDF: {name}") # Log successful PDF reading
 
     except PyPDF2.errors.PdfReadError as e:
-        logging.error(f"Error reading the PDF file {file.name}: {str(e)}") # Log specific PyPDF2 error
-        raise ValueError(f"Error reading the PDF file {file.name}: {str(e)}") # Raise a ValueError for PDF read errors
+        logging.error(f"Error reading the PDF file {name}: {str(e)}") # Log specific PyPDF2 error
+        raise ValueError(f"Error reading the PDF file {name}: {str(e)}") # Raise a ValueError for PDF read errors
+
+def read_pdf(file):
+    """Reads a PDF file and extracts the text."""
+    try:
+        return "".join(page_text for _, page_text in read_pdf_pages(file))  # Join once instead of growing a string per page
+    except ValueError:
+        raise
     except Exception as e:
         logging.error(f"An unexpected error occurred while reading the PDF: {str(e)}") # Log other unexpected errors
         raise Exception(f"An unexpected error occurred while reading the PDF: {str(e)}") # Raise a general exception for unexpected errors
 
-# Step 2: Convert text to documents
-def convert_to_documents(text):
-    """Converts a text string to a list of LangChain Document objects."""
-    try:
-        if not text:
+# Step 2: Convert pages to documents
+def convert_to_documents(pages):
+    """
+    Converts extracted text to LangChain Document objects.
+
+    Accepts either a single text string or an iterable of (page_number, text) pairs
+    as produced by read_pdf_pages; the latter is converted lazily, one Document per
+    page, with the page number stored in the Document metadata.
+    """
+    if isinstance(pages, str):
+        if not pages:
             logging.warning("Text content is empty, cannot convert to documents.") # Log if text is empty
             raise ValueError("Text content is empty, cannot convert to documents.") # Raise error if text is empty
-        doc = Document(page_content=text)  # Create a LangChain Document object from the text
-        logging.info("Successfully converted text to documents.") # Log successful conversion
-        return [doc]  # Return a list containing the Document object
-    except Exception as e:
-        logging.error(f"Error converting text to document: {str(e)}") # Log error during document conversion
-        raise Exception(f"Error converting text to document: {str(e)}") # Raise exception during document conversion
+        return [Document(page_content=pages)]  # Create a LangChain Document object from the text
+    return (Document(page_content=page_text, metadata={"page": page_num}) for page_num, page_text in pages)
 
 # Step 3: Split the document into chunks
-def process_documents(documents):
-    """Splits a list of LangChain Document objects into smaller chunks."""
+def process_documents(documents, chunker=None):
+    """
+    Splits LangChain Document objects into smaller chunks.
+
+    `documents` may be a generator; each page is split as soon as it is extracted
+    and every chunk inherits its page's metadata (including the page number).
+    `chunker` (default: the configured strategy, see uploadfile.chunking) must be
+    a fresh instance per PDF, since it may carry state from page to page.
+    """
     try:
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=550, chunk_overlap=50) # Initialize text splitter to chunk documents
-        split_documents = text_splitter.split_documents(documents) # Split the documents into smaller chunks
+        chunker = chunker or get_chunker() # Initialize the chunker that splits documents
+        split_documents = []
+        split_seconds = 0.0
+        for document in documents:  # Split page by page so each page's text can be released once chunked
+            started = time.perf_counter()
+            split_documents.extend(chunker.split(document))
+            split_seconds += time.perf_counter() - started
+        record_span("ingest.split", split_seconds) # Chunking share of the streamed extract stage
+        if not split_documents:
+            raise ValueError("No chunks produced from the documents.") # Raise error if there is nothing to index
         logging.info(f"Successfully split documents into {len(split_documents)} chunks.") # Log the number of chunks created
         return split_documents  # Return the list of split documents
     except Exception as e:
@@ -74,26 +199,253 @@ def process_documents(documents):
         raise Exception(f"Error splitting documents: {str(e)}") # Raise exception during document splitting
 
 # Step 4: Combine add_to_vector_store and generate_pdf_vectors
-def add_to_vector_store_and_generate_vectors(documents, client_id, pdf_name, base_save_path):
+VECTORS_FILE = 'vectors.npy'  # Exact float32 vectors, row i belongs to index position i
+INDEX_META_FILE = 'index_meta.json'  # How the on-disk ANN index was built
+
+def read_index_meta(index_path):
+    """Returns the build metadata saved next to an index, or {} if there is none."""
+    try:
+        with open(os.path.join(index_path, INDEX_META_FILE)) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+
+def _load_vector_store(index_path, embedding):
+    """Rebuilds a LangChain store (as saved, without changing its index) from the native layout."""
+    if not has_index_store(index_path):
+        # Index pickled by an earlier version; these files are only ever written by our own workers
+        logging.info(f"Reading legacy pickled index {index_path}; it is saved in the native layout on the next write") # Log legacy conversion
+        return FAISS.load_local(index_path, embedding, allow_dangerous_deserialization=True)
+    store = IndexStore.load(index_path)
+    documents = store.documents()
+    docstore = InMemoryDocstore({document.id: document for document in documents})
+    return FAISS(embedding, store.index, docstore, {position: document.id for position, document in enumerate(documents)})
+
+def load_flat_vector_store(index_path, embedding=None):
+    """
+    Loads a saved store with an exact flat index in memory, whatever type was saved.
+    `embedding` (default: the shared embedding engine) embeds chunks added later.
+
+    Vectors come from the exact sidecar file when present, so compressed (PQ)
+    indices are never re-quantized from their own lossy reconstructions.
+    """
+    index_path = os.path.realpath(index_path) # Chunks and vectors from the same generation
+    vector_store = _load_vector_store(index_path, embedding or get_embedding_engine())
+    vectors_path = os.path.join(index_path, VECTORS_FILE)
+    if os.path.exists(vectors_path):
+        vectors = np.load(vectors_path)
+    else:
+        index = faiss.downcast_index(vector_store.index)
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map() # IVF indices need a direct map before reconstruct_n
+        vectors = index.reconstruct_n(0, index.ntotal)
+    flat_index = faiss.IndexFlatL2(vector_store.index.d)
+    flat_index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    vector_store.index = flat_index
+    return vector_store
+
+def read_vectors(index_path, offset=0, limit=None):
+    """
+    Returns (rows, total): float32 vectors [offset, offset + limit) of a saved index
+    and the number of vectors it holds. The sidecar file is memory-mapped, so only
+    the requested rows are read from disk.
+    """
+    vectors_path = os.path.join(index_path, VECTORS_FILE)
+    if os.path.exists(vectors_path):
+        vectors = np.load(vectors_path, mmap_mode='r')
+        total = vectors.shape[0]
+        stop = total if limit is None else min(total, offset + limit)
+        return np.array(vectors[offset:stop], dtype=np.float32), total
+    index = faiss.downcast_index(faiss.read_index(os.path.join(index_path, 'index.faiss'))) # Indices saved before the sidecar existed
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    total = index.ntotal
+    stop = total if limit is None else min(total, offset + limit)
+    return index.reconstruct_n(offset, max(0, stop - offset)), total
+
+def save_vector_store(vector_store, index_path):
+    """
+    Saves a store whose in-memory index is flat, picking the on-disk index type by size.
+
+    The ANN index (flat/HNSW/IVF-Flat/IVF-PQ, see query_app.ann_index) is built
+    from the exact vectors and written instead of the flat one; the exact
+    vectors go to a sidecar file so later incremental updates stay lossless.
+    When the store only appended vectors to the saved ones and the corpus is
+    still in the same size tier (see query_app.ann_index.can_extend), the new
+    vectors are added to the saved, already trained index instead.
+    The store keeps its flat index in memory. Chunks are written in the native
+    layout (see query_app.index_store) rather than as a pickled docstore, and a
+    BM25 keyword index over the same positions goes to the sparse/ subdirectory.
+    All of it is written to a new generation directory that then atomically
+    replaces `index_path` (see query_app.index_store.index_generation).
+    Returns (index_type, vectors).
+    """
+    with span("ingest.save"):
+        return _save_vector_store(vector_store, index_path)
+
+def _extend_saved_index(index_path, vectors):
+    """
+    Returns (index, index_type, params): the index saved at `index_path` with the
+    rows of `vectors` it does not hold yet added, or None when it must be rebuilt
+    (no saved index, saved rows changed or removed, or a new size tier).
+    """
+    index_path = os.path.realpath(index_path) # Meta, vectors and index from the same generation
+    meta = read_index_meta(index_path)
+    vectors_path = os.path.join(index_path, VECTORS_FILE)
+    if not meta or not os.path.exists(vectors_path) or not can_extend(meta["index_type"], meta.get("params", {}), len(vectors)):
+        return None
+    saved = np.load(vectors_path, mmap_mode='r')
+    if saved.shape[0] > len(vectors) or saved.shape[1:] != vectors.shape[1:] or not np.array_equal(saved, vectors[:saved.shape[0]]):
+        return None # Deleting from HNSW/IVF shifts positions, so removals mean a rebuild
+    index = faiss.read_index(os.path.join(index_path, 'index.faiss'))
+    if index.ntotal != saved.shape[0]:
+        return None
+    index.add(np.ascontiguousarray(vectors[saved.shape[0]:], dtype=np.float32))
+    return index, meta["index_type"], meta.get("params", {})
+
+def _save_vector_store(vector_store, index_path):
+    flat_index = vector_store.index
+    vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+    extended = _extend_saved_index(index_path, vectors)
+    ann_index, index_type, params = extended or build_index(vectors)
+
+    documents = []
+    for position in range(flat_index.ntotal):
+        docstore_id = vector_store.index_to_docstore_id[position]
+        document = vector_store.docstore.search(docstore_id)
+        documents.append(document if document.id == docstore_id else Document(id=docstore_id, page_content=document.page_content, metadata=document.metadata))
+    with index_generation(index_path) as generation_path: # Written aside and swapped in whole: readers may have the current files mapped
+        write_index_store(generation_path, ann_index, documents)
+        np.save(os.path.join(generation_path, VECTORS_FILE), vectors)
+        with open(os.path.join(generation_path, INDEX_META_FILE), 'w') as meta_file:
+            json.dump({"index_type": index_type, "num_vectors": int(flat_index.ntotal), "params": params}, meta_file)
+        build_sparse_index([document.page_content for document in documents], generation_path) # Keyword index for hybrid retrieval, aligned with the vector positions
+    logging.info(f"Saved {index_type} index with {flat_index.ntotal} vectors to {index_path} ({'extended' if extended else 'built'})") # Log the chosen index type
+    return index_type, vectors
+
+def _replace_documents(docstore, documents):
+    """Replaces the stored Documents of the ids in `documents` (id -> Document), keeping their vectors."""
+    if documents:
+        docstore.delete(list(documents))
+        docstore.add(documents)
+
+def _update_vector_store(vector_store, documents, ids):
+    """
+    Brings an existing vector store in line with `documents` keyed by `ids`.
+
+    Only chunks whose id is not in the store are embedded; chunks that no longer
+    exist are removed. Unchanged chunks keep their vectors but get the new
+    Document (so metadata such as page numbers stays current).
+    Returns (added, removed) counts.
+    """
+    existing_ids = set(vector_store.index_to_docstore_id.values())
+    new_ids = set(ids)
+
+    stale_ids = list(existing_ids - new_ids)
+    if stale_ids:
+        vector_store.delete(stale_ids) # Remove chunks that are no longer in the PDF
+
+    added_documents, added_ids, refreshed = [], [], {}
+    for document, chunk_id in zip(documents, ids):
+        if chunk_id in existing_ids:
+            refreshed[chunk_id] = Document(id=chunk_id, page_content=document.page_content, metadata=document.metadata)
+        else:
+            added_documents.append(document)
+            added_ids.append(chunk_id)
+    _replace_documents(vector_store.docstore, refreshed) # Refresh metadata without re-embedding
+    if added_documents:
+        vector_store.add_documents(added_documents, ids=added_ids) # Embed only new or changed chunks
+
+    return len(added_ids), len(stale_ids)
+
+def add_to_vector_store_and_generate_vectors(documents, client_id, pdf_name, base_save_path, embedding=None):
     """
     Adds documents to a FAISS vector store, generates embeddings, and saves the store.
+    If an index already exists for this PDF it is updated incrementally: only new
+    or changed chunks are embedded and chunks that disappeared are removed.
+    `embedding` overrides the shared engine (e.g. with precomputed vectors).
     Returns the vector store and the generated vectors.
     """
     try:
-        embedding_function = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2') # Initialize embedding function
-        vector_store = FAISS.from_documents(documents, embedding_function) # Create FAISS vector store from documents
+        embedding_function = embedding or get_embedding_engine() # Reuse the embedding model already loaded in this process
+        ids = chunk_ids(documents) # Content-addressed chunk ids
 
         client_save_path = os.path.join(base_save_path, f'client_{client_id}') # Create client-specific save path
         os.makedirs(client_save_path, exist_ok=True) # Create directory if it doesn't exist
-
         faiss_index_file = os.path.join(client_save_path, pdf_name) # Create path to save FAISS index
-        vector_store.save_local(faiss_index_file) # Save FAISS index
-        logging.info(f"FAISS index saved to {faiss_index_file} for client {client_id}") # Log saved index
 
-        vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal) # Reconstruct all vectors from the index
+        if os.path.exists(os.path.join(faiss_index_file, 'index.faiss')):
+            vector_store = load_flat_vector_store(faiss_index_file, embedding_function) # Load the previous version
+            added, removed = _update_vector_store(vector_store, documents, ids)
+            logging.info(f"Incrementally updated FAISS index for client {client_id}: {added} chunks embedded, {removed} removed, {len(ids) - added} reused") # Log reuse
+        else:
+            vector_store = FAISS.from_documents(documents, embedding_function, ids=ids) # Create FAISS vector store from documents
+
+        _, vectors = save_vector_store(vector_store, faiss_index_file) # Save FAISS index with a size-appropriate index type
+        logging.info(f"FAISS index saved to {faiss_index_file} for client {client_id}") # Log saved index
         logging.info(f"Successfully generated vectors for client {client_id}") # Log vector generation
         return vector_store, vectors # Return the vector store and generated vectors
 
     except Exception as e:
         logging.error(f"Error adding documents to vector store and generating vectors for client {client_id}: {str(e)}") # Log error during vector store creation
-        raise Exception(f"Error adding documents to vector store and generating vectors for client {client_id}: {str(e)}") # Raise exception during vector store creation
\ No newline at end of file
+        raise Exception(f"Error adding documents to vector store and generating vectors for client {client_id}: {str(e)}") # Raise exception during vector store creation
+
+# Step 5: Keep the client's merged (all PDFs) index in sync
+def update_merged_index(vector_store, pdf_name, merged_index_path):
+    """
+    Replaces the chunks of `pdf_name` in the client's merged index with those in `vector_store`.
+
+    Merged-index ids are "<pdf_name>::<chunk id>" and every chunk carries its
+    `source` PDF in metadata, so results can be attributed to a document.
+    Vectors are copied from the per-PDF index instead of being re-embedded, and
+    only chunks that changed are added or removed; chunks already merged get the
+    per-PDF index's current Document (metadata such as page numbers may have
+    changed). Returns the merged store.
+    """
+    try:
+        os.makedirs(os.path.dirname(merged_index_path), exist_ok=True)
+        prefix = f"{pdf_name}::"
+        wanted = {prefix + chunk_id: position for position, chunk_id in vector_store.index_to_docstore_id.items()}
+
+        with open(f"{merged_index_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # One writer per client at a time
+            try:
+                merged = None
+                if os.path.exists(os.path.join(merged_index_path, 'index.faiss')):
+                    merged = load_flat_vector_store(merged_index_path)
+
+                existing = set()
+                if merged is not None:
+                    existing = {merged_id for merged_id in merged.index_to_docstore_id.values() if merged_id.startswith(prefix)}
+                    stale_ids = list(existing - wanted.keys())
+                    if stale_ids:
+                        merged.delete(stale_ids) # Drop chunks from the previous version of this PDF
+                    refreshed = {}
+                    for merged_id in existing & wanted.keys():
+                        document = vector_store.docstore.search(vector_store.index_to_docstore_id[wanted[merged_id]])
+                        refreshed[merged_id] = Document(id=merged_id, page_content=document.page_content, metadata={**document.metadata, "source": pdf_name})
+                    _replace_documents(merged.docstore, refreshed) # Refresh metadata of unchanged chunks without re-adding vectors
+
+                added_ids = [merged_id for merged_id in wanted if merged_id not in existing]
+                if added_ids:
+                    text_embeddings, metadatas = [], []
+                    for merged_id in added_ids:
+                        position = wanted[merged_id]
+                        document = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+                        text_embeddings.append((document.page_content, vector_store.index.reconstruct(position).tolist()))
+                        metadatas.append({**document.metadata, "source": pdf_name})
+                    if merged is None:
+                        merged = FAISS.from_embeddings(text_embeddings, get_embedding_engine(), metadatas=metadatas, ids=added_ids)
+                    else:
+                        merged.add_embeddings(text_embeddings, metadatas=metadatas, ids=added_ids)
+
+                if merged is not None:
+                    save_vector_store(merged, merged_index_path)
+                    logging.info(f"Merged index {merged_index_path} updated for {pdf_name}: {len(added_ids)} chunks added, {merged.index.ntotal} total") # Log merged index update
+                return merged
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    except Exception as e:
+        logging.error(f"Error updating merged index {merged_index_path} for {pdf_name}: {str(e)}") # Log error during merge
+        raise Exception(f"Error updating merged index {merged_index_path} for {pdf_name}: {str(e)}") # Raise exception during merge
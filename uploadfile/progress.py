@@ -0,0 +1,102 @@
+# progress.py
+import logging
+import time
+
+from celery import current_app
+from celery.backends.base import BaseKeyValueStoreBackend
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_STATE = 'PROGRESS'
+
+# Counters that measure each stage: (done, total)
+STAGE_COUNTERS = {
+    'extracting': ('pages_extracted', 'pages_total'),
+    'embedding': ('chunks_embedded', 'chunks'),
+}
+
+
+class IngestProgress:
+    """
+    Publishes the progress of one PDF ingest as the PROGRESS state of its task id
+    in the Celery result backend, where the status endpoints read it.
+
+    The published meta holds the current `stage`, the page and chunk counters,
+    `elapsed_seconds` and `eta_seconds` (time left in the current stage at its
+    rate so far, None when unknown). Writes are throttled to one per
+    `min_interval` seconds; stage changes are always written. Without a task
+    id (e.g. a task called directly) nothing is published.
+    """
+
+    def __init__(self, task_id, pdf_name, started_at=None, state=None, min_interval=None):
+        self.task_id = task_id
+        self.started_at = started_at or time.time()
+        self.min_interval = settings.INGEST_PROGRESS_MIN_INTERVAL_SECONDS if min_interval is None else min_interval
+        self.state = dict(state or {}, pdf_name=pdf_name)
+        self._stage_started = time.time()
+        self._last_published = 0.0
+
+    def stage(self, stage, **counters):
+        """Enters a new stage and publishes it."""
+        self._stage_started = time.time()
+        self.update(force=True, stage=stage, **counters)
+
+    def update(self, force=False, **counters):
+        """Updates counters and publishes them unless the last write was too recent."""
+        self.state.update(counters)
+        now = time.time()
+        if not force and now - self._last_published < self.min_interval:
+            return
+        self._last_published = now
+        self.publish()
+
+    def eta_seconds(self):
+        done_key, total_key = STAGE_COUNTERS.get(self.state.get('stage'), (None, None))
+        done, total = self.state.get(done_key), self.state.get(total_key)
+        if not done or not total:
+            return None
+        return round((time.time() - self._stage_started) / done * (total - done), 1)
+
+    def publish(self):
+        if not self.task_id:
+            return
+        meta = dict(self.state, elapsed_seconds=round(time.time() - self.started_at, 1), eta_seconds=self.eta_seconds())
+        try:
+            current_app.backend.store_result(self.task_id, meta, PROGRESS_STATE)
+        except Exception as e:
+            # Progress is informational; a backend hiccup must not fail the ingest
+            logger.warning(f"Could not publish progress for task {self.task_id}: {str(e)}")
+
+
+def _describe(task_id, meta):
+    status = meta.get('status', 'PENDING')
+    if status == 'FAILURE':
+        return {"task_id": task_id, "status": status, "error": "Task failed"}
+    description = {"task_id": task_id, "status": status, "result": meta.get('result')}
+    if status == PROGRESS_STATE:
+        description["progress"] = meta.get('result')
+    return description
+
+
+def task_states(task_ids):
+    """
+    Returns the status of each task id, in order, as dicts with `task_id`,
+    `status` and `result` (plus `progress` while running, or `error` on failure).
+    Key-value result backends such as Redis are read with a single MGET.
+    """
+    backend = current_app.backend
+    if isinstance(backend, BaseKeyValueStoreBackend):
+        keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+        values = backend.mget(keys)
+        if hasattr(values, 'get'):  # Some clients return {key: value} instead of a list
+            values = [values.get(key) for key in keys]
+        metas = [backend.decode_result(value) if value else {} for value in values]
+    else:
+        metas = [backend.get_task_meta(task_id) for task_id in task_ids]
+    return [_describe(task_id, meta) for task_id, meta in zip(task_ids, metas)]
+
+
+def task_traceback(task_id):
+    """Returns the traceback stored for a failed task, or None."""
+    return current_app.backend.get_task_meta(task_id).get('traceback')
@@ -1,65 +1,352 @@
+import json
 import os
 import logging
-from celery import shared_task
+import time
+import uuid
+import numpy as np
+from celery import chain, shared_task
 from django.conf import settings  # Import the settings module
-from .pdf_processing import read_pdf, convert_to_documents, process_documents, add_to_vector_store_and_generate_vectors
+from langchain.docstore.document import Document
+from langchain_core.embeddings import Embeddings
+from .chunking import get_chunker
+from .pdf_processing import hash_file, chunk_ids, read_pdf_pages, convert_to_documents, process_documents, add_to_vector_store_and_generate_vectors, update_merged_index, read_index_meta
 from query_app.models import PDFDocument  # Import the PDFDocument model
+from query_app.index_cache import index_cache
+from query_app.index_store import has_index_store, read_chunk_ids
+from query_app.embeddings import PrecomputedEmbeddings, get_embedding_engine
+from query_app.metrics import registry, span
+from .progress import IngestProgress
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def process_pdf_task(pdf_path, client_id, pdf_name):
+
+def _embed_in_slices(texts, embed, progress):
     """
-    Celery task to process a PDF file asynchronously.
+    Embeds `texts` in slices of EMBEDDING_INGEST_MAX_BATCH_TEXTS, reporting
+    chunks_embedded after each. Chunks of the PDF that need no embedding
+    (reused from its previous version) count as already embedded.
     """
-    try:
-        logger.info(f"Starting to process PDF: {pdf_path}")
+    done = progress.state.get('chunks', len(texts)) - len(texts)
+    progress.stage('embedding', chunks_embedded=done)
+    vectors = []
+    step = settings.EMBEDDING_INGEST_MAX_BATCH_TEXTS
+    with span("ingest.embed"):
+        for start in range(0, len(texts), step):
+            batch = texts[start:start + step]
+            vectors.extend(embed(batch))
+            done += len(batch)
+            progress.update(chunks_embedded=done)
+    return vectors
 
-        # Step 1: Read the PDF content
-        if not os.path.exists(pdf_path):
-            raise FileNotFoundError(f"File not found: {pdf_path}")
 
-        with open(pdf_path, 'rb') as file:
-            pdf_text = read_pdf(file)
-            logger.info(f"Successfully read PDF: {pdf_path}")
+class _ProgressEmbeddings(Embeddings):
+    """Embeddings wrapper that reports embedding progress (see _embed_in_slices)."""
 
-        # Step 2: Convert PDF text to LangChain documents
-        documents = convert_to_documents(pdf_text)
-        logger.info("Successfully converted text to documents")
+    def __init__(self, inner, progress):
+        self.inner = inner
+        self.progress = progress
 
-        # Step 3: Split the documents into chunks
-        split_documents = process_documents(documents)
-        logger.info(f"Successfully split documents into {len(split_documents)} chunks")
-
-        # Step 4: Add to vector store and generate vectors
-        vector_store, vectors = add_to_vector_store_and_generate_vectors(split_documents, client_id, pdf_name, base_save_path=settings.FAISS_INDICES_DIR)
-        logger.info("Successfully added documents to vector store and generated vectors")
-
-        # Step 5: Save the PDF metadata to the database
-        client_save_path = os.path.join(settings.FAISS_INDICES_DIR, f'client_{client_id}')
-        faiss_index_file = os.path.join(client_save_path, pdf_name)
-
-        # Create a new PDFDocument entry
-        PDFDocument.objects.create(
-            client_id=client_id,
-            pdf_name=pdf_name,
-            file_path=faiss_index_file
+    def embed_documents(self, texts):
+        return _embed_in_slices(list(texts), self.inner.embed_documents, self.progress)
+
+    def embed_query(self, text):
+        return self.inner.embed_query(text)
+
+
+def _extract_chunks(pdf_path, client_id, pdf_name, progress):
+    """
+    Steps 1-3: reads, converts and splits the PDF, reporting pages extracted.
+    Returns (split_documents, file_hash); split_documents is None when the file is
+    an identical re-upload of an indexed PDF, in which case the file is removed.
+    """
+    # Step 1: Read the PDF content
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"File not found: {pdf_path}")
+
+    # Skip identical re-uploads: same client, same name, same file content, index still on disk
+    file_hash = hash_file(pdf_path)
+    existing_document = PDFDocument.objects.filter(client_id=client_id, pdf_name=pdf_name).only('file_hash', 'file_path').first()
+    if existing_document and existing_document.file_hash == file_hash and os.path.exists(existing_document.file_path):
+        os.remove(pdf_path)
+        logger.info(f"Skipped unchanged re-upload of {pdf_name} for client {client_id}")
+        return None, file_hash
+
+    progress.stage('extracting')
+    with span("ingest.extract"), open(pdf_path, 'rb') as file:
+        # Steps 1-3 stream: pages are extracted, converted and split one at a time
+        pages = read_pdf_pages(
+            file,
+            parallel_threshold=settings.PDF_PARALLEL_PAGE_THRESHOLD,
+            max_workers=settings.PDF_EXTRACT_WORKERS,
+            pages_per_task=settings.PDF_PAGES_PER_TASK,
+            on_page=lambda done, total: progress.update(pages_extracted=done, pages_total=total),
         )
-        logger.info(f"Saved PDF metadata to the database for client {client_id}, PDF {pdf_name}")
+
+        # Step 2: Convert PDF pages to LangChain documents
+        documents = convert_to_documents(pages)
+
+        # Step 3: Split the documents into chunks
+        split_documents = process_documents(documents, chunker=get_chunker(client_id))
+        logger.info(f"Successfully read and split PDF {pdf_path} into {len(split_documents)} chunks")
+    progress.update(force=True, chunks=len(split_documents))
+    return split_documents, file_hash
+
+
+def _skipped_result(client_id):
+    registry.inc("ingest_documents_total", status="skipped")
+    return {
+        "status": "success",
+        "client_id": client_id,
+        "skipped": True,
+        "message": "Identical PDF already indexed."
+    }
+
+
+def _pdf_index_path(client_id, pdf_name):
+    return os.path.join(settings.FAISS_INDICES_DIR, f'client_{client_id}', pdf_name)
+
+
+def _index_chunks(split_documents, client_id, pdf_name, file_hash, timings, progress, embedding=None):
+    """Steps 4-6: indexes the chunks, records the PDF and updates the merged index. Returns the summary."""
+    faiss_index_file = _pdf_index_path(client_id, pdf_name)
+
+    # Step 4: Add to vector store and generate vectors
+    progress.stage('indexing')
+    step_started = time.perf_counter()
+    with span("ingest.index"):
+        vector_store, vectors = add_to_vector_store_and_generate_vectors(split_documents, client_id, pdf_name, base_save_path=settings.FAISS_INDICES_DIR, embedding=embedding)
+    logger.info("Successfully added documents to vector store and generated vectors")
+    timings["index_seconds"] = time.perf_counter() - step_started
+
+    # Step 5: Save the PDF metadata to the database
+    # Drop any stale copy of this index cached in the current process
+    index_cache.invalidate(faiss_index_file)
+
+    # Record which index type the pipeline picked for this corpus size
+    index_type = read_index_meta(faiss_index_file).get('index_type', 'flat')
+
+    # Upsert the PDFDocument entry: (client_id, pdf_name) is unique, a new version updates the row
+    document, _ = PDFDocument.objects.update_or_create(
+        client_id=client_id,
+        pdf_name=pdf_name,
+        defaults={
+            "file_path": faiss_index_file,
+            "file_hash": file_hash,
+            "index_type": index_type,
+        }
+    )
+    logger.info(f"Saved PDF metadata to the database for client {client_id}, PDF {pdf_name}")
+
+    # Step 6: Fold this PDF's chunks into the client's merged index for cross-document search
+    merged_index_file = os.path.join(settings.FAISS_MERGED_INDICES_DIR, f'client_{client_id}')
+    progress.stage('merging')
+    step_started = time.perf_counter()
+    with span("ingest.merge"):
+        update_merged_index(vector_store, pdf_name, merged_index_file)
+    index_cache.invalidate(merged_index_file)
+    timings["merge_seconds"] = time.perf_counter() - step_started
+
+    registry.inc("ingest_documents_total", status="success")
+    # Keep the result small: it is stored in the result backend and polled by clients.
+    # The vectors themselves are served by the document vectors endpoint.
+    return {
+        "status": "success",
+        "client_id": client_id,
+        "pdf_name": pdf_name,
+        "document_id": document.id,
+        "index_type": index_type,
+        "chunks": len(split_documents),
+        "vectors": len(vectors),
+        "timings": {name: round(seconds, 3) for name, seconds in timings.items()}
+    }
+
+
+@shared_task(bind=True)
+def process_pdf_task(self, pdf_path, client_id, pdf_name):
+    """
+    Celery task to process a PDF file asynchronously, all steps in one worker.
+    Used when INGEST_PIPELINE_ENABLED is off; see start_pdf_ingest.
+    Progress is published under this task's id.
+    """
+    try:
+        logger.info(f"Starting to process PDF: {pdf_path}")
+        started = time.perf_counter()
+        timings = {}
+        progress = IngestProgress(self.request.id, pdf_name)
+
+        split_documents, file_hash = _extract_chunks(pdf_path, client_id, pdf_name, progress)
+        if split_documents is None:
+            return _skipped_result(client_id)
+        timings["extract_seconds"] = time.perf_counter() - started
+
+        embedding = _ProgressEmbeddings(get_embedding_engine(), progress)
+        result = _index_chunks(split_documents, client_id, pdf_name, file_hash, timings, progress, embedding=embedding)
 
         # Clean up the temporary file
         os.remove(pdf_path)
         logger.info(f"Successfully cleaned up temporary file: {pdf_path}")
 
-        return {
-            "status": "success",
-            "client_id": client_id,
-            "vectors": vectors.tolist() if hasattr(vectors, 'tolist') else vectors
-        }
+        result["timings"]["total_seconds"] = round(time.perf_counter() - started, 3)
+        return result
 
     except Exception as e:
         logger.error(f"Error processing PDF {pdf_path}: {str(e)}")
+        registry.inc("ingest_documents_total", status="error")
         return {
             "status": "error",
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+# Pipelined ingest: extract (IO queue) -> embed (embed queue) -> index and merge (index queue).
+# Stages hand over through files next to the uploaded PDF in TEMP_PDFS_DIR, so only a
+# small payload travels through the broker. A failed or skipped stage returns a final
+# result that the later stages pass through, so the chain always completes.
+
+def _remove_stage_files(payload):
+    for key in ('chunks_path', 'embeddings_path'):
+        path = payload.get(key)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def _stage_error(payload, stage, e):
+    logger.error(f"Error in {stage} stage for PDF {payload.get('pdf_name')}: {str(e)}")
+    registry.inc("ingest_documents_total", status="error")
+    _remove_stage_files(payload)
+    return {
+        "status": "error",
+        "error": str(e)
+    }
+
+
+def _stage_progress(payload):
+    return IngestProgress(payload.get("progress_id"), payload["pdf_name"], started_at=payload["started_at"], state=payload.get("progress"))
+
+
+@shared_task
+def extract_pdf_task(pdf_path, client_id, pdf_name, progress_id=None):
+    """
+    Pipeline stage 1: extracts and splits the PDF, writes the chunks to a JSON
+    file and removes the uploaded PDF. Returns the payload for the embed stage.
+    Progress of every stage is published under `progress_id` (the id of the
+    chain's last task).
+    """
+    payload = {"status": "pending", "client_id": client_id, "pdf_name": pdf_name, "progress_id": progress_id, "started_at": time.time(), "timings": {}}
+    try:
+        logger.info(f"Starting to process PDF: {pdf_path}")
+        started = time.perf_counter()
+        progress = _stage_progress(payload)
+        split_documents, file_hash = _extract_chunks(pdf_path, client_id, pdf_name, progress)
+        if split_documents is None:
+            return _skipped_result(client_id)
+
+        payload["stage_prefix"] = os.path.splitext(pdf_path)[0]
+        payload["chunks_path"] = payload["stage_prefix"] + '.chunks.json'
+        with open(payload["chunks_path"], 'w') as chunks_file:
+            json.dump([{"page_content": d.page_content, "metadata": d.metadata} for d in split_documents], chunks_file)
+        os.remove(pdf_path)
+
+        payload.update(file_hash=file_hash, chunks=len(split_documents), progress=progress.state)
+        payload["timings"]["extract_seconds"] = time.perf_counter() - started
+        return payload
+    except Exception as e:
+        return _stage_error(payload, "extract", e)
+
+
+def _read_chunks(payload):
+    with open(payload["chunks_path"]) as chunks_file:
+        return [Document(page_content=chunk["page_content"], metadata=chunk["metadata"]) for chunk in json.load(chunks_file)]
+
+
+@shared_task
+def embed_chunks_task(payload):
+    """
+    Pipeline stage 2: embeds the chunks and writes the vectors to a .npz file.
+    As in the single-task path, chunks already in the PDF's previous index are
+    not embedded: the index stage reuses their saved vectors. Concurrent embed
+    tasks in one worker (threads pool) share forward passes through
+    EmbeddingEngine.embed_documents_batched.
+    """
+    if payload.get("status") != "pending":
+        return payload
+    try:
+        started = time.perf_counter()
+        progress = _stage_progress(payload)
+        documents = _read_chunks(payload)
+        faiss_index_file = _pdf_index_path(payload["client_id"], payload["pdf_name"])
+        indexed_ids = set(read_chunk_ids(faiss_index_file)) if has_index_store(faiss_index_file) else set()
+        positions = [position for position, chunk_id in enumerate(chunk_ids(documents)) if chunk_id not in indexed_ids]
+        texts = [documents[position].page_content for position in positions]
+        vectors = np.asarray(_embed_in_slices(texts, get_embedding_engine().embed_documents_batched, progress), dtype=np.float32)
+
+        payload["embeddings_path"] = payload["stage_prefix"] + '.embeddings.npz'
+        np.savez(payload["embeddings_path"], positions=np.asarray(positions, dtype=np.int64), vectors=vectors)
+        payload["progress"] = progress.state
+        payload["timings"]["embed_seconds"] = time.perf_counter() - started
+        return payload
+    except Exception as e:
+        return _stage_error(payload, "embed", e)
+
+
+@shared_task
+def index_chunks_task(payload):
+    """
+    Pipeline stage 3: builds or updates the PDF's index from the precomputed
+    vectors (chunks the embed stage skipped keep their saved ones), records the PDF and updates the client's merged index.
+    """
+    if payload.get("status") != "pending":
+        return payload
+    try:
+        split_documents = _read_chunks(payload)
+        with np.load(payload["embeddings_path"]) as embeddings:
+            texts = [split_documents[position].page_content for position in embeddings["positions"]]
+            embedding = PrecomputedEmbeddings(texts, embeddings["vectors"], get_embedding_engine())
+
+        result = _index_chunks(split_documents, payload["client_id"], payload["pdf_name"], payload["file_hash"], payload["timings"], _stage_progress(payload), embedding=embedding)
+        _remove_stage_files(payload)
+        result["timings"]["total_seconds"] = round(time.time() - payload["started_at"], 3)  # Includes time spent queued between stages
+        return result
+    except Exception as e:
+        return _stage_error(payload, "index", e)
+
+
+def start_pdf_ingest(pdf_path, client_id, pdf_name):
+    """
+    Dispatches ingest of a PDF stored in TEMP_PDFS_DIR. Returns the AsyncResult
+    whose result is the ingest summary (the last task of the pipeline chain) and
+    under whose id progress is published.
+    """
+    if settings.INGEST_PIPELINE_ENABLED:
+        ingest_id = str(uuid.uuid4())
+        pipeline = chain(
+            extract_pdf_task.s(pdf_path, client_id, pdf_name, progress_id=ingest_id),
+            embed_chunks_task.s(),
+            index_chunks_task.s().set(task_id=ingest_id),
+        )
+        return pipeline.apply_async()
+    return process_pdf_task.delay(pdf_path, client_id=client_id, pdf_name=pdf_name)
+
+
+@shared_task
+def expire_upload_sessions_task():
+    """
+    Celery task that removes chunked uploads left unfinished for longer than
+    UPLOAD_SESSION_TTL_HOURS, together with their partial files.
+    """
+    from datetime import timedelta
+    from django.utils import timezone
+    from .models import UploadSession
+
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    stale = UploadSession.objects.filter(status=UploadSession.STATUS_OPEN, updated_at__lt=cutoff)
+    removed = 0
+    for upload in stale.iterator():
+        try:
+            os.remove(upload.part_path)
+        except FileNotFoundError:
+            pass
+        upload.delete()
+        removed += 1
+    logger.info(f"Removed {removed} expired upload sessions")
+    return {"status": "success", "removed": removed}
@@ -1,9 +1,32 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from unittest.mock import patch, MagicMock
+import hashlib
+import io
+import json
 import os
+import shutil
+import tempfile
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework.authtoken.models import Token
+from langchain.docstore.document import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+from django.core.management import call_command
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
-from uploadfile.tasks import process_pdf_task
+from uploadfile.tasks import process_pdf_task, extract_pdf_task, embed_chunks_task, index_chunks_task
+from uploadfile.pdf_processing import read_pdf, read_pdf_pages, convert_to_documents, process_documents, hash_file, chunk_ids, add_to_vector_store_and_generate_vectors, update_merged_index, read_index_meta, load_flat_vector_store
+from uploadfile.models import UploadSession
+from uploadfile.chunking import StructureChunker, TokenChunker, get_chunker
+from uploadfile.benchmarks import StubLLMServer, compare_results, make_pdf, run_load_test, summarize
+from uploadfile.progress import IngestProgress
+from celery.backends.cache import CacheBackend
+from myapi.celery import app as celery_app
+from query_app.models import PDFDocument
+from query_app.ann_index import build_index
+from query_app.index_store import IndexStore
 
 class TestTasks(TestCase):
     def setUp(self):
@@ -18,11 +41,12 @@ class TestTasks(TestCase):
         if os.path.exists(self.sample_pdf_path):
             os.remove(self.sample_pdf_path)
 
-    @patch("uploadfile.tasks.read_pdf")
+    @patch("uploadfile.tasks.read_pdf_pages")
     @patch("uploadfile.tasks.convert_to_documents")
     @patch("uploadfile.tasks.process_documents")
     @patch("uploadfile.tasks.add_to_vector_store_and_generate_vectors")
-    def test_process_pdf_task_success(self, mock_add, mock_process, mock_convert, mock_read):
+    @patch("uploadfile.tasks.update_merged_index")
+    def test_process_pdf_task_success(self, mock_merge, mock_add, mock_process, mock_convert, mock_read):
         """Test processing a valid PDF file."""
         # Mock the return values
         mock_read.return_value = "sample text"
@@ -36,9 +60,13 @@ class TestTasks(TestCase):
         # Assert the result
         self.assertEqual(result["status"], "success")
         self.assertEqual(result["client_id"], "12345")
-        self.assertEqual(result["vectors"], [1, 2, 3])
+        self.assertEqual(result["vectors"], 3)
+        self.assertEqual(result["chunks"], 1)
+        self.assertEqual(result["document_id"], PDFDocument.objects.get(client_id="12345", pdf_name="sample.pdf").id)
+        self.assertIn("total_seconds", result["timings"])
+        mock_merge.assert_called_once()
 
-    @patch("uploadfile.tasks.read_pdf")
+    @patch("uploadfile.tasks.read_pdf_pages")
     def test_process_pdf_task_file_not_found(self, mock_read):
         """Test handling a missing PDF file."""
         mock_read.side_effect = FileNotFoundError("File not found")
@@ -50,7 +78,7 @@ class TestTasks(TestCase):
         self.assertEqual(result["status"], "error")
         self.assertIn("File not found", result["error"])
 
-    @patch("uploadfile.tasks.read_pdf")
+    @patch("uploadfile.tasks.read_pdf_pages")
     @patch("uploadfile.tasks.convert_to_documents")
     def test_process_pdf_task_conversion_error(self, mock_convert, mock_read):
         """Test handling an error during document conversion."""
@@ -64,7 +92,7 @@ class TestTasks(TestCase):
         self.assertEqual(result["status"], "error")
         self.assertIn("Conversion error", result["error"])
 
-    @patch("uploadfile.tasks.read_pdf")
+    @patch("uploadfile.tasks.read_pdf_pages")
     @patch("uploadfile.tasks.convert_to_documents")
     @patch("uploadfile.tasks.process_documents")
     @patch("uploadfile.tasks.add_to_vector_store_and_generate_vectors")
@@ -80,4 +108,624 @@ class TestTasks(TestCase):
 
         # Assert the result
         self.assertEqual(result["status"], "error")
-        self.assertIn("Vector store error", result["error"])
\ No newline at end of file
+        self.assertIn("Vector store error", result["error"])
+
+    @patch("uploadfile.tasks.read_pdf_pages")
+    def test_process_pdf_task_skips_identical_reupload(self, mock_read):
+        """Test that re-uploading an identical PDF skips extraction and embedding."""
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        PDFDocument.objects.create(client_id="12345", pdf_name="sample.pdf", file_path=index_dir, file_hash=hash_file(self.sample_pdf_path))
+
+        result = process_pdf_task(self.sample_pdf_path, client_id="12345", pdf_name="sample.pdf")
+
+        self.assertEqual(result["status"], "success")
+        self.assertTrue(result["skipped"])
+        mock_read.assert_not_called()
+        self.assertFalse(os.path.exists(self.sample_pdf_path))
+
+    @patch("uploadfile.tasks.read_pdf_pages")
+    @patch("uploadfile.tasks.convert_to_documents")
+    @patch("uploadfile.tasks.process_documents")
+    @patch("uploadfile.tasks.add_to_vector_store_and_generate_vectors")
+    @patch("uploadfile.tasks.update_merged_index")
+    def test_process_pdf_task_upserts_document(self, mock_merge, mock_add, mock_process, mock_convert, mock_read):
+        """Test that a new version of a PDF updates its existing row instead of adding another."""
+        PDFDocument.objects.create(client_id="12345", pdf_name="sample.pdf", file_path="old/path", file_hash="old")
+        mock_process.return_value = [MagicMock()]
+        mock_add.return_value = (MagicMock(), [1, 2, 3])
+
+        process_pdf_task(self.sample_pdf_path, client_id="12345", pdf_name="sample.pdf")
+
+        documents = PDFDocument.objects.filter(client_id="12345", pdf_name="sample.pdf")
+        self.assertEqual(documents.count(), 1)
+        self.assertNotEqual(documents.get().file_hash, "old")
+
+
+class TestPdfProcessing(TestCase):
+    def setUp(self):
+        # Create a multi-page sample PDF with one line of text per page
+        self.sample_pdf_path = "sample_pages.pdf"
+        c = canvas.Canvas(self.sample_pdf_path, pagesize=letter)
+        for page in range(1, 6):
+            c.drawString(100, 750, f"Text on page {page}.")
+            c.showPage()
+        c.save()
+
+    def tearDown(self):
+        if os.path.exists(self.sample_pdf_path):
+            os.remove(self.sample_pdf_path)
+
+    def test_read_pdf_pages_sequential(self):
+        """Test that pages are yielded in order with 1-based page numbers."""
+        with open(self.sample_pdf_path, "rb") as file:
+            pages = list(read_pdf_pages(file))
+
+        self.assertEqual([page_num for page_num, _ in pages], [1, 2, 3, 4, 5])
+        self.assertIn("page 3", pages[2][1])
+
+    def test_read_pdf_pages_parallel_matches_sequential(self):
+        """Test that process-pool extraction yields the same pages in the same order."""
+        with open(self.sample_pdf_path, "rb") as file:
+            sequential = list(read_pdf_pages(file))
+        with open(self.sample_pdf_path, "rb") as file:
+            parallel = list(read_pdf_pages(file, parallel_threshold=1, max_workers=2, pages_per_task=2))
+
+        self.assertEqual(parallel, sequential)
+
+    @patch("uploadfile.pdf_processing._parallel_fallback_logged", False)
+    @patch("uploadfile.pdf_processing.ProcessPoolExecutor", side_effect=AssertionError("daemonic processes are not allowed to have children"))
+    def test_read_pdf_pages_falls_back_with_one_warning(self, mock_pool):
+        """Test that a process that cannot start the pool extracts sequentially and warns only once."""
+        with self.assertLogs(level="WARNING") as logs:
+            for _ in range(2):
+                with open(self.sample_pdf_path, "rb") as file:
+                    pages = list(read_pdf_pages(file, parallel_threshold=1, max_workers=2))
+
+        self.assertEqual(len(pages), 5)
+        self.assertEqual(mock_pool.call_count, 2)
+        self.assertEqual(len([line for line in logs.output if "Parallel page extraction unavailable" in line]), 1)
+
+    def test_read_pdf_joins_pages(self):
+        """Test that read_pdf still returns the whole document text."""
+        with open(self.sample_pdf_path, "rb") as file:
+            text = read_pdf(file)
+
+        self.assertIn("page 1", text)
+        self.assertIn("page 5", text)
+
+    def test_chunks_keep_page_metadata(self):
+        """Test that every chunk carries the page number it came from."""
+        with open(self.sample_pdf_path, "rb") as file:
+            chunks = process_documents(convert_to_documents(read_pdf_pages(file)))
+
+        self.assertEqual([chunk.metadata["page"] for chunk in chunks], [1, 2, 3, 4, 5])
+
+
+class TestChunking(TestCase):
+    def setUp(self):
+        # One token per word, so budgets are exact whether or not tiktoken is available
+        patcher = patch("uploadfile.chunking.count_tokens_many", side_effect=lambda texts: [len(text.split()) for text in texts])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_structure_chunks_follow_headings_and_sentences(self):
+        """Test that chunks keep sentences whole, start at headings and carry the section across pages."""
+        chunker = StructureChunker(chunk_tokens=12, overlap_tokens=0)
+        first = Document(page_content="1. SCOPE\nThe warranty covers parts. It lasts two\nyears from delivery.\n\n2.1 Claims Process\nSend the receipt.", metadata={"page": 1})
+        second = Document(page_content="Claims are answered within ten days.", metadata={"page": 2})
+
+        chunks = chunker.split(first) + chunker.split(second)
+
+        self.assertEqual([chunk.page_content for chunk in chunks], [
+            "1. SCOPE\nThe warranty covers parts. It lasts two\nyears from delivery.",
+            "2.1 Claims Process\nSend the receipt.",
+            "Claims are answered within ten days.",
+        ])
+        self.assertEqual([chunk.metadata["section"] for chunk in chunks], ["1. SCOPE", "2.1 Claims Process", "2.1 Claims Process"])
+        self.assertEqual([chunk.metadata["page"] for chunk in chunks], [1, 1, 2])
+        self.assertEqual(chunks[0].metadata["tokens"], 12)
+
+    def test_token_chunks_respect_budget_and_overlap(self):
+        """Test that token chunks never exceed the budget and share the overlap with the previous chunk."""
+        text = " ".join(f"w{i}" for i in range(25))
+
+        chunks = TokenChunker(chunk_tokens=10, overlap_tokens=3).split(Document(page_content=text))
+
+        self.assertTrue(all(len(chunk.page_content.split()) <= 10 for chunk in chunks))
+        self.assertEqual(chunks[0].page_content.split()[-3:], chunks[1].page_content.split()[:3])
+        self.assertEqual(chunks[-1].page_content.split()[-1], "w24")
+
+    @override_settings(CHUNKING_STRATEGY="structure", CHUNKING_CLIENT_OVERRIDES={"7": {"strategy": "tokens", "chunk_tokens": 50}})
+    def test_chunker_is_configured_per_client(self):
+        """Test that a client override picks its own strategy and sizes."""
+        self.assertIsInstance(get_chunker("1"), StructureChunker)
+        chunker = get_chunker(7)
+        self.assertIs(type(chunker), TokenChunker)
+        self.assertEqual(chunker.chunk_tokens, 50)
+
+
+class TestBenchmarks(TestCase):
+    def test_synthetic_pdf_and_summary(self):
+        """Test that the synthetic PDF has the requested pages and samples are summarized as percentiles."""
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, "synthetic.pdf")
+            make_pdf(path, pages=3, lines_per_page=5)
+            with open(path, "rb") as file:
+                self.assertEqual([page for page, _ in read_pdf_pages(file)], [1, 2, 3])
+
+        summary = summarize([0.1, 0.2, 0.3, 0.4], items=8)
+        self.assertAlmostEqual(summary["p50"], 0.25)
+        self.assertAlmostEqual(summary["items_per_second"], 32.0)
+        self.assertGreater(summary["peak_rss_mb"], 0)
+
+    def test_compare_flags_regressions(self):
+        """Test that only stages slower than the threshold are flagged."""
+        baseline = {"stages": {"read_pdf": {"p50": 1.0, "p95": 2.0}, "index_load": {"p50": 1.0, "p95": 1.0}}}
+        current = {"stages": {"read_pdf": {"p50": 1.1, "p95": 3.0}, "index_load": {"p50": 0.5, "p95": 0.5}, "new_stage": {"p50": 1.0, "p95": 1.0}}}
+
+        rows = compare_results(baseline, current, threshold=1.2)
+
+        self.assertEqual([(stage, metric) for stage, metric, *_, regressed in rows if regressed], [("read_pdf", "p95")])
+        self.assertEqual(len(rows), 4)
+
+    def test_load_test_counts_streamed_responses(self):
+        """Test that the load test times every request and reports throughput."""
+        with StubLLMServer(tokens=3) as server:
+            results = run_load_test(server.base_url, "token", path="/chat/completions", concurrency=4, total=12, log=lambda message: None)
+
+        self.assertEqual((results["requests"], results["errors"]), (12, 0))
+        self.assertGreater(results["requests_per_second"], 0)
+        self.assertLessEqual(results["first_chunk"]["p50"], results["total"]["p50"])
+        self.assertNotIn("rss_mb", results["total"])
+
+
+class CountingEmbeddings(Embeddings):
+    """Deterministic fake embeddings that record which texts were embedded."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+    def embed_documents_batched(self, texts):
+        return self.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class TestIncrementalIngestion(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.embeddings = CountingEmbeddings()
+        patcher = patch("uploadfile.pdf_processing.get_embedding_engine", return_value=self.embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def test_chunk_ids_are_content_addressed(self):
+        """Test that chunk ids depend only on text and stay unique for repeated chunks."""
+        ids = chunk_ids([Document(page_content="a"), Document(page_content="b"), Document(page_content="a")])
+
+        self.assertEqual(ids[0], chunk_ids([Document(page_content="a")])[0])
+        self.assertEqual(ids[2], f"{ids[0]}-1")
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_reupload_embeds_only_changed_chunks(self):
+        """Test that a new version of a PDF only embeds new chunks and drops stale ones."""
+        first = [Document(page_content=text) for text in ("alpha", "beta", "gamma")]
+        add_to_vector_store_and_generate_vectors(first, "1", "doc.pdf", self.base_dir)
+        self.embeddings.embedded.clear()
+
+        second = [Document(page_content=text, metadata={"page": 2}) for text in ("alpha", "beta", "delta")]
+        vector_store, vectors = add_to_vector_store_and_generate_vectors(second, "1", "doc.pdf", self.base_dir)
+
+        self.assertEqual(self.embeddings.embedded, ["delta"])
+        self.assertEqual(vector_store.index.ntotal, 3)
+        self.assertEqual(len(vectors), 3)
+        stored = [vector_store.docstore.search(chunk_id) for chunk_id in vector_store.index_to_docstore_id.values()]
+        self.assertEqual(sorted(doc.page_content for doc in stored), ["alpha", "beta", "delta"])
+        self.assertTrue(all(doc.metadata == {"page": 2} for doc in stored))
+
+    def test_merged_index_tracks_each_pdf(self):
+        """Test that the merged index holds every PDF's chunks with source attribution and replaces stale ones."""
+        merged_path = os.path.join(self.base_dir, "merged", "client_1")
+        store_a, _ = add_to_vector_store_and_generate_vectors([Document(page_content="alpha")], "1", "a.pdf", self.base_dir)
+        store_b, _ = add_to_vector_store_and_generate_vectors([Document(page_content="beta"), Document(page_content="gamma")], "1", "b.pdf", self.base_dir)
+        update_merged_index(store_a, "a.pdf", merged_path)
+        update_merged_index(store_b, "b.pdf", merged_path)
+
+        store_b, _ = add_to_vector_store_and_generate_vectors([Document(page_content="beta"), Document(page_content="delta")], "1", "b.pdf", self.base_dir)
+        self.embeddings.embedded.clear()
+        merged = update_merged_index(store_b, "b.pdf", merged_path)
+
+        self.assertEqual(self.embeddings.embedded, [])  # Vectors are copied, not re-embedded
+        self.assertEqual(merged.index.ntotal, 3)
+        merged_documents = [merged.docstore.search(merged_id) for merged_id in merged.index_to_docstore_id.values()]
+        sources = sorted((doc.metadata["source"], doc.page_content) for doc in merged_documents)
+        self.assertEqual(sources, [("a.pdf", "alpha"), ("b.pdf", "beta"), ("b.pdf", "delta")])
+        hit = merged.similarity_search_by_vector(self.embeddings.embed_query("delta"), k=1)[0]
+        self.assertEqual(hit.metadata["source"], "b.pdf")
+
+    def test_merged_index_refreshes_metadata_of_unchanged_chunks(self):
+        """Test that re-merging a PDF updates the metadata of chunks whose text did not change."""
+        merged_path = os.path.join(self.base_dir, "merged", "client_1")
+        store, _ = add_to_vector_store_and_generate_vectors([Document(page_content="alpha", metadata={"page": 1})], "1", "a.pdf", self.base_dir)
+        update_merged_index(store, "a.pdf", merged_path)
+
+        store, _ = add_to_vector_store_and_generate_vectors([Document(page_content="alpha", metadata={"page": 3})], "1", "a.pdf", self.base_dir)
+        update_merged_index(store, "a.pdf", merged_path)
+
+        merged = load_flat_vector_store(merged_path)
+        document = merged.docstore.search(merged.index_to_docstore_id[0])
+        self.assertEqual(document.metadata, {"page": 3, "source": "a.pdf"})
+        self.assertEqual(merged.index.ntotal, 1)
+
+    def test_build_merged_indices_backfills_existing_pdfs(self):
+        """Test that PDFs indexed without a merged index are added to it once."""
+        merged_dir = os.path.join(self.base_dir, "merged")
+        for pdf_name, texts in (("a.pdf", ["alpha"]), ("b.pdf", ["beta", "gamma"])):
+            add_to_vector_store_and_generate_vectors([Document(page_content=text) for text in texts], "1", pdf_name, self.base_dir)
+            PDFDocument.objects.create(client_id="1", pdf_name=pdf_name, file_path=os.path.join(self.base_dir, "client_1", pdf_name))
+        self.embeddings.embedded.clear()
+
+        with override_settings(FAISS_MERGED_INDICES_DIR=merged_dir):
+            call_command("build_merged_indices", stdout=io.StringIO())
+            output = io.StringIO()
+            call_command("build_merged_indices", stdout=output)
+
+        self.assertIn("Added 0 PDFs", output.getvalue())
+        self.assertEqual(self.embeddings.embedded, [])
+        merged = IndexStore.load(os.path.join(merged_dir, "client_1"))
+        self.assertEqual(sorted((doc.metadata["source"], doc.page_content) for doc in merged.documents()),
+                         [("a.pdf", "alpha"), ("b.pdf", "beta"), ("b.pdf", "gamma")])
+
+    def test_legacy_pickled_index_is_converted(self):
+        """Test that convert_indices rewrites a save_local index in the native layout with the same chunks."""
+        index_path = os.path.join(self.base_dir, "client_1", "old.pdf")
+        texts = ["alpha", "beta"]
+        legacy = FAISS.from_embeddings(list(zip(texts, self.embeddings.embed_documents(texts))), self.embeddings, ids=["a", "b"])
+        legacy.save_local(index_path)
+
+        call_command("convert_indices", path=self.base_dir, stdout=io.StringIO())
+
+        self.assertFalse(os.path.exists(os.path.join(index_path, "index.pkl")))
+        store = IndexStore.load(index_path)
+        self.assertEqual([(doc.id, doc.page_content) for doc in store.documents()], [("a", "alpha"), ("b", "beta")])
+        self.assertEqual(load_flat_vector_store(index_path).index.ntotal, 2)
+
+    @override_settings(FAISS_FLAT_MAX_VECTORS=2, FAISS_MEDIUM_INDEX_TYPE="hnsw")
+    def test_index_type_follows_corpus_size_and_stays_incremental(self):
+        """Test that larger corpora are saved as HNSW and still update incrementally from exact vectors."""
+        first = [Document(page_content=text) for text in ("alpha", "beta", "gamma")]
+        add_to_vector_store_and_generate_vectors(first, "1", "doc.pdf", self.base_dir)
+        index_path = os.path.join(self.base_dir, "client_1", "doc.pdf")
+        self.assertEqual(read_index_meta(index_path)["index_type"], "hnsw")
+
+        self.embeddings.embedded.clear()
+        second = [Document(page_content=text) for text in ("alpha", "delta")]
+        vector_store, vectors = add_to_vector_store_and_generate_vectors(second, "1", "doc.pdf", self.base_dir)
+
+        self.assertEqual(self.embeddings.embedded, ["delta"])
+        self.assertEqual(read_index_meta(index_path)["index_type"], "flat")
+        self.assertEqual(vectors.tolist(), self.embeddings.embed_documents(["alpha", "delta"]))
+
+    @override_settings(FAISS_FLAT_MAX_VECTORS=10, FAISS_MEDIUM_INDEX_TYPE="ivf_flat")
+    def test_appended_chunks_extend_trained_index(self):
+        """Test that appending within a size tier adds to the trained index and a removal retrains it."""
+        index_path = os.path.join(self.base_dir, "client_1", "doc.pdf")
+        texts = [f"chunk number {i}" for i in range(80)]
+        add_to_vector_store_and_generate_vectors([Document(page_content=text) for text in texts], "1", "doc.pdf", self.base_dir)
+
+        with patch("uploadfile.pdf_processing.build_index", wraps=build_index) as mock_build:
+            texts += [f"appended chunk {i}" for i in range(10)]
+            add_to_vector_store_and_generate_vectors([Document(page_content=text) for text in texts], "1", "doc.pdf", self.base_dir)
+            self.assertEqual(mock_build.call_count, 0)
+            self.assertEqual(IndexStore.load(index_path).index.ntotal, 90)
+            self.assertEqual(read_index_meta(index_path)["index_type"], "ivf_flat")
+
+            add_to_vector_store_and_generate_vectors([Document(page_content=text) for text in texts[1:]], "1", "doc.pdf", self.base_dir)
+            self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(IndexStore.load(index_path).index.ntotal, 89)
+
+class TestChunkedUpload(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        settings_patcher = override_settings(TEMP_PDFS_DIR=self.temp_dir, UPLOAD_MAX_CHUNK_SIZE=1024)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        task_patcher = patch("uploadfile.tasks.start_pdf_ingest")
+        self.mock_task = task_patcher.start()
+        self.mock_task.return_value.id = "task-1"
+        self.addCleanup(task_patcher.stop)
+
+        self.user = User.objects.create_user(username="client", password="secret")
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {Token.objects.create(user=self.user).key}"}
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer, pagesize=letter)
+        c.drawString(100, 750, "This is a sample PDF file.")
+        c.save()
+        self.pdf_bytes = buffer.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _init(self, data=None):
+        data = data or {"pdf_name": "sample.pdf", "total_size": len(self.pdf_bytes)}
+        return self.client.post("/api/uploads/", data, content_type="application/json", **self.auth)
+
+    def _append(self, upload_id, offset, chunk, checksum=None):
+        return self.client.put(
+            f"/api/uploads/{upload_id}/", chunk, content_type="application/octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset), HTTP_UPLOAD_CHECKSUM=checksum or hashlib.sha256(chunk).hexdigest(), **self.auth
+        )
+
+    def test_chunked_upload_resumes_and_dispatches(self):
+        """Test that chunks append in order, a bad chunk is dropped, and complete dispatches the task."""
+        upload_id = self._init().json()["upload_id"]
+        first, rest = self.pdf_bytes[:1024], self.pdf_bytes[1024:]
+
+        self.assertEqual(self._append(upload_id, 0, first).json()["offset"], 1024)
+        # A corrupted chunk is rejected without moving the offset
+        self.assertEqual(self._append(upload_id, 1024, rest, checksum="0" * 64).status_code, 400)
+        # Resuming from the wrong offset reports the offset to send from
+        response = self._append(upload_id, 0, first)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 1024)
+        # Completing early is refused
+        self.assertEqual(self.client.post(f"/api/uploads/{upload_id}/complete/", **self.auth).status_code, 409)
+
+        for offset in range(1024, len(self.pdf_bytes), 1024):
+            self.assertEqual(self._append(upload_id, offset, self.pdf_bytes[offset:offset + 1024]).status_code, 200)
+        self.assertEqual(self.client.get(f"/api/uploads/{upload_id}/", **self.auth).json()["offset"], len(self.pdf_bytes))
+
+        response = self.client.post(f"/api/uploads/{upload_id}/complete/", **self.auth)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["task_id"], "task-1")
+        upload = UploadSession.objects.get(id=upload_id)
+        with open(upload.pdf_path, "rb") as f:
+            self.assertEqual(f.read(), self.pdf_bytes)
+        self.mock_task.assert_called_once_with(upload.pdf_path, client_id=str(self.user.id), pdf_name="sample.pdf")
+
+    def test_complete_rejects_checksum_mismatch_and_non_pdf(self):
+        """Test that complete verifies the whole-file checksum and the PDF header."""
+        upload_id = self._init({"pdf_name": "a.pdf", "total_size": 4, "checksum": "0" * 64}).json()["upload_id"]
+        self._append(upload_id, 0, b"%PDF")
+        self.assertEqual(self.client.post(f"/api/uploads/{upload_id}/complete/", **self.auth).status_code, 400)
+
+        upload_id = self._init({"pdf_name": "b.pdf", "total_size": 4}).json()["upload_id"]
+        self._append(upload_id, 0, b"text")
+        self.assertEqual(self.client.post(f"/api/uploads/{upload_id}/complete/", **self.auth).status_code, 400)
+        self.mock_task.assert_not_called()
+
+    def test_init_rejects_names_with_a_path(self):
+        """Test that a pdf_name that could leave the client's index folder is rejected."""
+        for pdf_name in ("../../other/x.pdf", "/tmp/x.pdf", "a\\b.pdf", "x\0.pdf", "..pdf", "a" * 256 + ".pdf"):
+            response = self._init({"pdf_name": pdf_name, "total_size": len(self.pdf_bytes)})
+            self.assertEqual(response.status_code, 400, pdf_name)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self._init().status_code, 201)
+
+    def test_uploads_are_scoped_to_the_client(self):
+        """Test that another client cannot read or append to an upload."""
+        upload_id = self._init().json()["upload_id"]
+        other = User.objects.create_user(username="other", password="secret")
+        other_auth = {"HTTP_AUTHORIZATION": f"Token {Token.objects.create(user=other).key}"}
+
+        self.assertEqual(self.client.get(f"/api/uploads/{upload_id}/", **other_auth).status_code, 404)
+
+    def test_multipart_batch_validates_each_file(self):
+        """Test that a non-PDF in a multipart batch is reported without rejecting the others."""
+        files = [
+            SimpleUploadedFile("good.pdf", self.pdf_bytes, content_type="application/pdf"),
+            SimpleUploadedFile("bad.pdf", b"not a pdf", content_type="application/pdf"),
+        ]
+
+        response = self.client.post("/api/upload/", {"pdfs": files}, **self.auth)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["task_ids"], ["task-1"])
+        self.assertEqual([r["file"] for r in response.json()["rejected"]], ["bad.pdf"])
+
+
+class TestDocumentVectors(TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        self.vectors = np.arange(20, dtype=np.float32).reshape(5, 4)
+        np.save(os.path.join(self.index_dir, "vectors.npy"), self.vectors)
+
+        self.user = User.objects.create_user(username="client", password="secret")
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {Token.objects.create(user=self.user).key}"}
+        self.document = PDFDocument.objects.create(client_id=str(self.user.id), pdf_name="a.pdf", file_path=self.index_dir)
+        self.url = f"/api/documents/{self.document.id}/vectors/"
+
+    def test_vectors_are_paginated_npy(self):
+        """Test that vectors come back as float16 .npy pages with pagination headers."""
+        response = self.client.get(self.url, {"limit": 3}, **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        page = np.load(io.BytesIO(response.content))
+        self.assertEqual(page.dtype, np.float16)
+        np.testing.assert_array_equal(page, self.vectors[:3])
+        self.assertEqual(response["X-Total-Count"], "5")
+        self.assertEqual(response["X-Next-Offset"], "3")
+
+        response = self.client.get(self.url, {"offset": 3, "limit": 3, "dtype": "float32"}, **self.auth)
+        np.testing.assert_array_equal(np.load(io.BytesIO(response.content)), self.vectors[3:])
+        self.assertNotIn("X-Next-Offset", response)
+
+    def test_vectors_are_scoped_to_the_client(self):
+        """Test that another client's document and bad parameters are rejected."""
+        other = User.objects.create_user(username="other", password="secret")
+        other_auth = {"HTTP_AUTHORIZATION": f"Token {Token.objects.create(user=other).key}"}
+
+        self.assertEqual(self.client.get(self.url, **other_auth).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {"dtype": "int8"}, **self.auth).status_code, 400)
+
+
+class TestIngestPipeline(TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir, ignore_errors=True)
+        settings_patcher = override_settings(
+            FAISS_INDICES_DIR=os.path.join(self.base_dir, "indices"),
+            FAISS_MERGED_INDICES_DIR=os.path.join(self.base_dir, "merged"),
+        )
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.embeddings = CountingEmbeddings()
+        for target in ("uploadfile.pdf_processing.get_embedding_engine", "uploadfile.tasks.get_embedding_engine"):
+            patcher = patch(target, return_value=self.embeddings)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.pdf_path = os.path.join(self.base_dir, "upload.pdf")
+        c = canvas.Canvas(self.pdf_path, pagesize=letter)
+        for page in range(3):
+            c.drawString(100, 750, f"Page {page} of the pipeline sample.")
+            c.showPage()
+        c.save()
+
+    def test_stages_hand_over_through_files(self):
+        """Test that the chained stages index the PDF, embed once and clean up their files."""
+        payload = extract_pdf_task(self.pdf_path, "12345", "sample.pdf")
+        self.assertEqual(payload["status"], "pending")
+        self.assertFalse(os.path.exists(self.pdf_path))
+
+        payload = embed_chunks_task(payload)
+        embedded = len(self.embeddings.embedded)
+        result = index_chunks_task(payload)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["chunks"], 3)
+        self.assertEqual(embedded, 3)
+        self.assertEqual(len(self.embeddings.embedded), 3)  # The index stage reuses the stage-2 vectors
+        self.assertTrue(PDFDocument.objects.filter(client_id="12345", pdf_name="sample.pdf").exists())
+        self.assertEqual(sorted(os.listdir(self.base_dir)), ["indices", "merged"])
+        self.assertTrue(os.path.exists(os.path.join(self.base_dir, "indices", "client_12345", "sample.pdf", "sparse", "meta.json")))  # Stage files are gone
+
+    def test_reupload_embeds_only_new_chunks(self):
+        """Test that the embed stage skips chunks already in the PDF's index."""
+        index_chunks_task(embed_chunks_task(extract_pdf_task(self.pdf_path, "12345", "sample.pdf")))
+        c = canvas.Canvas(self.pdf_path, pagesize=letter)
+        for page in range(4):
+            c.drawString(100, 750, f"Page {page} of the pipeline sample.")
+            c.showPage()
+        c.save()
+        self.embeddings.embedded.clear()
+
+        result = index_chunks_task(embed_chunks_task(extract_pdf_task(self.pdf_path, "12345", "sample.pdf")))
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["vectors"], 4)
+        self.assertEqual(self.embeddings.embedded, ["Page 3 of the pipeline sample."])
+
+    def test_failed_stage_result_passes_through(self):
+        """Test that a failed stage's result is carried to the end of the chain."""
+        failed = extract_pdf_task(os.path.join(self.base_dir, "missing.pdf"), "12345", "sample.pdf")
+
+        self.assertEqual(failed["status"], "error")
+        self.assertEqual(index_chunks_task(embed_chunks_task(failed)), failed)
+
+
+class TestIngestProgress(TestCase):
+    def setUp(self):
+        # In-memory key-value result backend standing in for Redis
+        self.backend = CacheBackend(app=celery_app, backend="memory")
+        patcher = patch("uploadfile.progress.current_app")
+        patcher.start().backend = self.backend
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username="client", password="secret")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+
+    def test_progress_is_throttled_and_has_eta(self):
+        """Test that progress writes are throttled, stage changes are not, and an ETA is derived."""
+        progress = IngestProgress("ingest-1", "a.pdf", min_interval=60)
+        progress.stage("extracting")
+        progress.update(pages_extracted=1, pages_total=4)
+
+        self.assertNotIn("pages_extracted", self.backend.get_task_meta("ingest-1")["result"])
+        progress.update(force=True, pages_extracted=2)
+        meta = self.backend.get_task_meta("ingest-1")
+        self.assertEqual(meta["status"], "PROGRESS")
+        self.assertEqual(meta["result"]["pages_extracted"], 2)
+        self.assertIsNotNone(meta["result"]["eta_seconds"])
+
+    @patch("uploadfile.tasks.read_pdf_pages")
+    @patch("uploadfile.tasks.convert_to_documents")
+    @patch("uploadfile.tasks.process_documents")
+    @patch("uploadfile.tasks.add_to_vector_store_and_generate_vectors")
+    @patch("uploadfile.tasks.update_merged_index")
+    def test_process_pdf_task_publishes_stages(self, mock_merge, mock_add, mock_process, mock_convert, mock_read):
+        """Test that process_pdf_task reports each stage under its own task id."""
+        mock_process.return_value = [MagicMock()]
+        mock_add.return_value = (MagicMock(), [1])
+        stages = []
+        original = self.backend.store_result
+        self.backend.store_result = lambda task_id, meta, state, **kw: (stages.append(meta["stage"]), original(task_id, meta, state, **kw))[1]
+        pdf_path = os.path.join(tempfile.mkdtemp(), "sample.pdf")
+        self.addCleanup(shutil.rmtree, os.path.dirname(pdf_path), ignore_errors=True)
+        canvas.Canvas(pdf_path).save()
+
+        process_pdf_task.apply((pdf_path, "12345", "sample.pdf"), task_id="ingest-2")
+
+        self.assertEqual(list(dict.fromkeys(stages)), ["extracting", "indexing", "merging"])
+
+    def test_batch_status_lookup(self):
+        """Test that many task ids are resolved in one call, with progress for running tasks."""
+        self.backend.store_result("done-1", {"status": "success"}, "SUCCESS")
+        self.backend.store_result("running-1", {"stage": "embedding", "chunks_embedded": 5}, "PROGRESS")
+
+        response = self.client.get("/api/status/batch/", {"task_ids": "done-1,running-1,unknown-1"}, **self.auth)
+
+        tasks = response.json()["tasks"]
+        self.assertEqual([t["status"] for t in tasks], ["SUCCESS", "PROGRESS", "PENDING"])
+        self.assertEqual(tasks[1]["progress"]["chunks_embedded"], 5)
+        self.assertEqual(self.client.get("/api/status/batch/", **self.auth).status_code, 400)
+
+    def test_failed_task_status_logs_traceback(self):
+        """Test that a failed task's traceback is logged, but not returned to the client."""
+        self.backend.store_result("failed-1", ValueError("boom"), "FAILURE", traceback="Traceback (most recent call last): boom")
+
+        with self.assertLogs("uploadfile.views", level="ERROR") as logs:
+            response = self.client.get("/api/status/failed-1", **self.auth)
+
+        self.assertEqual(response.json(), {"task_id": "failed-1", "status": "FAILURE", "error": "Task failed"})
+        self.assertIn("Traceback (most recent call last): boom", logs.output[0])
+
+    @override_settings(STATUS_STREAM_MAX_SECONDS=0)
+    async def test_status_stream_sends_updates(self):
+        """Test that the status stream sends one event per task and reports tasks still pending."""
+        self.backend.store_result("done-1", {"status": "success"}, "SUCCESS")
+        self.backend.store_result("running-1", {"stage": "extracting"}, "PROGRESS")
+
+        response = await self.async_client.get(
+            "/api/status/stream/", {"task_ids": "done-1,running-1"}, headers={"Authorization": f"Token {self.token.key}"}
+        )
+        body = b"".join([part async for part in response.streaming_content]).decode()
+
+        events = [block.split("\n") for block in body.strip().split("\n\n")]
+        self.assertEqual([lines[0] for lines in events], ["event: status", "event: status", "event: timeout"])
+        self.assertEqual(json.loads(events[2][1][len("data: "):]), {"pending": ["running-1"]})
+
+    @override_settings(STATUS_STREAM_POLL_SECONDS=0.01, STATUS_STREAM_MAX_SECONDS=30)
+    def test_status_stream_is_incremental_under_wsgi(self):
+        """Test that a WSGI request gets a sync stream whose events arrive while tasks are still running."""
+        self.backend.store_result("wsgi-1", {"stage": "extracting"}, "PROGRESS")
+
+        response = self.client.get("/api/status/stream/", {"task_ids": "wsgi-1"}, **self.auth)
+        stream = iter(response.streaming_content)
+
+        self.assertFalse(response.is_async)
+        self.assertIn('"PROGRESS"', next(stream).decode())
+        self.backend.store_result("wsgi-1", {"status": "success"}, "SUCCESS")
+        self.assertEqual([part.decode().split("\n")[0] for part in stream], ["event: status", "event: done"])
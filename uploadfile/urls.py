@@ -3,5 +3,11 @@ from . import views
 
 urlpatterns = [
     path('upload/', views.upload_and_process_pdfs, name='upload_and_process_pdfs'),  # Example URL pattern
+    path('uploads/', views.init_upload, name='init_upload'),
+    path('uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.complete_upload, name='complete_upload'),
+    path('documents/<int:document_id>/vectors/', views.get_document_vectors, name='get_document_vectors'),
+    path('status/batch/', views.check_task_statuses, name='check_task_statuses'),
+    path('status/stream/', views.stream_task_status, name='stream_task_status'),
     path('status/<str:task_id>',views.check_task_status, name="check_task_status")
-]
\ No newline at end of file
+]
@@ -1,18 +1,69 @@
+import asyncio
+import fcntl
+import hashlib
+import io
+import json
 import os
+import time
 import uuid
+from asgiref.sync import sync_to_async
+from celery.states import READY_STATES
 from django.conf import settings
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.utils import timezone
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+import numpy as np
 from rest_framework.decorators import api_view, parser_classes, authentication_classes, permission_classes
 from rest_framework.parsers import MultiPartParser
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
-from .tasks import process_pdf_task
-from celery.result import AsyncResult
+from .models import UploadSession
+from query_app.models import PDFDocument
+from .progress import task_states, task_traceback
 import logging
 
 # Set up logging for this module
 logger = logging.getLogger(__name__)
 
+# The ingest modules (.tasks, .pdf_processing) pull in LangChain and FAISS; they are imported
+# by the views that use them, so URL resolution and management commands do not load them
+
+PDF_MAGIC = b'%PDF-'
+STREAM_READ_SIZE = 64 * 1024  # Bytes read from the request body at a time
+
+
+def _looks_like_pdf(header):
+    """PDF readers accept the %PDF- marker anywhere in the first 1024 bytes."""
+    return PDF_MAGIC in header[:1024]
+
+
+def _validate_uploaded_pdf(pdf):
+    """Returns an error message if the uploaded file is not a PDF, else None."""
+    if pdf.content_type != 'application/pdf':
+        return f"File {pdf.name} is not a valid PDF."
+    header = pdf.read(1024)
+    pdf.seek(0)
+    if not _looks_like_pdf(header):
+        return f"File {pdf.name} is not a valid PDF."
+    return None
+
+
+def _store_uploaded_pdf(pdf, destination_path):
+    """
+    Puts an uploaded file at `destination_path`. Large uploads are already spooled
+    to disk by Django (in FILE_UPLOAD_TEMP_DIR, which is TEMP_PDFS_DIR), so they are
+    renamed into place; only small in-memory uploads are written out.
+    """
+    if hasattr(pdf, 'temporary_file_path'):
+        os.replace(pdf.temporary_file_path(), destination_path)
+        return
+    with open(destination_path, 'wb') as destination:
+        for chunk in pdf.chunks():  # Read the file in chunks
+            destination.write(chunk)
+
+
 @api_view(['POST'])  # This view only accepts POST requests
 @parser_classes([MultiPartParser])  # Parse multipart form data (file uploads)
 @authentication_classes([TokenAuthentication])  # Require token-based authentication
@@ -20,6 +71,8 @@ logger = logging.getLogger(__name__)
 def upload_and_process_pdfs(request):
     """
     View to upload PDFs and trigger background processing using Celery.
+    Each file is validated on its own: invalid files are reported in `rejected`
+    without stopping the rest of the batch.
     """
     # Check if the request contains any files
     if 'pdfs' not in request.FILES:
@@ -27,68 +80,409 @@ def upload_and_process_pdfs(request):
 
     # Get the list of uploaded PDF files
     pdfs = request.FILES.getlist('pdfs')
-    allowed_file_types = ['application/pdf']  # Only allow PDF files
     task_ids = []  # Store the IDs of the Celery tasks created
+    rejected = []  # Files that could not be accepted, with the reason
     client_id = str(request.user.id)  # Use the authenticated user's ID as the client ID
 
+    from .tasks import start_pdf_ingest
+
     # Process each uploaded PDF file
     for pdf in pdfs:
         # Check if the file is a valid PDF
-        if pdf.content_type not in allowed_file_types:
-            return HttpResponseBadRequest(f"File {pdf.name} is not a valid PDF.")
+        error = _validate_uploaded_pdf(pdf)
+        if error:
+            rejected.append({"file": pdf.name, "error": error})
+            continue
 
         try:
-            # Create a temporary directory for storing uploaded PDFs
-            temp_dir = settings.TEMP_PDFS_DIR  # Get the path from Django settings
-            os.makedirs(temp_dir, exist_ok=True)  # Create the directory if it doesn't exist
-
-            # Generate a unique filename for the uploaded PDF
-            temp_file_path = os.path.join(temp_dir, f"{uuid.uuid4()}.pdf")
-
-            # Save the uploaded PDF to the temporary file
-            with open(temp_file_path, 'wb+') as destination:
-                for chunk in pdf.chunks():  # Read the file in chunks
-                    destination.write(chunk)  # Write each chunk to the file
+            # Generate a unique filename for the uploaded PDF in the worker-visible directory
+            temp_file_path = os.path.join(settings.TEMP_PDFS_DIR, f"{uuid.uuid4()}.pdf")
+            _store_uploaded_pdf(pdf, temp_file_path)
 
             # Trigger the Celery task to process the PDF
-            task = process_pdf_task.delay(temp_file_path, client_id=client_id, pdf_name=pdf.name)
+            task = start_pdf_ingest(temp_file_path, client_id=client_id, pdf_name=pdf.name)
             task_ids.append(task.id)  # Store the task ID
             logger.info(f"Task {task.id} dispatched for {pdf.name} by client {client_id}")
 
-        except OSError as e:
-            # Log and return an error if there's an issue creating the temporary directory
-            logger.error(f"Error creating temporary directory: {e}")
-            return JsonResponse({"error": f"Error creating temporary directory: {str(e)}"}, status=500)
         except Exception as e:
-            # Log and return an error if there's an issue processing the PDF
+            # Log the error and carry on with the other files
             logger.error(f"Error processing {pdf.name}: {e}")
-            return JsonResponse({"error": f"Error processing {pdf.name}: {str(e)}"}, status=500)
+            rejected.append({"file": pdf.name, "error": f"Error processing {pdf.name}: {str(e)}"})
+
+    if not task_ids:
+        return JsonResponse({"error": "No PDFs were accepted.", "rejected": rejected}, status=400)
 
     # Return a success response with the list of task IDs
     return JsonResponse({
         "message": "PDFs are being processed in the background.",
-        "task_ids": task_ids
+        "task_ids": task_ids,
+        "rejected": rejected
+    }, status=202)
+
+
+def _upload_state(upload):
+    return {
+        "upload_id": str(upload.id),
+        "pdf_name": upload.pdf_name,
+        "offset": upload.received_bytes,
+        "total_size": upload.total_size,
+        "status": upload.status,
+        "task_id": upload.task_id or None,
+        "max_chunk_size": settings.UPLOAD_MAX_CHUNK_SIZE,
+    }
+
+
+def _get_upload(request, upload_id):
+    """Returns the caller's upload session, or None."""
+    return UploadSession.objects.filter(id=upload_id, client_id=str(request.user.id)).first()
+
+
+def _pdf_name_error(pdf_name):
+    """
+    Returns why `pdf_name` cannot be used, or None. The name becomes a directory
+    under the client's index folder, so it must be a plain file name (multipart
+    uploads get this from Django, which keeps only the basename).
+    """
+    max_length = UploadSession._meta.get_field('pdf_name').max_length
+    if len(pdf_name) > max_length:
+        return f"pdf_name must be at most {max_length} characters."
+    if any(part in pdf_name for part in ('/', '\\', '\0', '..')) or os.path.basename(pdf_name) != pdf_name:
+        return "pdf_name must be a file name without a path."
+    if not pdf_name.lower().endswith('.pdf'):
+        return f"File {pdf_name} is not a valid PDF."
+    return None
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def init_upload(request):
+    """
+    Starts a chunked upload. Body: {"pdf_name", "total_size", "checksum" (optional
+    SHA-256 hex of the whole file)}. Returns the upload id and the offset to send from.
+    """
+    pdf_name = request.data.get('pdf_name')
+    checksum = (request.data.get('checksum') or '').lower()
+    try:
+        total_size = int(request.data.get('total_size'))
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "total_size must be an integer."}, status=400)
+
+    if not pdf_name or not isinstance(pdf_name, str):
+        return JsonResponse({"error": "pdf_name is required."}, status=400)
+    name_error = _pdf_name_error(pdf_name)
+    if name_error:
+        return JsonResponse({"error": name_error}, status=400)
+    if not 0 < total_size <= settings.UPLOAD_MAX_FILE_SIZE:
+        return JsonResponse({"error": f"total_size must be between 1 and {settings.UPLOAD_MAX_FILE_SIZE} bytes."}, status=400)
+
+    upload = UploadSession.objects.create(
+        client_id=str(request.user.id), pdf_name=pdf_name, total_size=total_size, checksum=checksum
+    )
+    open(upload.part_path, 'wb').close()  # Chunks are written into this file in place
+    logger.info(f"Upload {upload.id} started for {pdf_name} ({total_size} bytes) by client {upload.client_id}")
+    return JsonResponse(_upload_state(upload), status=201)
+
+
+@api_view(['GET', 'PUT'])
+@parser_classes([])  # The chunk body is read as a raw stream, never parsed or buffered
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id):
+    """
+    GET returns the upload state; a client resumes by sending from `offset`.
+
+    PUT appends one chunk. The raw request body is the chunk; the headers
+    `Upload-Offset` (must equal the current offset) and `Upload-Checksum`
+    (SHA-256 hex of the chunk) are required. The chunk is streamed into the
+    partial file and kept only if its checksum matches.
+    """
+    upload = _get_upload(request, upload_id)
+    if upload is None:
+        return JsonResponse({"error": "Upload not found."}, status=404)
+    if request.method == 'GET':
+        return JsonResponse(_upload_state(upload))
+
+    if upload.status != UploadSession.STATUS_OPEN:
+        return JsonResponse({"error": "Upload is already completed.", **_upload_state(upload)}, status=409)
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return JsonResponse({"error": "Upload-Offset header is required."}, status=400)
+    expected_checksum = (request.headers.get('Upload-Checksum') or '').lower()
+    if not expected_checksum:
+        return JsonResponse({"error": "Upload-Checksum header is required."}, status=400)
+    if offset != upload.received_bytes:
+        return JsonResponse({"error": "Offset mismatch; resume from the returned offset.", **_upload_state(upload)}, status=409)
+
+    max_length = min(settings.UPLOAD_MAX_CHUNK_SIZE, upload.total_size - offset)
+    digest = hashlib.sha256()
+    written = 0
+    with open(upload.part_path, 'r+b') as part:
+        # One writer per upload: a concurrent append for the same offset waits here
+        fcntl.flock(part, fcntl.LOCK_EX)
+        part.seek(offset)
+        while True:
+            data = request.stream.read(STREAM_READ_SIZE) if request.stream else b''
+            if not data:
+                break
+            written += len(data)
+            if written > max_length:
+                part.truncate(offset)
+                return JsonResponse({"error": f"Chunk exceeds the allowed size of {max_length} bytes.", **_upload_state(upload)}, status=413)
+            digest.update(data)
+            part.write(data)
+
+        if not written or digest.hexdigest() != expected_checksum:
+            part.truncate(offset)  # Drop the bad chunk; the client retries from the same offset
+            return JsonResponse({"error": "Chunk checksum mismatch.", **_upload_state(upload)}, status=400)
+        part.flush()
+
+        # Advance the offset only if no other append got there first
+        updated = UploadSession.objects.filter(id=upload.id, received_bytes=offset, status=UploadSession.STATUS_OPEN).update(
+            received_bytes=offset + written, updated_at=timezone.now()
+        )
+        if not updated:
+            upload.refresh_from_db()
+            return JsonResponse({"error": "Offset mismatch; resume from the returned offset.", **_upload_state(upload)}, status=409)
+
+    upload.received_bytes = offset + written
+    return JsonResponse(_upload_state(upload))
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    """
+    Finishes a chunked upload: checks that every byte arrived, that the file is a
+    PDF and (if given at init) matches its checksum, then renames it into place
+    and starts the ingest pipeline.
+    """
+    from .pdf_processing import hash_file
+    from .tasks import start_pdf_ingest
+
+    upload = _get_upload(request, upload_id)
+    if upload is None:
+        return JsonResponse({"error": "Upload not found."}, status=404)
+    if upload.status == UploadSession.STATUS_COMPLETED:
+        return JsonResponse(_upload_state(upload))  # Completing twice is harmless
+    if upload.received_bytes != upload.total_size:
+        return JsonResponse({"error": "Upload is incomplete.", **_upload_state(upload)}, status=409)
+
+    with open(upload.part_path, 'rb') as part:
+        if not _looks_like_pdf(part.read(1024)):
+            return JsonResponse({"error": f"File {upload.pdf_name} is not a valid PDF.", **_upload_state(upload)}, status=400)
+    if upload.checksum and hash_file(upload.part_path) != upload.checksum:
+        return JsonResponse({"error": "File checksum mismatch.", **_upload_state(upload)}, status=400)
+
+    # Claim the upload so that concurrent completes dispatch a single task
+    if not UploadSession.objects.filter(id=upload.id, status=UploadSession.STATUS_OPEN).update(status=UploadSession.STATUS_COMPLETED):
+        upload.refresh_from_db()
+        return JsonResponse(_upload_state(upload))
+
+    try:
+        os.replace(upload.part_path, upload.pdf_path)  # Same directory: a rename, not a copy
+        task = start_pdf_ingest(upload.pdf_path, client_id=upload.client_id, pdf_name=upload.pdf_name)
+    except Exception as e:
+        logger.error(f"Error completing upload {upload.id}: {e}")
+        if os.path.exists(upload.pdf_path):
+            os.replace(upload.pdf_path, upload.part_path)
+        UploadSession.objects.filter(id=upload.id).update(status=UploadSession.STATUS_OPEN)
+        return JsonResponse({"error": f"Error processing {upload.pdf_name}: {str(e)}"}, status=500)
+
+    upload.status = UploadSession.STATUS_COMPLETED
+    upload.task_id = task.id
+    upload.save(update_fields=['status', 'task_id', 'updated_at'])
+    logger.info(f"Task {task.id} dispatched for upload {upload.id} ({upload.pdf_name}) by client {upload.client_id}")
+    return JsonResponse({
+        "message": "PDF is being processed in the background.",
+        **_upload_state(upload)
     }, status=202)
 
 
+VECTOR_DTYPES = {'float16': np.float16, 'float32': np.float32}
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def get_document_vectors(request, document_id):
+    """
+    Returns a page of a document's embedding vectors as a .npy file.
+
+    Query parameters: `offset` (default 0), `limit` (default VECTORS_PAGE_DEFAULT_ROWS,
+    at most VECTORS_PAGE_MAX_ROWS) and `dtype` ('float16' or 'float32', default
+    'float16'). Row i is index position offset + i. The `X-Total-Count` and
+    `X-Next-Offset` headers drive pagination; `X-Next-Offset` is absent on the last page.
+    """
+    document = PDFDocument.objects.filter(id=document_id, client_id=str(request.user.id)).only('file_path').first()
+    if document is None:
+        return JsonResponse({"error": "Document not found."}, status=404)
+
+    dtype = request.query_params.get('dtype', 'float16')
+    if dtype not in VECTOR_DTYPES:
+        return JsonResponse({"error": "dtype must be 'float16' or 'float32'."}, status=400)
+    try:
+        offset = int(request.query_params.get('offset', 0))
+        limit = int(request.query_params.get('limit', settings.VECTORS_PAGE_DEFAULT_ROWS))
+    except ValueError:
+        return JsonResponse({"error": "offset and limit must be integers."}, status=400)
+    if offset < 0 or not 0 < limit <= settings.VECTORS_PAGE_MAX_ROWS:
+        return JsonResponse({"error": f"offset must be >= 0 and limit between 1 and {settings.VECTORS_PAGE_MAX_ROWS}."}, status=400)
+
+    from .pdf_processing import read_vectors
+
+    try:
+        rows, total = read_vectors(document.file_path, offset=offset, limit=limit)
+    except (OSError, RuntimeError) as e:
+        logger.error(f"Error reading vectors of document {document_id}: {e}")
+        return JsonResponse({"error": "Vectors are not available for this document."}, status=404)
+
+    buffer = io.BytesIO()
+    np.save(buffer, rows.astype(VECTOR_DTYPES[dtype], copy=False))
+    response = HttpResponse(buffer.getvalue(), content_type='application/octet-stream')
+    response['Content-Disposition'] = f'attachment; filename="vectors_{document_id}_{offset}.npy"'
+    response['X-Total-Count'] = str(total)
+    response['X-Offset'] = str(offset)
+    if offset + len(rows) < total:
+        response['X-Next-Offset'] = str(offset + len(rows))
+    return response
+
+
 @api_view(['GET'])  # This view only accepts GET requests
 @authentication_classes([TokenAuthentication])  # Require token-based authentication
 @permission_classes([IsAuthenticated])  # Restrict access to authenticated users
 def check_task_status(request, task_id):
     """
     View to check the status of a Celery task.
+    While an ingest runs, its status is PROGRESS and `progress` holds its counters.
     """
-    # Get the result of the Celery task using the task ID
-    task_result = AsyncResult(task_id)
+    # Get the status of the Celery task using the task ID
+    state = task_states([task_id])[0]
 
     # Check if the task failed
-    if task_result.failed():
-        logger.error(f"Task {task_id} failed: {task_result.traceback}")
-        return JsonResponse({"task_id": task_id, "status": task_result.status, "error": "Task failed"})
+    if state["status"] == "FAILURE":
+        logger.error(f"Task {task_id} failed: {task_traceback(task_id)}")
 
     # Return the task status and result
-    return JsonResponse({
-        "task_id": task_id,
-        "status": task_result.status,
-        "result": task_result.result
-    })
\ No newline at end of file
+    return JsonResponse(state)
+
+
+def _parse_task_ids(raw):
+    """Parses a comma-separated (or list of) task ids; raises ValueError if invalid."""
+    task_ids = raw.split(',') if isinstance(raw, str) else list(raw or [])
+    task_ids = [str(task_id).strip() for task_id in task_ids if str(task_id).strip()]
+    if not task_ids:
+        raise ValueError("task_ids is required.")
+    if len(task_ids) > settings.STATUS_BATCH_MAX_TASKS:
+        raise ValueError(f"At most {settings.STATUS_BATCH_MAX_TASKS} task ids per request.")
+    return list(dict.fromkeys(task_ids))
+
+
+@api_view(['GET', 'POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def check_task_statuses(request):
+    """
+    Batched status lookup: `task_ids` as a comma-separated query parameter (GET)
+    or a JSON list (POST). Returns {"tasks": [...]} in the same form as
+    check_task_status, read from the result backend in one round trip.
+    """
+    raw = request.query_params.get('task_ids') if request.method == 'GET' else request.data.get('task_ids')
+    try:
+        task_ids = _parse_task_ids(raw)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"tasks": task_states(task_ids)})
+
+
+def _authenticate_token(request):
+    """Runs DRF token authentication on a plain Django request; returns the user or None."""
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def _sse_event(event, data):
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+_STREAM_END = object()
+
+
+def _status_events(task_ids):
+    """
+    The messages of a status stream, polling the result backend for all pending
+    tasks together. Yields None where the stream should pause for
+    STATUS_STREAM_POLL_SECONDS before the next read.
+    """
+    pending = list(task_ids)
+    last_sent = {}
+    deadline = time.monotonic() + settings.STATUS_STREAM_MAX_SECONDS
+    while pending:
+        try:
+            states = task_states(pending)
+        except Exception as e:
+            logger.error(f"Error reading task status: {str(e)}")
+            yield _sse_event("error", {"error": str(e)})
+            return
+        for state in states:
+            if last_sent.get(state["task_id"]) != state:
+                last_sent[state["task_id"]] = state
+                yield _sse_event("status", state)
+        pending = [state["task_id"] for state in states if state["status"] not in READY_STATES]
+        if not pending:
+            break
+        if time.monotonic() >= deadline:
+            yield _sse_event("timeout", {"pending": pending})
+            return
+        yield None
+    yield _sse_event("done", {})
+
+
+@require_GET
+async def stream_task_status(request):
+    """
+    Streams the status of one or more tasks (`task_ids`, comma-separated) as
+    Server-Sent Events. A 'status' event is sent for each task whenever its
+    status or progress changes, and 'done' once every task has finished. The
+    result backend is read once per STATUS_STREAM_POLL_SECONDS for all pending
+    tasks together; the stream ends after STATUS_STREAM_MAX_SECONDS and the
+    client reconnects with the ids still pending.
+
+    Under ASGI the stream waits on the event loop. Under WSGI (gunicorn gthread,
+    the default) it is a plain generator that holds its worker thread, since a
+    WSGI server would otherwise collect an async stream whole before sending it.
+    """
+    user = await sync_to_async(_authenticate_token)(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    try:
+        task_ids = _parse_task_ids(request.GET.get('task_ids'))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    def sync_event_stream():
+        for message in _status_events(task_ids):
+            if message is None:
+                time.sleep(settings.STATUS_STREAM_POLL_SECONDS)
+            else:
+                yield message
+
+    async def event_stream():
+        events = _status_events(task_ids)
+        while (message := await sync_to_async(next)(events, _STREAM_END)) is not _STREAM_END:
+            if message is None:
+                await asyncio.sleep(settings.STATUS_STREAM_POLL_SECONDS)
+            else:
+                yield message
+
+    stream = event_stream() if isinstance(request, ASGIRequest) else sync_event_stream()
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Disable proxy buffering so events are delivered immediately
+    return response